@@ -1,18 +1,35 @@
 import asyncio
+import bisect
 import logging
 import os
+import random
 import signal
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+import sys
+import threading
+from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.middlewares.error import ErrorsMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import DEFAULT_DESTINY, BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import DisabledEventIsolation, SimpleEventIsolation
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import asyncpg
+from aiohttp import ClientSession, ClientTimeout, web
+import json
+import time
+from collections import Counter, OrderedDict, deque
 from datetime import datetime
-from typing import Optional, Dict, List, Tuple
+from typing import Any, Callable, Optional, Dict, List, Tuple
 import secrets
 import hashlib
+import hmac
+import base64
+import functools
+import inspect
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 
 # ============================================
 # НАСТРОЙКА ЛОГИРОВАНИЯ
@@ -29,14 +46,421 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-# Инициализация бота
+# Кэш уже зарегистрированных менеджеров (telegram_id)
+KNOWN_MANAGERS_CACHE_SIZE = int(os.getenv("KNOWN_MANAGERS_CACHE_SIZE", "10000"))
+KNOWN_MANAGERS_CACHE_TTL = float(os.getenv("KNOWN_MANAGERS_CACHE_TTL", "3600"))
+
+# Кэш снимков контента квартир (infos + категории)
+APARTMENT_SNAPSHOT_CACHE_SIZE = int(os.getenv("APARTMENT_SNAPSHOT_CACHE_SIZE", "500"))
+APARTMENT_SNAPSHOT_CACHE_TTL = float(os.getenv("APARTMENT_SNAPSHOT_CACHE_TTL", "300"))
+
+# Кэш собранных гостевых гидов (тексты и клавиатуры режима гостя)
+GUEST_GUIDE_CACHE_SIZE = int(os.getenv("GUEST_GUIDE_CACHE_SIZE", "1000"))
+GUEST_GUIDE_CACHE_TTL = float(os.getenv("GUEST_GUIDE_CACHE_TTL", "600"))
+
+# Подписанные deep-link ссылки (гость / приглашение менеджера).
+# Без LINK_SECRET ключ выводится из BOT_TOKEN - смена токена бота отзывает все ссылки.
+LINK_SECRET = os.getenv("LINK_SECRET")
+GUEST_LINK_TTL_DAYS = float(os.getenv("GUEST_LINK_TTL_DAYS", "120"))
+INVITE_LINK_TTL_DAYS = float(os.getenv("INVITE_LINK_TTL_DAYS", "30"))
+LEGACY_LINK_HASHES = os.getenv("LEGACY_LINK_HASHES", "1") == "1"
+
+# Лента изменений БД (LISTEN/NOTIFY) для сброса кэшей при правках из Strapi
+CHANGE_FEED_ENABLED = os.getenv("CHANGE_FEED_ENABLED", "1") == "1"
+CHANGE_FEED_CHANNEL = "bot_cache_invalidation"
+CHANGE_FEED_PING_INTERVAL = float(os.getenv("CHANGE_FEED_PING_INTERVAL", "30"))
+CHANGE_FEED_PING_TIMEOUT = float(os.getenv("CHANGE_FEED_PING_TIMEOUT", "5"))
+
+# Приём апдейтов: polling (по умолчанию) или webhook на том же aiohttp-сервере
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))
+
+# Пул обработчиков апдейтов (0 воркеров - обработка прямо в задаче aiogram, без пула)
+HANDLER_WORKERS = int(os.getenv("HANDLER_WORKERS", "16"))
+HANDLER_QUEUE_DEPTH = int(os.getenv("HANDLER_QUEUE_DEPTH", "2000"))
+HANDLER_DRAIN_TIMEOUT = float(os.getenv("HANDLER_DRAIN_TIMEOUT", "10"))
+
+# Окна идемпотентности: повтор update_id и повторное нажатие мутирующей кнопки
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "50000"))
+IDEMPOTENCY_UPDATE_WINDOW = float(os.getenv("IDEMPOTENCY_UPDATE_WINDOW", "600"))
+IDEMPOTENCY_CALLBACK_WINDOW = float(os.getenv("IDEMPOTENCY_CALLBACK_WINDOW", "3"))
+
+# Веса полос пула: гость, менеджер, фон (правки контента, предложения)
+HANDLER_LANE_WEIGHTS = tuple(int(w) for w in os.getenv("HANDLER_LANE_WEIGHTS", "6,3,1").split(","))
+
+# Контекст БД апдейта: одно соединение на апдейт и мемоизация чтений.
+# Апдейт дороже DB_QUERIES_WARN запросов попадает в лог.
+# Соединение из пула ждём не дольше DB_ACQUIRE_TIMEOUT секунд - при исчерпании пула
+# апдейт падает с ошибкой, а не висит вместе со всеми остальными.
+DB_REQUEST_CONTEXT = os.getenv("DB_REQUEST_CONTEXT", "1") == "1"
+DB_QUERIES_WARN = int(os.getenv("DB_QUERIES_WARN", "25"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+
+# Запросы к БД дольше SLOW_QUERY_MS попадают в лог (с формой аргументов, без значений)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+
+# Готовность (/ready): интервал замера лага event loop и пороги проверок
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+READY_MAX_LOOP_LAG_MS = float(os.getenv("READY_MAX_LOOP_LAG_MS", "500"))
+READY_DB_TIMEOUT = float(os.getenv("READY_DB_TIMEOUT", "1"))
+READY_MAX_UPDATE_AGE = float(os.getenv("READY_MAX_UPDATE_AGE", "60"))
+
+# Трассировка апдейтов: доля случайно сохраняемых трасс и порог "медленной" трассы
+# (сохраняется всегда). Экспорт в JSONL-файл или OTLP/HTTP JSON (TRACE_OTLP_URL).
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_URL = os.getenv("TRACE_OTLP_URL")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "1000"))
+
+# Темп исходящих вызовов Bot API (сообщений в секунду): общий и на чат, 0 - без ограничения.
+# На 429 ждём retry_after и повторяем до TG_MAX_RETRIES раз, если ожидание не дольше TG_MAX_RETRY_AFTER;
+# вызовы из обработчика апдейта держат воркер пула и соединение с БД - им не дольше TG_MAX_INLINE_RETRY_AFTER.
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "28"))
+TG_GLOBAL_BURST = float(os.getenv("TG_GLOBAL_BURST", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+TG_MAX_RETRY_AFTER = float(os.getenv("TG_MAX_RETRY_AFTER", "60"))
+TG_MAX_INLINE_RETRY_AFTER = float(os.getenv("TG_MAX_INLINE_RETRY_AFTER", "5"))
+
+# Рассылки: свой темп (ниже общего TG_GLOBAL_RATE - запас для интерактива),
+# параллельные отправки, размер захватываемой пачки и число попыток на получателя.
+# Повтор после сбоя - не раньше BROADCAST_RETRY_DELAY * 2^(попытка-1) секунд.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "50"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "3"))
+BROADCAST_RETRY_DELAY = float(os.getenv("BROADCAST_RETRY_DELAY", "30"))
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "30"))
+
+# Профилировщик /debug/profile: доступ по Bearer-токену, без токена маршрут выключен
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+# /stats, /stats/queries и /metrics: с STATS_TOKEN - только по Bearer-токену.
+# Без токена открыты в polling-режиме; в webhook-режиме порт публичный - маршруты выключены.
+STATS_TOKEN = os.getenv("STATS_TOKEN")
+
+# Одинаковые одновременные чтения из БД (разные апдейты) выполняются одним запросом
+DB_SINGLE_FLIGHT = os.getenv("DB_SINGLE_FLIGHT", "1") == "1"
+
+# FSM-хранилище: memory (по умолчанию) или postgres - общее для нескольких реплик
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.2"))
+
+# Границы memory-хранилища: число чатов и время простоя до удаления состояния
+FSM_MEMORY_MAX_CHATS = int(os.getenv("FSM_MEMORY_MAX_CHATS", "100000"))
+FSM_MEMORY_TTL = float(os.getenv("FSM_MEMORY_TTL", "259200"))  # 3 суток
+
+# ============================================
+# FSM-ХРАНИЛИЩА
+# ============================================
+
+class FSMRecord:
+    """Компактная запись FSM: данные - кортеж пар вместо dict"""
+    
+    __slots__ = ('state', 'data', 'expires_at')
+    
+    def __init__(self, state: Optional[str], data: Tuple, expires_at: float):
+        self.state = state
+        self.data = data
+        self.expires_at = expires_at
+
+class BoundedMemoryStorage(BaseStorage):
+    """
+    Замена MemoryStorage с ограничением памяти: записи простаивающих чатов
+    истекают через ttl (скользящий - продлевается при каждом обращении),
+    сверх max_chats вытесняются самые давние (LRU). Пустые записи
+    (нет состояния и данных) не хранятся вовсе. ttl <= 0 - без истечения.
+    
+    При общем скользящем TTL порядок LRU совпадает с порядком истечения,
+    поэтому устаревшие записи снимаются с головы очереди за O(число истёкших).
+    """
+    
+    def __init__(self, max_chats: int, ttl: float):
+        self.max_chats = max_chats
+        self.ttl = ttl if ttl > 0 else float('inf')
+        self._records: OrderedDict = OrderedDict()
+        self.expired = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def _compact_key(key: StorageKey) -> Tuple:
+        if key.thread_id is None and key.destiny == DEFAULT_DESTINY:
+            return key.bot_id, key.chat_id, key.user_id
+        return key.bot_id, key.chat_id, key.user_id, key.thread_id, key.destiny
+    
+    def _expire(self, now: float):
+        while self._records:
+            record = next(iter(self._records.values()))
+            if record.expires_at > now:
+                break
+            self._records.popitem(last=False)
+            self.expired += 1
+    
+    def _get(self, key: StorageKey) -> Optional[FSMRecord]:
+        now = time.monotonic()
+        self._expire(now)
+        
+        compact_key = self._compact_key(key)
+        record = self._records.get(compact_key)
+        if record is not None:
+            record.expires_at = now + self.ttl
+            self._records.move_to_end(compact_key)
+        return record
+    
+    def _put(self, key: StorageKey, state: Optional[str], data: Tuple):
+        compact_key = self._compact_key(key)
+        
+        if state is None and not data:
+            self._records.pop(compact_key, None)
+            return
+        
+        self._records[compact_key] = FSMRecord(state, data, time.monotonic() + self.ttl)
+        self._records.move_to_end(compact_key)
+        
+        while len(self._records) > self.max_chats:
+            self._records.popitem(last=False)
+            self.evictions += 1
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._get(key)
+        state = state.state if isinstance(state, State) else state
+        self._put(key, state, record.data if record else ())
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._get(key)
+        return record.state if record else None
+    
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = self._get(key)
+        items = tuple((sys.intern(name), value) for name, value in data.items())
+        self._put(key, record.state if record else None, items)
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self._get(key)
+        return dict(record.data) if record else {}
+    
+    async def close(self) -> None:
+        self._records.clear()
+    
+    def memory_usage(self) -> int:
+        """Примерный объём памяти записей в байтах (ключи, записи, данные)"""
+        total = sys.getsizeof(self._records)
+        for compact_key, record in self._records.items():
+            total += sys.getsizeof(compact_key) + sys.getsizeof(record) + sys.getsizeof(record.data)
+            for item in record.data:
+                total += sys.getsizeof(item) + sys.getsizeof(item[1])
+        return total
+    
+    def stats(self) -> Dict:
+        self._expire(time.monotonic())
+        return {
+            'size': len(self._records),
+            'max_chats': self.max_chats,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'memory_bytes': self.memory_usage()
+        }
+
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM-хранилище на asyncpg: одна строка на ключ aiogram
+    (bot, chat, user, thread, destiny), состояние - TEXT, данные - JSONB.
+    
+    Изменения копятся в буфере и раз в flush_interval пишутся одним
+    batch-запросом, так что серия state.update_data внутри обработчика
+    даёт одну запись. Пока запись не сброшена, чтения отдают её из буфера;
+    после сброса читаем из БД, поэтому реплики видят общее состояние.
+    flush_interval <= 0 - запись сразу (write-through).
+    """
+    
+    def __init__(self, flush_interval: float = 0.2):
+        self.flush_interval = flush_interval
+        self._dirty: Dict[StorageKey, List] = {}
+        self._flushing: Dict[StorageKey, List] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._stats = {
+            'reads': 0,
+            'writes': 0,
+            'flushes': 0,
+            'rows_flushed': 0,
+            'flush_errors': 0
+        }
+    
+    @staticmethod
+    async def setup(conn):
+        """Таблица бота (не Strapi) - создаём при старте, если её нет"""
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS bot_fsm_states (
+                bot_id BIGINT NOT NULL,
+                chat_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                thread_id BIGINT NOT NULL DEFAULT 0,
+                destiny TEXT NOT NULL DEFAULT 'default',
+                state TEXT,
+                data JSONB NOT NULL DEFAULT '{}'::jsonb,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (bot_id, chat_id, user_id, thread_id, destiny)
+            )
+        ''')
+    
+    @staticmethod
+    def _key_values(key: StorageKey) -> Tuple:
+        return key.bot_id, key.chat_id, key.user_id, key.thread_id or 0, key.destiny
+    
+    async def _record(self, key: StorageKey) -> List:
+        """[state, data] из буфера или из БД"""
+        record = self._dirty.get(key) or self._flushing.get(key)
+        if record is not None:
+            return record
+        
+        self._stats['reads'] += 1
+        async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+            row = await conn.fetchrow('''
+                SELECT state, data FROM bot_fsm_states
+                WHERE bot_id = $1 AND chat_id = $2 AND user_id = $3
+                  AND thread_id = $4 AND destiny = $5
+            ''', *self._key_values(key))
+        
+        if not row:
+            return [None, {}]
+        return [row['state'], json.loads(row['data'])]
+    
+    async def _write(self, key: StorageKey, record: List):
+        self._stats['writes'] += 1
+        self._dirty[key] = record
+        
+        if self.flush_interval <= 0:
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+    
+    async def _delayed_flush(self):
+        # Записи, пришедшие во время сброса, не создают новую задачу
+        # (эта ещё не завершена), поэтому досбрасываем их здесь же
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if not self._dirty:
+                return
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        state = state.state if isinstance(state, State) else state
+        await self._write(key, [state, record[1]])
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key))[0]
+    
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._record(key)
+        await self._write(key, [record[0], dict(data)])
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._record(key))[1])
+    
+    async def flush(self):
+        """Записать накопленные изменения: upsert непустых строк, delete пустых"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            
+            self._flushing, self._dirty = self._dirty, {}
+            upserts = [
+                self._key_values(key) + (state, json.dumps(data, default=str))
+                for key, (state, data) in self._flushing.items()
+                if state is not None or data
+            ]
+            deletes = [
+                self._key_values(key)
+                for key, (state, data) in self._flushing.items()
+                if state is None and not data
+            ]
+            
+            try:
+                async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+                    async with conn.transaction():
+                        if upserts:
+                            await conn.execute('''
+                                INSERT INTO bot_fsm_states (
+                                    bot_id, chat_id, user_id, thread_id, destiny, state, data, updated_at
+                                )
+                                SELECT r.bot_id, r.chat_id, r.user_id, r.thread_id, r.destiny,
+                                       r.state, r.data::jsonb, NOW()
+                                FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[],
+                                            $5::text[], $6::text[], $7::text[])
+                                     AS r(bot_id, chat_id, user_id, thread_id, destiny, state, data)
+                                ON CONFLICT (bot_id, chat_id, user_id, thread_id, destiny)
+                                DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data,
+                                              updated_at = EXCLUDED.updated_at
+                            ''', *(list(column) for column in zip(*upserts)))
+                        
+                        if deletes:
+                            await conn.execute('''
+                                DELETE FROM bot_fsm_states t
+                                USING unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[], $5::text[])
+                                      AS r(bot_id, chat_id, user_id, thread_id, destiny)
+                                WHERE t.bot_id = r.bot_id AND t.chat_id = r.chat_id
+                                  AND t.user_id = r.user_id AND t.thread_id = r.thread_id
+                                  AND t.destiny = r.destiny
+                            ''', *(list(column) for column in zip(*deletes)))
+                
+                self._stats['flushes'] += 1
+                self._stats['rows_flushed'] += len(self._flushing)
+            except Exception as e:
+                # Возвращаем в буфер всё, что не было перезаписано за время сброса
+                logger.error(f"❌ FSM flush failed: {e}")
+                self._stats['flush_errors'] += 1
+                for key, record in self._flushing.items():
+                    self._dirty.setdefault(key, record)
+                if self.flush_interval > 0 and (self._flush_task is None or self._flush_task.done()):
+                    self._flush_task = asyncio.create_task(self._delayed_flush())
+            finally:
+                self._flushing = {}
+    
+    async def close(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        if db_pool:
+            await self.flush()
+    
+    def stats(self) -> Dict:
+        return {**self._stats, 'pending': len(self._dirty)}
+
+# ============================================
+# ИНИЦИАЛИЗАЦИЯ БОТА
+# ============================================
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+if FSM_STORAGE == "postgres":
+    storage = PostgresStorage(FSM_FLUSH_INTERVAL)
+else:
+    storage = BoundedMemoryStorage(FSM_MEMORY_MAX_CHATS, FSM_MEMORY_TTL)
+# Без пула обработчиков апдейты одного чата сериализует сам aiogram
+dp = Dispatcher(
+    storage=storage,
+    events_isolation=SimpleEventIsolation() if not HANDLER_WORKERS else DisabledEventIsolation()
+)
 
 # Глобальный пул соединений
 db_pool: Optional[asyncpg.Pool] = None
 
+# Реестр категорий: название -> id и id -> id родительской категории
+category_ids: Dict[str, int] = {}
+category_parents: Dict[int, int] = {}
+
+# Фоновые задачи, которые нужно остановить при выключении
+background_tasks: List[asyncio.Task] = []
+
 # ============================================
 # HELPER ФУНКЦИЯ ДЛЯ БЕЗОПАСНОЙ ОБРАБОТКИ NULL
 # ============================================
@@ -64,6 +488,7 @@ SECTION_TO_CATEGORY_MAP = {
     'stores': 'Магазины и услуги'
 }
 
+# Порядок ключей входит в callback_data (CALLBACK_STATIC_FIELDS): новые поля только в конец
 FIELD_TO_CATEGORY_MAP = {
     'checkin_time': 'Время заселения',
     'parking': 'Парковка',
@@ -104,6 +529,9 @@ FIELD_TO_CATEGORY_MAP = {
 # Обратный маппинг: из названия категории получаем field_key
 CATEGORY_TO_FIELD_MAP = {v: k for k, v in FIELD_TO_CATEGORY_MAP.items()}
 
+# Обратный маппинг: из названия категории раздела получаем ключ раздела
+CATEGORY_TO_SECTION_MAP = {v: k for k, v in SECTION_TO_CATEGORY_MAP.items()}
+
 # Иконки для UI
 FIELD_NAMES = {
     'checkin_time': '🕐 Время заселения и выселения',
@@ -183,6 +611,1068 @@ USEFUL_LINKS = {
     'join_chat': 'https://t.me/mir_any'
 }
 
+# ============================================
+# IN-MEMORY КЭШИ
+# ============================================
+
+class TTLCache:
+    """
+    Ограниченный кэш с TTL и LRU-вытеснением.
+    ttl <= 0 - записи не устаревают, вытесняются только по размеру.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at is None or expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+    
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+    
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        return item[1] if item else None
+    
+    def clear(self):
+        self._data.clear()
+    
+    def values(self) -> List:
+        """Все значения (включая устаревшие) без обновления LRU-порядка"""
+        return [value for _, value in self._data.values()]
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def stats(self) -> Dict:
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+# telegram_id менеджеров, которые точно есть в таблице managers
+known_managers = TTLCache(KNOWN_MANAGERS_CACHE_SIZE, KNOWN_MANAGERS_CACHE_TTL)
+
+# ============================================
+# МЕТРИКИ
+# ============================================
+
+class LatencyHistogram:
+    """Гистограмма длительностей (мс) с фиксированными корзинами"""
+    
+    BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+    
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+    
+    def quantile(self, q: float) -> Optional[float]:
+        """Верхняя граница корзины, в которую попадает квантиль q"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.BUCKETS_MS, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return float(bound)
+        return self.max_ms
+    
+    def stats(self) -> Dict:
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total_ms / self.count, 2) if self.count else None,
+            'p50_ms': self.quantile(0.5),
+            'p95_ms': self.quantile(0.95),
+            'p99_ms': self.quantile(0.99),
+            'max_ms': round(self.max_ms, 2)
+        }
+
+# ============================================
+# ИДЕМПОТЕНТНОСТЬ АПДЕЙТОВ
+# ============================================
+
+# Кнопки, которые пишут в БД: повторное нажатие той же кнопки того же
+# сообщения, пока первое не обработано (и ещё окно после), отбрасывается
+MUTATING_CALLBACK_PREFIXES = (
+    "confirm_save_", "confirm_delete_", "confirm_apt_edit_", "toggle_term_",
+    "toggle_long_term", "save_custom_", "delete_custom_", "complete_booking_"
+)
+
+# update_id, уже принятые этой репликой (повторная доставка webhook, ретраи)
+seen_updates = TTLCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_UPDATE_WINDOW)
+
+# Ключи мутирующих нажатий: в работе и недавно завершённые
+inflight_mutations = set()
+recent_mutations = TTLCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_CALLBACK_WINDOW)
+
+idempotency_stats = {
+    'duplicate_updates': 0,
+    'duplicate_callbacks': 0
+}
+
+def mutation_key(event: types.Update) -> Optional[Tuple]:
+    """(чат, сообщение, callback_data) для мутирующей кнопки, иначе None"""
+    callback = event.callback_query
+    if not callback or not callback.data or not callback.message:
+        return None
+    
+    if callback.data.startswith(CALLBACK_CODEC_PREFIX):
+        payload = FieldCallback.unpack(callback.data)
+        if not payload or payload.action != CB_CUSTOM_DELETE:
+            return None
+    elif not callback.data.startswith(MUTATING_CALLBACK_PREFIXES):
+        return None
+    
+    return callback.message.chat.id, callback.message.message_id, callback.data
+
+def release_mutation(key: Optional[Tuple]):
+    """Нажатие обработано: ещё IDEMPOTENCY_CALLBACK_WINDOW секунд считаем его дублем"""
+    if key is not None:
+        inflight_mutations.discard(key)
+        recent_mutations.set(key, True)
+
+@dp.update.outer_middleware()
+async def idempotency_middleware(handler, event: types.Update, data: dict):
+    """Отбрасывает повторные апдейты и двойные нажатия до любого SQL"""
+    if seen_updates.get(event.update_id) is not None:
+        idempotency_stats['duplicate_updates'] += 1
+        return None
+    seen_updates.set(event.update_id, True)
+    
+    key = mutation_key(event)
+    if key is None:
+        return await handler(event, data)
+    
+    if key in inflight_mutations or recent_mutations.get(key) is not None:
+        idempotency_stats['duplicate_callbacks'] += 1
+        logger.info(f"♻️ Duplicate press dropped: {event.callback_query.data}")
+        try:
+            await event.callback_query.answer()
+        except Exception as e:
+            logger.error(f"Failed to answer duplicate callback: {e}")
+        return None
+    
+    inflight_mutations.add(key)
+    data['mutation_key'] = key
+    try:
+        return await handler(event, data)
+    finally:
+        # Отложенный в пул обработчик освобождает ключ сам, по завершении;
+        # отброшенное при перегрузке нажатие не выполнялось - повтор не дубль
+        if data.get('mutation_shed'):
+            inflight_mutations.discard(key)
+        elif not data.get('mutation_deferred'):
+            release_mutation(key)
+
+# ============================================
+# ПУЛ ОБРАБОТЧИКОВ
+# ============================================
+
+# Полосы приоритета: гость у двери важнее правок контента менеджером
+LANE_GUEST = 0
+LANE_MANAGER = 1
+LANE_BACKGROUND = 2
+LANE_NAMES = ('guest', 'manager', 'background')
+
+class UpdateScheduler:
+    """
+    Ограниченный пул воркеров между приёмом апдейтов и обработчиками.
+    
+    У каждого чата своя FIFO-очередь, и в работе одновременно не больше
+    одного апдейта чата - порядок сохраняется. Чат с ожидающими апдейтами
+    стоит в очереди готовности полосы своего ближайшего апдейта; воркеры
+    выбирают полосу по взвешенному кругу (lane_weights), пропуская пустые.
+    Сверх max_depth ожидающих апдейтов новые отбрасываются (load shedding),
+    фоновая полоса - уже с половины глубины.
+    """
+    
+    def __init__(self, workers: int, max_depth: int, lane_weights: Tuple[int, ...]):
+        # Лишний вес дал бы в цикле несуществующую полосу (IndexError в _next_chat)
+        if (len(lane_weights) != len(LANE_NAMES)
+                or any(weight < 0 for weight in lane_weights) or not any(lane_weights)):
+            raise ValueError(
+                f"HANDLER_LANE_WEIGHTS must be {len(LANE_NAMES)} non-negative weights "
+                f"({', '.join(LANE_NAMES)}) with a positive sum, got {lane_weights}"
+            )
+        
+        self.workers = workers
+        self.max_depth = max_depth
+        self._chats: Dict = {}
+        self._lanes = tuple(deque() for _ in LANE_NAMES)
+        self._ready_count = asyncio.Semaphore(0)
+        self._cycle = [lane for lane, weight in enumerate(lane_weights) for _ in range(weight)]
+        self._cycle_pos = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.depth = 0
+        self.active = 0
+        self.submitted = 0
+        self.failed = 0
+        self.lane_depth = [0] * len(LANE_NAMES)
+        self.lane_shed = [0] * len(LANE_NAMES)
+        self.wait_time = tuple(LatencyHistogram() for _ in LANE_NAMES)
+        self.run_time = LatencyHistogram()
+    
+    def start(self):
+        for _ in range(self.workers):
+            background_tasks.append(asyncio.create_task(self._run_worker()))
+    
+    def submit(self, chat_key, job: Callable, lane: int = LANE_MANAGER) -> bool:
+        """Поставить job в очередь чата; False - очередь переполнена"""
+        limit = self.max_depth // 2 if lane == LANE_BACKGROUND else self.max_depth
+        if self.depth >= limit:
+            self.lane_shed[lane] += 1
+            return False
+        
+        queue = self._chats.get(chat_key)
+        if queue is None:
+            queue = self._chats[chat_key] = deque()
+            self._make_ready(chat_key, lane)
+        
+        queue.append((time.monotonic(), lane, job))
+        self.depth += 1
+        self.lane_depth[lane] += 1
+        self.submitted += 1
+        self._idle.clear()
+        return True
+    
+    def _make_ready(self, chat_key, lane: int):
+        self._lanes[lane].append(chat_key)
+        self._ready_count.release()
+    
+    def _next_chat(self):
+        """Следующий чат по взвешенному кругу полос"""
+        for _ in range(len(self._cycle)):
+            lane = self._cycle[self._cycle_pos]
+            self._cycle_pos = (self._cycle_pos + 1) % len(self._cycle)
+            if self._lanes[lane]:
+                return self._lanes[lane].popleft()
+        
+        # Полосы с нулевым весом обслуживаются, только когда остальные пусты
+        for lane_queue in self._lanes:
+            if lane_queue:
+                return lane_queue.popleft()
+    
+    async def _run_worker(self):
+        while True:
+            await self._ready_count.acquire()
+            chat_key = self._next_chat()
+            queue = self._chats[chat_key]
+            enqueued_at, lane, job = queue.popleft()
+            self.depth -= 1
+            self.lane_depth[lane] -= 1
+            self.active += 1
+            
+            started_at = time.monotonic()
+            self.wait_time[lane].observe(started_at - enqueued_at)
+            try:
+                await job()
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ Update job failed: {e}")
+            finally:
+                self.run_time.observe(time.monotonic() - started_at)
+                self.active -= 1
+                
+                # Следующий апдейт чата - в конец очереди готовности своей полосы
+                if queue:
+                    self._make_ready(chat_key, queue[0][1])
+                else:
+                    del self._chats[chat_key]
+                
+                if not self.depth and not self.active:
+                    self._idle.set()
+    
+    def oldest_enqueued_at(self) -> Optional[float]:
+        """Когда встал в очередь самый давний ожидающий апдейт (None - очередь пуста)"""
+        return min((queue[0][0] for queue in self._chats.values() if queue), default=None)
+    
+    async def drain(self, timeout: float):
+        """Дождаться обработки уже принятых апдейтов"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ {self.depth} queued updates dropped on shutdown")
+    
+    def stats(self) -> Dict:
+        return {
+            'workers': self.workers,
+            'active': self.active,
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'chats_waiting': len(self._chats),
+            'submitted': self.submitted,
+            'shed': sum(self.lane_shed),
+            'failed': self.failed,
+            'lanes': {
+                name: {
+                    'depth': self.lane_depth[lane],
+                    'shed': self.lane_shed[lane],
+                    'wait': self.wait_time[lane].stats()
+                }
+                for lane, name in enumerate(LANE_NAMES)
+            },
+            'run': self.run_time.stats()
+        }
+
+update_scheduler = UpdateScheduler(HANDLER_WORKERS, HANDLER_QUEUE_DEPTH, HANDLER_LANE_WEIGHTS)
+
+# Ошибки отложенных обработчиков уходят в dp.errors так же, как при обычном вызове
+_scheduled_errors = ErrorsMiddleware(dp)
+
+# Префиксы callback_data гостевого режима
+GUEST_CALLBACK_PREFIXES = ("guest_",)
+
+def classify_update(event: types.Update, data: dict) -> int:
+    """Полоса апдейта по callback_data, payload /start и текущему FSM-состоянию"""
+    if event.callback_query:
+        callback_data = event.callback_query.data or ""
+        if callback_data.startswith(GUEST_CALLBACK_PREFIXES):
+            return LANE_GUEST
+        if callback_data.startswith(CALLBACK_CODEC_PREFIX):
+            payload = FieldCallback.unpack(callback_data)
+            if payload and payload.action == CB_GUEST_FIELD:
+                return LANE_GUEST
+        return LANE_MANAGER
+    
+    if event.message:
+        text = event.message.text or ""
+        if text.startswith("/start guest_"):
+            return LANE_GUEST
+        # Загрузка контента и длинные формы не должны тормозить интерактив
+        if data.get('raw_state') in BACKGROUND_STATES:
+            return LANE_BACKGROUND
+        return LANE_MANAGER
+    
+    return LANE_BACKGROUND
+
+def update_chat_key(event: types.Update):
+    """Ключ упорядочивания: чат апдейта, иначе пользователь, иначе сам апдейт"""
+    if event.message:
+        return event.message.chat.id
+    if event.callback_query:
+        if event.callback_query.message:
+            return event.callback_query.message.chat.id
+        return event.callback_query.from_user.id
+    if event.inline_query:
+        return event.inline_query.from_user.id
+    return ('update', event.update_id)
+
+@dp.update.outer_middleware()
+async def scheduling_middleware(handler, event: types.Update, data: dict):
+    """
+    Передаёт обработку апдейта (остальные middleware и хендлер) в пул
+    воркеров и сразу возвращается - приём апдейтов не ждёт БД.
+    """
+    if not HANDLER_WORKERS:
+        return await handler(event, data)
+    
+    async def job():
+        try:
+            # raw_state прочитан при приёме; предыдущий апдейт чата мог его сменить
+            if 'state' in data:
+                data['raw_state'] = await data['state'].get_state()
+            await _scheduled_errors(handler, event, data)
+        finally:
+            release_mutation(data.get('mutation_key'))
+    
+    lane = classify_update(event, data)
+    if update_scheduler.submit(update_chat_key(event), job, lane):
+        data['mutation_deferred'] = True
+    else:
+        data['mutation_shed'] = True
+        logger.warning(f"⚠️ Update {event.update_id} ({LANE_NAMES[lane]}) shed: queue depth {update_scheduler.depth}")
+        if event.callback_query:
+            try:
+                await event.callback_query.answer("⏳ Бот перегружен, нажмите ещё раз через пару секунд")
+            except Exception as e:
+                logger.error(f"Failed to answer shed callback: {e}")
+
+# ============================================
+# ИНСТРУМЕНТАЦИЯ ЗАПРОСОВ
+# ============================================
+
+class StatementStats:
+    """Агрегаты одного SQL-выражения: латентность, строки, ошибки"""
+    
+    __slots__ = ('sql', 'latency', 'rows', 'errors', 'slow')
+    
+    def __init__(self, sql: str):
+        self.sql = " ".join(sql.split())[:160]
+        self.latency = LatencyHistogram()
+        self.rows = 0
+        self.errors = 0
+        self.slow = 0
+    
+    def stats(self) -> Dict:
+        return {
+            'sql': self.sql,
+            **self.latency.stats(),
+            'total_ms': round(self.latency.total_ms, 2),
+            'rows': self.rows,
+            'errors': self.errors,
+            'slow': self.slow
+        }
+
+# Имя выражения -> агрегаты; имя = функция-вызывающий + хэш текста SQL
+statement_stats: Dict[str, StatementStats] = {}
+_statement_names: Dict[Tuple, str] = {}
+
+# Ожидание свободного соединения в пуле
+pool_wait = LatencyHistogram()
+
+def statement_name(code, query: str) -> str:
+    """Стабильное имя выражения: не меняется между запусками и при правках соседнего кода"""
+    key = (code, query)
+    name = _statement_names.get(key)
+    if name is None:
+        digest = hashlib.sha1(" ".join(query.split()).encode()).hexdigest()[:6]
+        name = _statement_names[key] = f"{code.co_name}.{digest}"
+    return name
+
+def args_shape(args: Tuple) -> str:
+    """Типы и длины аргументов запроса - значения (имена, телефоны гостей) в лог не пишем"""
+    parts = []
+    for arg in args:
+        shape = type(arg).__name__
+        if isinstance(arg, (str, bytes, list, tuple)):
+            shape += f"[{len(arg)}]"
+        parts.append(shape)
+    return "(" + ", ".join(parts) + ")"
+
+def status_rows(status: str) -> int:
+    """Число строк из статуса execute ("UPDATE 3", "INSERT 0 1")"""
+    tail = status.rsplit(" ", 1)[-1] if status else ""
+    return int(tail) if tail.isdigit() else 0
+
+class InstrumentedConnection:
+    """
+    Обёртка соединения: fetch*/execute замеряются по имени выражения и считаются
+    в контексте апдейта; остальное (transaction и т.п.) уходит в соединение как есть.
+    """
+    
+    __slots__ = ('_conn', '_ctx')
+    
+    def __init__(self, conn, ctx=None):
+        self._conn = conn
+        self._ctx = ctx
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+    
+    async def _run(self, code, method, count_rows, query: str, args: Tuple, kwargs: Dict):
+        name = statement_name(code, query)
+        stats = statement_stats.get(name)
+        if stats is None:
+            stats = statement_stats[name] = StatementStats(query)
+        if self._ctx is not None:
+            self._ctx.queries += 1
+        
+        with trace_span(f"db {name}") as span:
+            started_at = time.monotonic()
+            try:
+                result = await method(query, *args, **kwargs)
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                elapsed = time.monotonic() - started_at
+                stats.latency.observe(elapsed)
+            
+            rows = count_rows(result)
+            if span is not None:
+                span.attributes['db.rows'] = rows
+        
+        stats.rows += rows
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            stats.slow += 1
+            logger.warning(f"🐢 Slow query {name}: {elapsed * 1000:.0f} ms, args {args_shape(args)}")
+        return result
+    
+    async def fetch(self, query: str, *args, **kwargs):
+        return await self._run(sys._getframe(1).f_code, self._conn.fetch, len, query, args, kwargs)
+    
+    async def fetchrow(self, query: str, *args, **kwargs):
+        return await self._run(sys._getframe(1).f_code, self._conn.fetchrow,
+                               lambda row: int(row is not None), query, args, kwargs)
+    
+    async def fetchval(self, query: str, *args, **kwargs):
+        return await self._run(sys._getframe(1).f_code, self._conn.fetchval,
+                               lambda value: int(value is not None), query, args, kwargs)
+    
+    async def execute(self, query: str, *args, **kwargs):
+        return await self._run(sys._getframe(1).f_code, self._conn.execute, status_rows, query, args, kwargs)
+
+def query_stats() -> Dict:
+    """Агрегаты по выражениям, самые дорогие по суммарному времени - первыми"""
+    statements = sorted(statement_stats.items(), key=lambda item: item[1].latency.total_ms, reverse=True)
+    return {
+        'slow_query_ms': SLOW_QUERY_MS,
+        'pool': {
+            'size': db_pool.get_size() if db_pool else 0,
+            'idle': db_pool.get_idle_size() if db_pool else 0,
+            'acquire_wait': pool_wait.stats()
+        },
+        'statements': {name: stats.stats() for name, stats in statements}
+    }
+
+# ============================================
+# КОНТЕКСТ ЗАПРОСА К БД
+# ============================================
+
+class RequestContext:
+    """
+    Контекст БД одного апдейта: соединение из пула берётся при первом запросе
+    и держится до конца апдейта, одинаковые чтения мемоизируются.
+    На время вызовов Bot API свободное соединение возвращается в пул
+    (release_idle) и при следующем запросе берётся заново.
+    Соединение и мемо доступны только задаче, создавшей контекст: задачи,
+    запущенные из хендлера, работают с пулом как обычно.
+    """
+    
+    __slots__ = ('owner', 'conn', 'proxy', 'borrowers', 'acquired', 'memo', 'queries', 'memo_hits', 'closed')
+    
+    def __init__(self):
+        self.owner = asyncio.current_task()
+        self.conn = None
+        self.proxy = None
+        self.borrowers = 0
+        self.acquired = 0
+        self.memo: Dict[Tuple, Any] = {}
+        self.queries = 0
+        self.memo_hits = 0
+        self.closed = False
+    
+    def is_active(self) -> bool:
+        return not self.closed and asyncio.current_task() is self.owner
+    
+    async def connection(self) -> InstrumentedConnection:
+        if self.conn is None:
+            started_at = time.monotonic()
+            self.conn = await db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+            pool_wait.observe(time.monotonic() - started_at)
+            self.proxy = InstrumentedConnection(self.conn, self)
+            self.acquired += 1
+        return self.proxy
+    
+    async def release_idle(self):
+        """Вернуть соединение в пул, если оно сейчас не занято блоком db_acquire и транзакцией"""
+        if self.conn is not None and not self.borrowers and not self.conn.is_in_transaction():
+            conn, self.conn, self.proxy = self.conn, None, None
+            await db_pool.release(conn)
+    
+    async def close(self):
+        self.closed = True
+        if self.conn is not None:
+            conn, self.conn, self.proxy = self.conn, None, None
+            await db_pool.release(conn)
+
+_request_context: ContextVar[Optional[RequestContext]] = ContextVar('request_context', default=None)
+
+# Задача, обрабатывающая апдейт (воркер пула или цикл polling)
+_update_task: ContextVar[Optional[asyncio.Task]] = ContextVar('update_task', default=None)
+
+# Верхние границы корзин "запросов на апдейт"
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25)
+
+request_context_stats = {
+    'updates': 0,
+    'connections': 0,
+    'queries': 0,
+    'memo_hits': 0,
+    'max_queries': 0,
+    'heavy_updates': 0,
+    'queries_per_update': {f"<={bound}": 0 for bound in QUERY_COUNT_BUCKETS} | {'more': 0}
+}
+
+def in_update_handler() -> bool:
+    """Код выполняется в задаче обработки апдейта, а не в запущенной из неё или фоновой"""
+    task = _update_task.get()
+    return task is not None and task is asyncio.current_task()
+
+def active_request_context() -> Optional[RequestContext]:
+    """Контекст текущего апдейта, если код выполняется в его задаче"""
+    ctx = _request_context.get()
+    return ctx if ctx is not None and ctx.is_active() else None
+
+# Область данных - (сущность, id), например ('apartment', 42); (сущность, None) - все
+# записи сущности (списки, агрегаты). Запись в область отцепляет чтения в полёте с этой
+# областью, со всей сущностью и чтения без областей; запись без областей - все чтения.
+Scope = Tuple[str, Any]
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных чтений: первый вызов по ключу идёт в БД,
+    остальные ждут его результат. Чтение выполняет сам первый вызов (без отдельной
+    задачи); если его отменили, ожидающие повторяют чтение сами.
+    Чтение, отцепленное записью (invalidate), дорабатывает для своих ожидающих,
+    а новые вызовы идут в БД заново.
+    """
+    
+    def __init__(self):
+        self._flights: Dict[Tuple, asyncio.Future] = {}
+        self._scopes: Dict[Tuple, Tuple[Scope, ...]] = {}
+        self._by_scope: Dict[Scope, set] = {}
+        self._unscoped: set = set()
+        self.leaders = 0
+        self.coalesced = 0
+        self.detached = 0
+    
+    async def do(self, key: Tuple, loader: Callable, scopes: Tuple[Scope, ...] = ()):
+        future = self._flights.get(key)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling() or not future.cancelled():
+                    raise
+                return await self.do(key, loader, scopes)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._attach(key, future, scopes)
+        self.leaders += 1
+        try:
+            value = await loader()
+        except Exception as e:
+            future.set_exception(e)
+            # Ожидающих может не быть - не даём asyncio ругаться на непрочитанную ошибку
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            if self._flights.get(key) is future:
+                self._detach(key)
+    
+    def _attach(self, key: Tuple, future: asyncio.Future, scopes: Tuple[Scope, ...]):
+        scopes = tuple(dict.fromkeys(scopes))
+        self._flights[key] = future
+        self._scopes[key] = scopes
+        if not scopes:
+            self._unscoped.add(key)
+        for scope in scopes:
+            self._by_scope.setdefault(scope, set()).add(key)
+    
+    def _detach(self, key: Tuple):
+        del self._flights[key]
+        self._unscoped.discard(key)
+        for scope in self._scopes.pop(key):
+            keys = self._by_scope[scope]
+            keys.discard(key)
+            if not keys:
+                del self._by_scope[scope]
+    
+    def invalidate(self, scopes: Tuple[Scope, ...] = ()):
+        """Запись в области scopes (пусто - во все): затронутые чтения не раздаём новым вызовам"""
+        if not scopes:
+            stale = set(self._flights)
+        else:
+            stale = set(self._unscoped)
+            for entity, entity_id in scopes:
+                if entity_id is None:
+                    for scope, keys in self._by_scope.items():
+                        if scope[0] == entity:
+                            stale |= keys
+                else:
+                    stale |= self._by_scope.get((entity, entity_id), set())
+                    stale |= self._by_scope.get((entity, None), set())
+        
+        for key in stale:
+            self._detach(key)
+        self.detached += len(stale)
+    
+    def stats(self) -> Dict:
+        return {
+            'in_flight': len(self._flights),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'detached': self.detached
+        }
+
+read_flights = SingleFlight()
+
+def note_db_write(*scopes: Scope):
+    """Данные в областях scopes (без аргументов - любые) изменились или вот-вот изменятся"""
+    read_flights.invalidate(scopes)
+    ctx = active_request_context()
+    if ctx is not None:
+        ctx.memo.clear()
+
+@asynccontextmanager
+async def db_acquire(*scopes: Scope, write: bool = False):
+    """
+    Соединение для DB-функций: общее соединение апдейта или отдельное из пула.
+    Функции, которые пишут, передают области записи (или write=True, если область
+    не определить): до и после записи мемо апдейта сбрасывается, а затронутые
+    чтения в полёте больше не раздаются новым вызовам. Чтения ничего не сбрасывают.
+    """
+    write = write or bool(scopes)
+    if write:
+        note_db_write(*scopes)
+    
+    try:
+        ctx = active_request_context()
+        if ctx is None:
+            started_at = time.monotonic()
+            async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+                pool_wait.observe(time.monotonic() - started_at)
+                yield InstrumentedConnection(conn)
+            return
+    
+        conn = await ctx.connection()
+        ctx.borrowers += 1
+        try:
+            yield conn
+        finally:
+            ctx.borrowers -= 1
+    finally:
+        # Чтение, начатое во время записи, могло не увидеть её результат
+        if write:
+            note_db_write(*scopes)
+
+async def read_through(key: Tuple, loader: Callable, scopes: Tuple[Scope, ...] = ()):
+    """Чтение из БД без записи, одинаковые одновременные чтения объединяются"""
+    if not DB_SINGLE_FLIGHT:
+        return await loader()
+    return await read_flights.do(key, loader, scopes)
+    
+async def request_memo(key: Tuple, loader: Callable, scopes: Tuple[Scope, ...] = ()):
+    """Первое чтение по ключу идёт в БД, повторные в том же апдейте - из мемо"""
+    ctx = active_request_context()
+    if ctx is None:
+        return await read_through(key, loader, scopes)
+    
+    if key in ctx.memo:
+        ctx.memo_hits += 1
+        return ctx.memo[key]
+    
+    value = await read_through(key, loader, scopes)
+    ctx.memo[key] = value
+    return value
+
+async def request_load_many(name: str, ids: List, batch_loader: Callable,
+                            entity: Optional[str] = None) -> Dict:
+    """
+    Чтение по списку id одним запросом: batch_loader(missing_ids) -> {id: value}.
+    Уже прочитанные в апдейте id (в т.ч. через request_cached-функцию name) не запрашиваются.
+    entity - сущность, которой принадлежат id (область чтения).
+    """
+    ctx = active_request_context()
+    memo = ctx.memo if ctx is not None else {}
+    
+    missing = [item_id for item_id in dict.fromkeys(ids) if (name, (item_id,)) not in memo]
+    if ctx is not None:
+        ctx.memo_hits += len(set(ids)) - len(missing)
+    
+    if missing:
+        key = (batch_loader.__name__, tuple(missing))
+        scopes = tuple((entity, item_id) for item_id in missing) if entity else ()
+        loaded = await read_through(key, lambda: batch_loader(missing), scopes)
+        for item_id in missing:
+            memo[(name, (item_id,))] = loaded.get(item_id)
+    
+    return {item_id: memo[(name, (item_id,))] for item_id in ids}
+
+def request_prime(name: str, args: Tuple, value):
+    """Положить в мемо результат, уже полученный другим запросом"""
+    ctx = active_request_context()
+    if ctx is not None:
+        ctx.memo.setdefault((name, args), value)
+
+def request_cached(func: Callable = None, *, entity: Optional[str] = None, related: Tuple[str, ...] = ()):
+    """
+    Чтение из БД, мемоизируемое в пределах апдейта по (функция, аргументы);
+    одновременные вызовы с теми же аргументами из разных апдейтов - один запрос.
+    Области чтения: (entity, первый аргумент) и все записи сущностей related.
+    Без областей чтение считается зависящим от любой записи.
+    """
+    if func is None:
+        return functools.partial(request_cached, entity=entity, related=related)
+    
+    @functools.wraps(func)
+    async def wrapper(*args):
+        scopes = ((entity, args[0]),) if entity else ()
+        scopes += tuple((name, None) for name in related)
+        return await request_memo((func.__name__, args), lambda: func(*args), scopes)
+    return wrapper
+
+def record_request_context(ctx: RequestContext, event: types.Update):
+    """Счётчики запросов апдейта"""
+    stats = request_context_stats
+    stats['updates'] += 1
+    stats['queries'] += ctx.queries
+    stats['memo_hits'] += ctx.memo_hits
+    stats['max_queries'] = max(stats['max_queries'], ctx.queries)
+    
+    index = bisect.bisect_left(QUERY_COUNT_BUCKETS, ctx.queries)
+    bucket = f"<={QUERY_COUNT_BUCKETS[index]}" if index < len(QUERY_COUNT_BUCKETS) else 'more'
+    stats['queries_per_update'][bucket] += 1
+    
+    if ctx.queries > DB_QUERIES_WARN:
+        stats['heavy_updates'] += 1
+        if event.callback_query:
+            source = f"callback {event.callback_query.data}"
+        elif event.message:
+            source = f"message {(event.message.text or '<media>')[:32]!r}"
+        else:
+            source = f"update {event.update_id}"
+        logger.warning(f"🐢 {ctx.queries} DB queries for one update ({source})")
+
+@dp.update.outer_middleware()
+async def request_context_middleware(handler, event: types.Update, data: dict):
+    """Открывает контекст БД на время обработки апдейта (внутри воркера пула)"""
+    task_token = _update_task.set(asyncio.current_task())
+    try:
+        if not DB_REQUEST_CONTEXT or db_pool is None:
+            return await handler(event, data)
+        
+        ctx = RequestContext()
+        token = _request_context.set(ctx)
+        try:
+            return await handler(event, data)
+        finally:
+            _request_context.reset(token)
+            request_context_stats['connections'] += ctx.acquired
+            await ctx.close()
+            record_request_context(ctx, event)
+    finally:
+        _update_task.reset(task_token)
+
+@bot.session.middleware()
+async def release_request_connection(make_request, bot: Bot, method):
+    """
+    Вызов Bot API (с ожиданием темпа и 429) идёт без соединения с БД:
+    иначе медленный Telegram держит соединения пула. Регистрируется первым.
+    """
+    ctx = active_request_context()
+    if ctx is not None:
+        await ctx.release_idle()
+    return await make_request(bot, method)
+
+# ============================================
+# ТРАССИРОВКА
+# ============================================
+
+# Трассировка включена, если что-то сохраняется: случайная доля или медленные
+TRACING_ENABLED = TRACE_SAMPLE_RATE > 0 or TRACE_SLOW_MS > 0
+
+class Trace:
+    """Спаны одного апдейта; sampled - сохраняется независимо от длительности"""
+    
+    __slots__ = ('trace_id', 'sampled', 'spans', 'finished')
+    
+    def __init__(self, sampled: bool):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.sampled = sampled
+        self.spans: List['Span'] = []
+        self.finished = False
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'start_ns', 'end_ns', 'attributes', 'error')
+    
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: Dict):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+    
+    def finish(self):
+        self.end_ns = time.time_ns()
+        # Задачи, запущенные из хендлера, могут пережить апдейт - их спаны не пишем
+        if not self.trace.finished:
+            self.trace.spans.append(self)
+    
+    def to_dict(self) -> Dict:
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+_current_span: ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+
+# Завершённые трассы ждут экспорта; при переполнении новые отбрасываются
+trace_queue: asyncio.Queue = asyncio.Queue(maxsize=TRACE_QUEUE_SIZE)
+
+trace_stats = {
+    'started': 0,
+    'exported': 0,
+    'dropped': 0,
+    'export_errors': 0
+}
+
+@contextmanager
+def trace_span(name: str, **attributes):
+    """Дочерний спан текущего; вне трассы - ничего не делает (None)"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    
+    span = Span(parent.trace, name, parent.span_id, attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        span.finish()
+
+@dp.update.outer_middleware()
+async def tracing_middleware(handler, event: types.Update, data: dict):
+    """Корневой спан апдейта: middleware, SQL и Bot API внутри - дочерние спаны"""
+    if not TRACING_ENABLED:
+        return await handler(event, data)
+    
+    trace = Trace(sampled=random.random() < TRACE_SAMPLE_RATE)
+    root = Span(trace, f"update {handler_label(event, data)}", None, {
+        'update_id': event.update_id,
+        'update_type': update_kind(event)
+    })
+    trace_stats['started'] += 1
+    
+    token = _current_span.set(root)
+    try:
+        return await handler(event, data)
+    except BaseException as e:
+        root.error = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        root.finish()
+        trace.finished = True
+        
+        slow = TRACE_SLOW_MS > 0 and (root.end_ns - root.start_ns) / 1e6 >= TRACE_SLOW_MS
+        if trace.sampled or slow:
+            try:
+                trace_queue.put_nowait(trace)
+            except asyncio.QueueFull:
+                trace_stats['dropped'] += 1
+
+def _otlp_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def otlp_payload(traces: List[Trace]) -> Dict:
+    """Трассы в формате OTLP/HTTP JSON (ExportTraceServiceRequest)"""
+    spans = []
+    for trace in traces:
+        for span in trace.spans:
+            otlp_span = {
+                'traceId': trace.trace_id,
+                'spanId': span.span_id,
+                'name': span.name,
+                'kind': 1 if span.parent_id else 2,  # INTERNAL / SERVER
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(span.end_ns),
+                'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in span.attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.error else {'code': 0}
+            }
+            if span.parent_id:
+                otlp_span['parentSpanId'] = span.parent_id
+            spans.append(otlp_span)
+    
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'arenda-bot'}}]},
+        'scopeSpans': [{'scope': {'name': 'bot_strapi'}, 'spans': spans}]
+    }]}
+
+def write_trace_file(traces: List[Trace]):
+    with open(TRACE_FILE, "a", encoding="utf-8") as trace_file:
+        for trace in traces:
+            for span in trace.spans:
+                trace_file.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+async def export_traces(traces: List[Trace], session: Optional[ClientSession]):
+    try:
+        if session is not None:
+            async with session.post(TRACE_OTLP_URL, json=otlp_payload(traces)) as response:
+                if response.status >= 300:
+                    raise RuntimeError(f"OTLP sink answered {response.status}")
+        else:
+            await asyncio.to_thread(write_trace_file, traces)
+        trace_stats['exported'] += len(traces)
+    except Exception as e:
+        trace_stats['export_errors'] += 1
+        logger.warning(f"⚠️ Trace export failed ({len(traces)} traces): {e}")
+
+async def run_trace_exporter():
+    """Выгружает трассы пачками: до 64 за раз, не реже раза в 2 секунды"""
+    session = ClientSession(timeout=ClientTimeout(total=10)) if TRACE_OTLP_URL else None
+    batch: List[Trace] = []
+    try:
+        while True:
+            try:
+                batch.append(await asyncio.wait_for(trace_queue.get(), 2))
+            except asyncio.TimeoutError:
+                pass
+            while len(batch) < 64 and not trace_queue.empty():
+                batch.append(trace_queue.get_nowait())
+            if batch:
+                await export_traces(batch, session)
+                batch = []
+    finally:
+        # При выключении дописываем накопленное
+        while not trace_queue.empty():
+            batch.append(trace_queue.get_nowait())
+        if batch:
+            await export_traces(batch, session)
+        if session is not None:
+            await session.close()
+
 # ============================================
 # MIDDLEWARE
 # ============================================
@@ -192,6 +1682,7 @@ async def auto_register_manager_middleware(handler, event: types.Update, data: d
     """
     Автоматически регистрирует менеджера в БД при взаимодействии с ботом.
     В Strapi БД нет таблицы users - работаем только с managers.
+    Уже известные telegram_id берутся из known_managers без запроса к БД.
     """
     user = None
     
@@ -202,32 +1693,322 @@ async def auto_register_manager_middleware(handler, event: types.Update, data: d
     elif event.inline_query:
         user = event.inline_query.from_user
     
-    if user and db_pool:
-        try:
+    with trace_span("middleware auto_register_manager"):
+        if user and db_pool:
             telegram_id_str = str(user.id)
             
-            async with db_pool.acquire() as conn:
-                # Проверяем существует ли менеджер
-                exists = await conn.fetchval(
-                    'SELECT 1 FROM managers WHERE telegram_id = $1',
-                    telegram_id_str
-                )
-                
-                if not exists:
-                    # Создаём менеджера без организации
-                    await conn.execute('''
-                        INSERT INTO managers (
-                            telegram_id, name, lastname, 
-                            created_at, updated_at, published_at
-                        )
-                        VALUES ($1, $2, $3, NOW(), NOW(), NOW())
-                    ''', telegram_id_str, user.first_name or 'User', user.username or '')
+            if known_managers.get(telegram_id_str) is None:
+                try:
+                    async with db_acquire(('manager', user.id)) as conn:
+                        # Один запрос: создаём менеджера без организации, если его нет.
+                        # В Strapi нет уникального индекса на telegram_id, поэтому
+                        # ON CONFLICT подстрахован проверкой NOT EXISTS.
+                        await conn.execute('''
+                            INSERT INTO managers (
+                                telegram_id, name, lastname, 
+                                created_at, updated_at, published_at
+                            )
+                            SELECT $1, $2, $3, NOW(), NOW(), NOW()
+                            WHERE NOT EXISTS (
+                                SELECT 1 FROM managers WHERE telegram_id = $1
+                            )
+                            ON CONFLICT DO NOTHING
+                        ''', telegram_id_str, user.first_name or 'User', user.username or '')
                     
-        except Exception as e:
-            logger.error(f"⚠️ Error auto-registering manager {user.id}: {e}")
+                    known_managers.set(telegram_id_str, True)
+                
+                except Exception as e:
+                    logger.error(f"⚠️ Error auto-registering manager {user.id}: {e}")
     
     return await handler(event, data)
 
+# ============================================
+# ИСХОДЯЩИЕ ВЫЗОВЫ BOT API
+# ============================================
+
+class TokenBucket:
+    """Корзина токенов: rate в секунду, до capacity подряд; pause - запрет до срока (429)"""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at', 'paused_until')
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+    
+    def take(self) -> float:
+        """Взять токен: 0 - взят, иначе сколько секунд ждать до следующей попытки"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+    
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+global_send_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_BURST) if TG_GLOBAL_RATE > 0 else None
+
+# Корзины чатов; простаивающие вытесняются - полная корзина равна отсутствующей
+chat_send_buckets = TTLCache(10000, max(TG_CHAT_BURST / TG_CHAT_RATE if TG_CHAT_RATE > 0 else 0, TG_MAX_RETRY_AFTER, 60))
+
+throttle_stats = {
+    'throttled_global': 0,
+    'throttled_chat': 0,
+    'retry_after': 0,
+    'retry_exhausted': 0,
+    'pause_rejected': 0
+}
+throttle_wait = LatencyHistogram()
+
+def chat_send_bucket(chat_id) -> Optional[TokenBucket]:
+    if TG_CHAT_RATE <= 0:
+        return None
+    bucket = chat_send_buckets.get(chat_id)
+    if bucket is None:
+        bucket = TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+    # set продлевает TTL: активный чат не теряет паузу и остаток токенов
+    chat_send_buckets.set(chat_id, bucket)
+    return bucket
+
+async def wait_send_slot(chat_id, method, max_wait: float):
+    """
+    Ждать токен чата и общий токен; очередь превращает всплеск в задержку.
+    Ожидание дольше max_wait (чат на паузе после 429) не начинаем - TelegramRetryAfter сразу.
+    """
+    chat_bucket = chat_send_bucket(chat_id)
+    started_at = time.monotonic()
+    throttled = set()
+    
+    while True:
+        wait = chat_bucket.take() if chat_bucket else 0.0
+        scope = 'chat'
+        if not wait and global_send_bucket is not None:
+            wait = global_send_bucket.take()
+            scope = 'global'
+            if wait and chat_bucket:
+                chat_bucket.refund()
+        if not wait:
+            break
+        if wait > max_wait:
+            throttle_stats['pause_rejected'] += 1
+            raise TelegramRetryAfter(
+                method=method,
+                message=f"Chat {chat_id} is paused by flood control",
+                retry_after=int(wait) + 1
+            )
+        
+        if scope not in throttled:
+            throttled.add(scope)
+            throttle_stats[f'throttled_{scope}'] += 1
+        await asyncio.sleep(wait)
+    
+    if throttled:
+        throttle_wait.observe(time.monotonic() - started_at)
+
+@bot.session.middleware()
+async def rate_limit_middleware(make_request, bot: Bot, method):
+    """
+    Темп и повторы для методов с chat_id (отправка, редактирование, медиа).
+    answerCallbackQuery и служебные методы идут без ожидания.
+    Из обработчика апдейта долгий 429 не пережидаем - отдаём ошибку сразу;
+    долгие ожидания - дело фоновых отправителей (рассылки).
+    """
+    chat_id = getattr(method, 'chat_id', None)
+    if chat_id is None:
+        return await make_request(bot, method)
+    
+    max_retry_after = TG_MAX_INLINE_RETRY_AFTER if in_update_handler() else TG_MAX_RETRY_AFTER
+    attempt = 0
+    while True:
+        await wait_send_slot(chat_id, method, max_retry_after)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            attempt += 1
+            throttle_stats['retry_after'] += 1
+            if attempt > TG_MAX_RETRIES or e.retry_after > max_retry_after:
+                throttle_stats['retry_exhausted'] += 1
+                raise
+            
+            logger.warning(f"⏳ Flood control on {method.__api_method__} for chat {chat_id}: retry in {e.retry_after}s")
+            # Пауза на корзине чата - остальные вызовы в этот чат тоже ждут
+            bucket = chat_send_bucket(chat_id)
+            if bucket is not None:
+                bucket.pause(e.retry_after)
+            else:
+                await asyncio.sleep(e.retry_after)
+
+# ============================================
+# МЕТРИКИ PROMETHEUS
+# ============================================
+
+# Команды, которые идут в метки как есть; остальные - "/other"
+METRIC_COMMANDS = frozenset({"/start", "/menu", "/home", "/company", "/apartments", "/broadcast"})
+
+# Метка -> гистограмма; метки ограничены маршрутами, командами и состояниями FSM
+handler_latency: Dict[Tuple[str, str], LatencyHistogram] = {}
+telegram_api_latency: Dict[str, LatencyHistogram] = {}
+updates_total: Dict[str, int] = {}
+handler_errors_total: Dict[str, int] = {}
+telegram_api_errors_total: Dict[str, int] = {}
+
+# Время (monotonic) завершения обработки последнего апдейта (до первого - старта) - для /ready
+update_progress = {'last_processed_at': time.monotonic()}
+
+def update_kind(event: types.Update) -> str:
+    try:
+        return event.event_type
+    except Exception:
+        return "unknown"
+
+def handler_label(event: types.Update, data: dict) -> str:
+    """Метка обработчика: маршрут callback, команда или состояние FSM"""
+    if event.callback_query:
+        return callback_router.route_label(event.callback_query.data or "")
+    
+    if event.message:
+        text = event.message.text or ""
+        if text.startswith("/"):
+            command = text.split()[0].split("@")[0]
+            return command if command in METRIC_COMMANDS else "/other"
+        return data.get('raw_state') or "message"
+    
+    return update_kind(event)
+
+@dp.update.outer_middleware()
+async def metrics_middleware(handler, event: types.Update, data: dict):
+    """Длительность обработки апдейта (без ожидания в очереди пула)"""
+    kind = update_kind(event)
+    updates_total[kind] = updates_total.get(kind, 0) + 1
+    
+    key = (kind, handler_label(event, data))
+    histogram = handler_latency.get(key)
+    if histogram is None:
+        histogram = handler_latency[key] = LatencyHistogram()
+    
+    task = asyncio.current_task()
+    if profiler.active:
+        profiler.active_handlers[task] = key[1]
+    
+    started_at = time.monotonic()
+    try:
+        with trace_span(f"handler {key[1]}"):
+            return await handler(event, data)
+    finally:
+        finished_at = time.monotonic()
+        histogram.observe(finished_at - started_at)
+        update_progress['last_processed_at'] = finished_at
+        profiler.active_handlers.pop(task, None)
+
+@bot.session.middleware()
+async def telegram_api_metrics(make_request, bot: Bot, method):
+    """Латентность и ошибки вызовов Bot API по методу"""
+    name = method.__api_method__
+    histogram = telegram_api_latency.get(name)
+    if histogram is None:
+        histogram = telegram_api_latency[name] = LatencyHistogram()
+    
+    started_at = time.monotonic()
+    try:
+        with trace_span(f"telegram {name}"):
+            return await make_request(bot, method)
+    except Exception:
+        telegram_api_errors_total[name] = telegram_api_errors_total.get(name, 0) + 1
+        raise
+    finally:
+        histogram.observe(time.monotonic() - started_at)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _metric_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels.items()) + "}"
+
+def render_histograms(lines: List[str], name: str, help_text: str,
+                      series: List[Tuple[Dict[str, str], LatencyHistogram]]):
+    """Гистограммы LatencyHistogram (мс) в формате Prometheus (секунды, накопительные корзины)"""
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in series:
+        cumulative = 0
+        for bound, bucket_count in zip(LatencyHistogram.BUCKETS_MS, histogram.counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_metric_labels({**labels, 'le': bound / 1000})} {cumulative}")
+        lines.append(f"{name}_bucket{_metric_labels({**labels, 'le': '+Inf'})} {histogram.count}")
+        lines.append(f"{name}_sum{_metric_labels(labels)} {histogram.total_ms / 1000}")
+        lines.append(f"{name}_count{_metric_labels(labels)} {histogram.count}")
+
+def render_samples(lines: List[str], name: str, metric_type: str, help_text: str,
+                   series: List[Tuple[Dict[str, str], float]]):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+    for labels, value in series:
+        lines.append(f"{name}{_metric_labels(labels)} {value}")
+
+def render_metrics() -> str:
+    """Текст для /metrics (Prometheus exposition format 0.0.4)"""
+    lines = []
+    
+    render_samples(lines, "bot_updates_total", "counter", "Processed updates by type",
+                   [({'type': kind}, count) for kind, count in updates_total.items()])
+    render_histograms(lines, "bot_handler_duration_seconds", "Update handling time by route",
+                      [({'type': kind, 'handler': label}, histogram)
+                       for (kind, label), histogram in handler_latency.items()])
+    render_samples(lines, "bot_handler_errors_total", "counter", "Errors reaching global_error_handler",
+                   [({'exception': name}, count) for name, count in handler_errors_total.items()])
+    render_samples(lines, "bot_updates_dropped_total", "counter", "Updates dropped before handling",
+                   [({'reason': 'duplicate_update'}, idempotency_stats['duplicate_updates']),
+                    ({'reason': 'duplicate_callback'}, idempotency_stats['duplicate_callbacks'])]
+                   + [({'reason': f'shed_{name}'}, update_scheduler.lane_shed[lane])
+                      for lane, name in enumerate(LANE_NAMES)])
+    render_samples(lines, "bot_handler_queue_depth", "gauge", "Updates waiting in the handler pool",
+                   [({'lane': name}, update_scheduler.lane_depth[lane]) for lane, name in enumerate(LANE_NAMES)])
+    render_histograms(lines, "bot_handler_queue_wait_seconds", "Wait in the handler pool by lane",
+                      [({'lane': name}, update_scheduler.wait_time[lane]) for lane, name in enumerate(LANE_NAMES)])
+    
+    render_samples(lines, "bot_event_loop_lag_seconds", "gauge", "Last measured event loop lag",
+                   [({}, loop_lag_monitor.last_lag)])
+    render_histograms(lines, "bot_event_loop_lag_distribution_seconds", "Event loop lag samples",
+                      [({}, loop_lag_monitor.histogram)])
+    
+    render_histograms(lines, "bot_telegram_api_duration_seconds", "Bot API call time by method",
+                      [({'method': name}, histogram) for name, histogram in telegram_api_latency.items()])
+    render_samples(lines, "bot_telegram_throttled_total", "counter", "Bot API calls delayed by pacing or flood control",
+                   [({'reason': 'global'}, throttle_stats['throttled_global']),
+                    ({'reason': 'chat'}, throttle_stats['throttled_chat']),
+                    ({'reason': 'retry_after'}, throttle_stats['retry_after']),
+                    ({'reason': 'retry_exhausted'}, throttle_stats['retry_exhausted'])])
+    render_histograms(lines, "bot_telegram_throttle_wait_seconds", "Wait for a send slot (throttled calls only)",
+                      [({}, throttle_wait)])
+    render_samples(lines, "bot_telegram_api_errors_total", "counter", "Failed Bot API calls by method",
+                   [({'method': name}, count) for name, count in telegram_api_errors_total.items()])
+    
+    size = db_pool.get_size() if db_pool else 0
+    idle = db_pool.get_idle_size() if db_pool else 0
+    render_samples(lines, "bot_db_pool_connections", "gauge", "asyncpg pool connections",
+                   [({'state': 'total'}, size), ({'state': 'idle'}, idle), ({'state': 'in_use'}, size - idle)])
+    render_samples(lines, "bot_db_pool_max_connections", "gauge", "asyncpg pool max size",
+                   [({}, db_pool.get_max_size() if db_pool else 0)])
+    render_histograms(lines, "bot_db_pool_acquire_seconds", "Wait for a pool connection",
+                      [({}, pool_wait)])
+    render_histograms(lines, "bot_db_query_duration_seconds", "Query time by statement",
+                      [({'statement': name}, stats.latency) for name, stats in statement_stats.items()])
+    
+    return "\n".join(lines) + "\n"
+
 # ============================================
 # ERROR HANDLERS
 # ============================================
@@ -235,6 +2016,9 @@ async def auto_register_manager_middleware(handler, event: types.Update, data: d
 @dp.error()
 async def global_error_handler(event: types.ErrorEvent):
     """Глобальный обработчик ошибок"""
+    error_name = type(event.exception).__name__
+    handler_errors_total[error_name] = handler_errors_total.get(error_name, 0) + 1
+    
     logger.error(
         f"❌ Critical error during update {event.update.update_id} processing:\n"
         f"Exception: {event.exception}\n"
@@ -250,36 +2034,325 @@ async def global_error_handler(event: types.ErrorEvent):
         except Exception as e:
             logger.error(f"Failed to answer callback query: {e}")
     
-    elif event.update.message:
-        try:
-            await event.update.message.answer(
-                "⚠️ Произошла ошибка. Используйте /start",
-                reply_markup=get_main_menu_keyboard()
-            )
-        except Exception as e:
-            logger.error(f"Failed to send error message: {e}")
+    elif event.update.message:
+        try:
+            await event.update.message.answer(
+                "⚠️ Произошла ошибка. Используйте /start",
+                reply_markup=get_main_menu_keyboard()
+            )
+        except Exception as e:
+            logger.error(f"Failed to send error message: {e}")
+    
+    return True
+
+# ============================================
+# HELPER FUNCTIONS
+# ============================================
+
+async def clear_state_keep_company(state: FSMContext):
+    """Очищает state, но сохраняет current_organization_id"""
+    data = await state.get_data()
+    org_id = data.get('current_organization_id')
+    await state.clear()
+    if org_id:
+        await state.update_data(current_organization_id=org_id)
+
+def generate_hash() -> str:
+    """Генерирует уникальный hash для organization или booking"""
+    return hashlib.md5(secrets.token_bytes(32)).hexdigest()[:16]
+
+def field_token(info_id: int) -> str:
+    """Короткий токен поля для callback_data - ссылается прямо на info.id"""
+    return f"i{info_id}"
+
+def telegram_id_to_str(telegram_id: int) -> str:
+    """Конвертирует Telegram ID в строку для БД"""
+    return str(telegram_id)
+
+# ============================================
+# CALLBACK-КОДЕК И МАРШРУТИЗАЦИЯ
+# ============================================
+
+# Кнопки полей: "~" + base64url(версия, действие, раздел, varint apt_id, varint ссылка на поле).
+# Ключи полей с "_" и кириллицей больше не попадают в callback_data, и кнопка всегда
+# укладывается в 64 байта без обрезки и md5.
+CALLBACK_CODEC_PREFIX = "~"
+CALLBACK_CODEC_VERSION = 1
+
+# Индексы уже лежат в отправленных кнопках: новые значения только в конец
+CALLBACK_SECTIONS = ('checkin', 'rent', 'experiences', 'checkout', 'help', 'stores')
+CALLBACK_STATIC_FIELDS = tuple(FIELD_TO_CATEGORY_MAP)
+
+# Старые сокращения разделов в callback_data
+SECTION_ALIASES = {'exp': 'experiences'}
+
+# Коды действий (байт в callback_data - не переиспользовать)
+CB_FIELD_EDIT = 1
+CB_CUSTOM_VIEW = 2
+CB_CUSTOM_DELETE = 3
+CB_PREVIEW_FIELD = 4
+CB_GUEST_FIELD = 5
+
+def normalize_section(section: str) -> str:
+    """Приводит старые сокращения раздела к ключу из SECTION_TO_CATEGORY_MAP"""
+    return SECTION_ALIASES.get(section, section)
+
+def _pack_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _unpack_varint(raw: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = raw[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+class FieldCallback:
+    """
+    Типизированная callback_data кнопки поля.
+    Поле задаётся либо статическим ключом (индекс в CALLBACK_STATIC_FIELDS),
+    либо id записи infos - младший бит ссылки различает эти варианты.
+    """
+    
+    __slots__ = ('action', 'apt_id', 'section', 'field_key', 'info_id')
+    
+    def __init__(self, action: int, apt_id: int, section: str,
+                 field_key: str = None, info_id: int = None):
+        self.action = action
+        self.apt_id = apt_id
+        self.section = normalize_section(section)
+        self.field_key = field_key
+        self.info_id = info_id
+    
+    def pack(self) -> str:
+        raw = bytearray((CALLBACK_CODEC_VERSION, self.action, CALLBACK_SECTIONS.index(self.section)))
+        _pack_varint(self.apt_id, raw)
+        
+        if self.info_id is not None:
+            _pack_varint(self.info_id << 1, raw)
+        else:
+            _pack_varint((CALLBACK_STATIC_FIELDS.index(self.field_key) << 1) | 1, raw)
+        
+        return CALLBACK_CODEC_PREFIX + base64.urlsafe_b64encode(bytes(raw)).decode().rstrip("=")
+    
+    @classmethod
+    def unpack(cls, data: str) -> Optional['FieldCallback']:
+        """Разбор callback_data; None - чужой формат, другая версия или битые данные"""
+        if not data.startswith(CALLBACK_CODEC_PREFIX):
+            return None
+        
+        encoded = data[len(CALLBACK_CODEC_PREFIX):]
+        try:
+            raw = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+            if len(raw) < 5 or raw[0] != CALLBACK_CODEC_VERSION:
+                return None
+            
+            action = raw[1]
+            section = CALLBACK_SECTIONS[raw[2]]
+            apt_id, pos = _unpack_varint(raw, 3)
+            ref, pos = _unpack_varint(raw, pos)
+            if pos != len(raw):
+                return None
+        except (ValueError, IndexError):
+            return None
+        
+        if ref & 1:
+            index = ref >> 1
+            if index >= len(CALLBACK_STATIC_FIELDS):
+                return None
+            return cls(action, apt_id, section, field_key=CALLBACK_STATIC_FIELDS[index])
+        return cls(action, apt_id, section, info_id=ref >> 1)
+
+def field_callback(action: int, apt_id: int, section: str,
+                   field_key: str = None, info_id: int = None) -> str:
+    """callback_data для кнопки поля"""
+    return FieldCallback(action, apt_id, section, field_key, info_id).pack()
+
+class CallbackRouter:
+    """
+    Маршрутизация callback_query одним обработчиком вместо цепочки
+    F.data.startswith(...): точные значения - dict, префиксы - trie
+    (выигрывает самый длинный), кодированные кнопки - по коду действия.
+    Стоимость не зависит от числа зарегистрированных обработчиков.
+    """
+    
+    def __init__(self):
+        self.exact_routes: Dict[str, Callable] = {}
+        self.prefix_trie: Dict = {}
+        self.action_routes: Dict[int, Callable] = {}
+        self.fallback_handler: Optional[Callable] = None
+        self.prefix_count = 0
+        self._kwargs: Dict[Callable, Tuple[str, ...]] = {}
+    
+    def _remember(self, handler: Callable):
+        # Какие из необязательных аргументов (state, payload) принимает обработчик
+        params = inspect.signature(handler).parameters
+        self._kwargs[handler] = tuple(name for name in ('state', 'payload') if name in params)
+    
+    def exact(self, *values: str):
+        def decorator(handler):
+            self._remember(handler)
+            for value in values:
+                self.exact_routes[value] = handler
+            return handler
+        return decorator
+    
+    def prefix(self, *prefixes: str):
+        def decorator(handler):
+            self._remember(handler)
+            for prefix in prefixes:
+                node = self.prefix_trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                node[None] = handler
+                self.prefix_count += 1
+            return handler
+        return decorator
+    
+    def action(self, *codes: int):
+        def decorator(handler):
+            self._remember(handler)
+            for code in codes:
+                self.action_routes[code] = handler
+            return handler
+        return decorator
+    
+    def fallback(self, handler):
+        self._remember(handler)
+        self.fallback_handler = handler
+        return handler
+    
+    def resolve(self, data: str) -> Tuple[Optional[Callable], Optional[FieldCallback]]:
+        """Обработчик для callback_data и разобранная кодированная кнопка (если есть)"""
+        if data.startswith(CALLBACK_CODEC_PREFIX):
+            payload = FieldCallback.unpack(data)
+            if payload and payload.action in self.action_routes:
+                return self.action_routes[payload.action], payload
+            return self.fallback_handler, None
+        
+        handler = self.exact_routes.get(data)
+        if handler:
+            return handler, None
+        
+        # Спуск по trie: запоминаем последний (самый длинный) совпавший префикс
+        node = self.prefix_trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            handler = node.get(None, handler)
+        
+        return handler or self.fallback_handler, None
+    
+    def route_label(self, data: str) -> str:
+        """Метка маршрута для метрик: точное значение, совпавший префикс или обработчик кнопки"""
+        if data.startswith(CALLBACK_CODEC_PREFIX):
+            payload = FieldCallback.unpack(data)
+            if payload and payload.action in self.action_routes:
+                return CALLBACK_CODEC_PREFIX + self.action_routes[payload.action].__name__
+            return "unrouted"
+        
+        if data in self.exact_routes:
+            return data
+        
+        node = self.prefix_trie
+        matched = 0
+        for depth, char in enumerate(data, 1):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                matched = depth
+        
+        return data[:matched] if matched else "unrouted"
+    
+    async def dispatch(self, callback: types.CallbackQuery, state: FSMContext):
+        handler, payload = self.resolve(callback.data or "")
+        if handler is None:
+            return
+        
+        available = {'state': state, 'payload': payload}
+        kwargs = {name: available[name] for name in self._kwargs[handler]}
+        return await handler(callback, **kwargs)
     
-    return True
+    def stats(self) -> Dict:
+        return {
+            'exact': len(self.exact_routes),
+            'prefixes': self.prefix_count,
+            'actions': len(self.action_routes)
+        }
+
+callback_router = CallbackRouter()
 
 # ============================================
-# HELPER FUNCTIONS
+# ПОДПИСАННЫЕ ССЫЛКИ
 # ============================================
 
-async def clear_state_keep_company(state: FSMContext):
-    """Очищает state, но сохраняет current_organization_id"""
-    data = await state.get_data()
-    org_id = data.get('current_organization_id')
-    await state.clear()
-    if org_id:
-        await state.update_data(current_organization_id=org_id)
+# Токен: base64url(версия, varint id, varint срок в часах от эпохи) + HMAC-SHA256[:10].
+# Вид ссылки входит только в подпись, поэтому гостевой токен не подходит как приглашение.
+LINK_TOKEN_VERSION = 1
+LINK_TOKEN_MAC_SIZE = 10
+LINK_KIND_GUEST = b"g"
+LINK_KIND_ORG = b"o"
 
-def generate_hash() -> str:
-    """Генерирует уникальный hash для organization или booking"""
-    return hashlib.md5(secrets.token_bytes(32)).hexdigest()[:16]
+_link_key = (LINK_SECRET or f"deep-link:{BOT_TOKEN}").encode()
 
-def telegram_id_to_str(telegram_id: int) -> str:
-    """Конвертирует Telegram ID в строку для БД"""
-    return str(telegram_id)
+link_token_stats = {
+    'signed': 0,
+    'legacy': 0,
+    'rejected': 0
+}
+
+def _link_mac(kind: bytes, body: bytes) -> bytes:
+    return hmac.new(_link_key, kind + body, hashlib.sha256).digest()[:LINK_TOKEN_MAC_SIZE]
+
+def sign_link_token(kind: bytes, entity_id: int, ttl_days: float) -> str:
+    """Подписанный токен для deep-link; ttl_days <= 0 - без срока действия"""
+    expires_hours = int(time.time() // 3600 + ttl_days * 24) + 1 if ttl_days > 0 else 0
+    
+    body = bytearray((LINK_TOKEN_VERSION,))
+    _pack_varint(entity_id, body)
+    _pack_varint(expires_hours, body)
+    
+    raw = bytes(body) + _link_mac(kind, bytes(body))
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def verify_link_token(kind: bytes, token: str) -> Optional[int]:
+    """id сущности из токена; None - подделка, битый или истёкший токен (без обращения к БД)"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        body, mac = raw[:-LINK_TOKEN_MAC_SIZE], raw[-LINK_TOKEN_MAC_SIZE:]
+        
+        if len(body) < 3 or not hmac.compare_digest(mac, _link_mac(kind, body)):
+            return None
+        if body[0] != LINK_TOKEN_VERSION:
+            return None
+        
+        entity_id, pos = _unpack_varint(body, 1)
+        expires_hours, pos = _unpack_varint(body, pos)
+        if pos != len(body):
+            return None
+    except (ValueError, IndexError):
+        return None
+    
+    if expires_hours and expires_hours * 3600 < time.time():
+        return None
+    
+    return entity_id
+
+def is_legacy_link_hash(token: str) -> bool:
+    """Старые ссылки: 16 hex-символов из generate_hash()"""
+    return (LEGACY_LINK_HASHES and len(token) == 16
+            and all(char in "0123456789abcdef" for char in token))
 
 # ============================================
 # ИНИЦИАЛИЗАЦИЯ БД
@@ -296,33 +2369,228 @@ async def init_db():
     
     logger.info("✅ Database pool created")
     
-    # Создаём базовые категории если их нет
+    # Загружаем реестр категорий и создаём базовые категории если их нет
     async with db_pool.acquire() as conn:
         try:
+            await load_category_registry(conn)
+            
             # Проверяем и создаём родительские категории (разделы)
             for section_key, section_name in SECTION_TO_CATEGORY_MAP.items():
-                exists = await conn.fetchval(
-                    'SELECT id FROM categories WHERE name = $1',
-                    section_name
-                )
-                
-                if not exists:
-                    await conn.execute('''
-                        INSERT INTO categories (
-                            name, expandable, editable, 
-                            created_at, updated_at, published_at
-                        )
-                        VALUES ($1, TRUE, TRUE, NOW(), NOW(), NOW())
-                    ''', section_name)
-                    logger.info(f"✅ Created category: {section_name}")
+                await get_or_create_category(section_name, conn=conn)
             
             logger.info("✅ Base categories verified")
             
         except Exception as e:
             logger.error(f"❌ Error creating base categories: {e}")
     
+    if isinstance(storage, PostgresStorage):
+        async with db_pool.acquire() as conn:
+            await PostgresStorage.setup(conn)
+        logger.info("✅ Postgres FSM storage ready")
+    
+    async with db_pool.acquire() as conn:
+        await setup_broadcast_tables(conn)
+    logger.info("✅ Broadcast tables ready")
+    
+    if CHANGE_FEED_ENABLED:
+        async with db_pool.acquire() as conn:
+            try:
+                await install_change_feed(conn)
+            except Exception as e:
+                logger.error(f"❌ Error installing change feed triggers: {e}")
+    
     logger.info("✅ Database initialized successfully")
 
+# ============================================
+# ЛЕНТА ИЗМЕНЕНИЙ БД (LISTEN/NOTIFY)
+# ============================================
+
+# Таблицы, изменения в которых должны сбрасывать кэши бота
+CHANGE_FEED_TABLES = (
+    'infos', 'infos_apartment_lnk', 'infos_category_lnk',
+    'categories', 'categories_parent_lnk',
+    'apartments', 'apartments_organization_lnk',
+    'organizations', 'bookings', 'bookings_apartment_lnk',
+    'managers', 'managers_organization_lnk'
+)
+
+change_feed_stats = {
+    'connected': False,
+    'events': 0,
+    'reconnects': 0,
+    'flushes': 0
+}
+
+async def install_change_feed(conn):
+    """
+    Создать триггеры, которые шлют NOTIFY с типом сущности и id.
+    В payload только ключевые колонки - лимит NOTIFY 8000 байт.
+    """
+    async with conn.transaction():
+        # Несколько реплик не должны пересоздавать триггеры одновременно
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('bot_change_feed'))")
+        
+        await conn.execute(f'''
+            CREATE OR REPLACE FUNCTION bot_notify_change() RETURNS trigger AS $$
+            DECLARE
+                r jsonb;
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    r := to_jsonb(OLD);
+                ELSE
+                    r := to_jsonb(NEW);
+                END IF;
+                
+                PERFORM pg_notify('{CHANGE_FEED_CHANNEL}', jsonb_strip_nulls(jsonb_build_object(
+                    'entity', TG_TABLE_NAME,
+                    'op', TG_OP,
+                    'id', r -> 'id',
+                    'apartment_id', r -> 'apartment_id',
+                    'info_id', r -> 'info_id',
+                    'category_id', r -> 'category_id',
+                    'inv_category_id', r -> 'inv_category_id',
+                    'organization_id', r -> 'organization_id',
+                    'manager_id', r -> 'manager_id',
+                    'booking_id', r -> 'booking_id',
+                    'telegram_id', r -> 'telegram_id'
+                ))::text);
+                
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        ''')
+        
+        # CREATE TRIGGER берёт SHARE ROW EXCLUSIVE на таблицу Strapi,
+        # поэтому трогаем только таблицы, где триггера ещё нет
+        installed = {
+            row['tbl'] for row in await conn.fetch('''
+                SELECT tbl
+                FROM unnest($1::text[]) AS tbl
+                WHERE EXISTS (
+                    SELECT 1 FROM pg_trigger
+                    WHERE tgrelid = to_regclass(tbl)
+                      AND tgname = 'bot_notify_change'
+                )
+            ''', list(CHANGE_FEED_TABLES))
+        }
+        
+        for table in CHANGE_FEED_TABLES:
+            if table in installed:
+                continue
+            await conn.execute(f'''
+                CREATE TRIGGER bot_notify_change
+                AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION bot_notify_change()
+            ''')
+    
+    logger.info(
+        f"✅ Change feed triggers ready on {len(CHANGE_FEED_TABLES)} tables "
+        f"({len(CHANGE_FEED_TABLES) - len(installed)} created)"
+    )
+
+def apply_change_event(event: Dict):
+    """Перевести событие из ленты изменений в инвалидацию кэшей"""
+    entity = event.get('entity')
+    op = event.get('op')
+    
+    if entity == 'infos':
+        if op != 'INSERT':
+            invalidate_info_snapshots(event['id'])
+    
+    elif entity == 'infos_apartment_lnk':
+        invalidate_apartment_snapshot(event['apartment_id'])
+    
+    elif entity == 'infos_category_lnk':
+        invalidate_info_snapshots(event['info_id'])
+    
+    elif entity == 'categories':
+        if op == 'INSERT':
+            return
+        # Переименование/удаление категории меняет field_key во всех снимках
+        for name, cat_id in list(category_ids.items()):
+            if cat_id == event['id']:
+                del category_ids[name]
+        category_parents.pop(event['id'], None)
+        invalidate_all_snapshots()
+    
+    elif entity == 'categories_parent_lnk':
+        if op == 'DELETE':
+            category_parents.pop(event['category_id'], None)
+        else:
+            category_parents[event['category_id']] = event.get('inv_category_id')
+        invalidate_all_snapshots()
+    
+    elif entity == 'apartments':
+        invalidate_apartment_snapshot(event['id'])
+    
+    elif entity == 'managers':
+        if op != 'INSERT' and event.get('telegram_id'):
+            known_managers.pop(str(event['telegram_id']))
+
+def on_change_notification(conn, pid, channel, payload):
+    """Обработчик NOTIFY от asyncpg"""
+    change_feed_stats['events'] += 1
+    try:
+        apply_change_event(json.loads(payload))
+    except Exception as e:
+        logger.warning(f"⚠️ Bad change feed event {payload!r}: {e}")
+
+async def flush_caches():
+    """Полный сброс кэшей - после разрыва ленты изменений события могли потеряться"""
+    known_managers.clear()
+    invalidate_all_snapshots()
+    note_db_write()
+    
+    async with db_acquire() as conn:
+        await load_category_registry(conn)
+    
+    change_feed_stats['flushes'] += 1
+    logger.info("✅ Caches flushed")
+
+async def run_change_feed():
+    """
+    Держит отдельное соединение с LISTEN и переподключается при разрыве.
+    После каждого (пере)подключения кэши сбрасываются полностью.
+    """
+    delay = 1
+    
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            lost = asyncio.Event()
+            conn.add_termination_listener(lambda _: lost.set())
+            await conn.add_listener(CHANGE_FEED_CHANNEL, on_change_notification)
+            
+            await flush_caches()
+            change_feed_stats['connected'] = True
+            logger.info("✅ Change feed listener connected")
+            delay = 1
+            
+            # Периодический ping ловит "тихо" умершие TCP-соединения: на полуоткрытом
+            # сокете ответа не будет, поэтому ждём его не дольше CHANGE_FEED_PING_TIMEOUT
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(lost.wait(), timeout=CHANGE_FEED_PING_INTERVAL)
+                except asyncio.TimeoutError:
+                    await conn.fetchval('SELECT 1', timeout=CHANGE_FEED_PING_TIMEOUT)
+            
+            logger.warning("⚠️ Change feed connection lost")
+        
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Change feed error: {e}")
+        finally:
+            change_feed_stats['connected'] = False
+            if conn and not conn.is_closed():
+                # close() ждёт ответа сервера и на мёртвом сокете зависнет - обрываем
+                conn.terminate()
+        
+        change_feed_stats['reconnects'] += 1
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+
 # ============================================
 # FSM STATES
 # ============================================
@@ -354,15 +2622,24 @@ class BookingStates(StatesGroup):
 class SuggestionStates(StatesGroup):
     waiting_suggestion = State()
 
+# Состояния, сообщения в которых идут в фоновую полосу пула обработчиков:
+# загрузка контента полей и свободный текст предложений
+BACKGROUND_STATES = frozenset({
+    ApartmentStates.editing_field.state,
+    ApartmentStates.adding_custom_button_content.state,
+    SuggestionStates.waiting_suggestion.state
+})
+
 # ============================================
 # DATABASE FUNCTIONS - ORGANIZATIONS
 # ============================================
 
+@request_cached(entity='manager', related=('organization',))
 async def get_manager_organizations(telegram_id: int) -> List[Tuple[int, str, str]]:
     """Получить список организаций менеджера"""
     telegram_id_str = telegram_id_to_str(telegram_id)
     
-    async with db_pool.acquire() as conn:
+    async with db_acquire() as conn:
         rows = await conn.fetch('''
             SELECT o.id, o.name, o.city
             FROM organizations o
@@ -380,7 +2657,7 @@ async def create_organization(name: str, city: str, telegram_id: int) -> int:
     greeting = "Добрый день! Добро пожаловать! Вы находитесь в боте-помощнике для ваших апартаментов."
     hash_code = generate_hash()
     
-    async with db_pool.acquire() as conn:
+    async with db_acquire(('manager', telegram_id), ('organization', None)) as conn:
         # Получаем ID менеджера
         manager_id = await conn.fetchval(
             'SELECT id FROM managers WHERE telegram_id = $1',
@@ -418,9 +2695,10 @@ async def create_organization(name: str, city: str, telegram_id: int) -> int:
         logger.info(f"✅ Created organization {org_id} for manager {telegram_id}")
         return org_id
 
+@request_cached(entity='organization')
 async def get_organization_info(org_id: int) -> Optional[Dict]:
     """Получить информацию об организации"""
-    async with db_pool.acquire() as conn:
+    async with db_acquire() as conn:
         row = await conn.fetchrow('''
             SELECT id, name, city, greeting, timezone, 
                    check_in, check_out, is_long, hash
@@ -437,19 +2715,32 @@ async def update_organization_field(org_id: int, field: str, value):
     if field not in allowed_fields:
         raise ValueError(f"Invalid field: {field}")
     
-    async with db_pool.acquire() as conn:
+    async with db_acquire(('organization', org_id)) as conn:
         query = f"UPDATE organizations SET {field} = $1, updated_at = NOW() WHERE id = $2"
         await conn.execute(query, value, org_id)
 
 async def join_organization_by_hash(telegram_id: int, hash_code: str) -> Optional[int]:
-    """Присоединиться к организации по hash"""
-    telegram_id_str = telegram_id_to_str(telegram_id)
-    
-    async with db_pool.acquire() as conn:
+    """Присоединиться к организации по hash (старые ссылки)"""
+    async with db_acquire() as conn:
         org_id = await conn.fetchval(
             'SELECT id FROM organizations WHERE hash = $1',
             hash_code
         )
+    
+    if not org_id:
+        return None
+    
+    return await join_organization(telegram_id, org_id)
+
+async def join_organization(telegram_id: int, org_id: int) -> Optional[int]:
+    """Присоединиться к организации по id из подписанной ссылки"""
+    telegram_id_str = telegram_id_to_str(telegram_id)
+    
+    async with db_acquire(('manager', telegram_id), ('organization', org_id)) as conn:
+        org_id = await conn.fetchval(
+            'SELECT id FROM organizations WHERE id = $1',
+            org_id
+        )
         
         if not org_id:
             return None
@@ -488,9 +2779,10 @@ async def join_organization_by_hash(telegram_id: int, hash_code: str) -> Optiona
 # DATABASE FUNCTIONS - APARTMENTS
 # ============================================
 
+@request_cached(entity='organization', related=('apartment',))
 async def get_organization_apartments(org_id: int) -> List[Tuple[int, str, str, bool]]:
     """Получить список квартир организации - ИСПРАВЛЕНО: убрана проблема с ORDER BY"""
-    async with db_pool.acquire() as conn:
+    async with db_acquire() as conn:
         rows = await conn.fetch('''
             SELECT a.id, a.name, COALESCE(a.address, '') as address, COALESCE(a.is_long, FALSE) as is_long
             FROM apartments a
@@ -499,13 +2791,17 @@ async def get_organization_apartments(org_id: int) -> List[Tuple[int, str, str,
             ORDER BY a.id DESC
         ''', org_id)
         
+        # Список уже содержит всё для get_apartment_info - не запрашиваем квартиры повторно
+        for row in rows:
+            request_prime('get_apartment_info', (row['id'],), {**dict(row), 'organization_id': org_id})
+        
         logger.info(f"✅ Found {len(rows)} apartments for org {org_id}")
         return [(row['id'], row['name'], row['address'], row['is_long']) for row in rows]
 
 
 async def create_apartment(org_id: int, name: str, address: str) -> int:
     """Создать новую квартиру"""
-    async with db_pool.acquire() as conn:
+    async with db_acquire(('organization', org_id)) as conn:
         # Создаём квартиру
         apt_id = await conn.fetchval('''
             INSERT INTO apartments (
@@ -525,23 +2821,33 @@ async def create_apartment(org_id: int, name: str, address: str) -> int:
         logger.info(f"✅ Created apartment {apt_id} for organization {org_id}")
         return apt_id
 
-async def get_apartment_info(apt_id: int) -> Optional[Dict]:
-    """Получить информацию о квартире - ИСПРАВЛЕНО: добавлены COALESCE"""
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow('''
-            SELECT a.id, a.name, COALESCE(a.address, '') as address, COALESCE(a.is_long, FALSE) as is_long,
+async def load_apartments_info(apt_ids: List[int]) -> Dict[int, Dict]:
+    """Информация о нескольких квартирах одним запросом - ИСПРАВЛЕНО: добавлены COALESCE"""
+    async with db_acquire() as conn:
+        rows = await conn.fetch('''
+            SELECT DISTINCT ON (a.id)
+                   a.id, a.name, COALESCE(a.address, '') as address, COALESCE(a.is_long, FALSE) as is_long,
                    aol.organization_id
             FROM apartments a
             LEFT JOIN apartments_organization_lnk aol ON a.id = aol.apartment_id
-            WHERE a.id = $1
-        ''', apt_id)
+            WHERE a.id = ANY($1::int[])
+            ORDER BY a.id
+        ''', apt_ids)
         
-        return dict(row) if row else None
+        return {row['id']: dict(row) for row in rows}
+
+async def get_apartments_info(apt_ids: List[int]) -> Dict[int, Optional[Dict]]:
+    """Информация о квартирах по id; уже прочитанные в этом апдейте берутся из мемо"""
+    return await request_load_many('get_apartment_info', apt_ids, load_apartments_info, 'apartment')
+
+async def get_apartment_info(apt_id: int) -> Optional[Dict]:
+    """Получить информацию о квартире"""
+    return (await get_apartments_info([apt_id]))[apt_id]
 
 
 async def toggle_apartment_term(apt_id: int):
     """Переключить долгосрок/краткосрок - ИСПРАВЛЕНО: добавлен COALESCE"""
-    async with db_pool.acquire() as conn:
+    async with db_acquire(('apartment', apt_id)) as conn:
         await conn.execute('''
             UPDATE apartments 
             SET is_long = NOT COALESCE(is_long, FALSE), updated_at = NOW()
@@ -551,7 +2857,7 @@ async def toggle_apartment_term(apt_id: int):
 
 async def delete_apartment(apt_id: int):
     """Удалить квартиру"""
-    async with db_pool.acquire() as conn:
+    async with db_acquire(('apartment', apt_id), ('booking', None)) as conn:
         # Сначала удаляем связи
         await conn.execute('DELETE FROM apartments_organization_lnk WHERE apartment_id = $1', apt_id)
         await conn.execute('DELETE FROM infos_apartment_lnk WHERE apartment_id = $1', apt_id)
@@ -559,6 +2865,7 @@ async def delete_apartment(apt_id: int):
         
         # Удаляем квартиру
         await conn.execute('DELETE FROM apartments WHERE id = $1', apt_id)
+        invalidate_apartment_snapshot(apt_id)
         
         logger.info(f"✅ Deleted apartment {apt_id}")
 
@@ -566,32 +2873,58 @@ async def delete_apartment(apt_id: int):
 # DATABASE FUNCTIONS - INFOS & CATEGORIES
 # ============================================
 
-async def get_or_create_category(name: str, parent_name: str = None) -> int:
-    """Получить или создать категорию"""
-    async with db_pool.acquire() as conn:
-        # Проверяем существует ли
-        cat_id = await conn.fetchval(
-            'SELECT id FROM categories WHERE name = $1',
-            name
+async def load_category_registry(conn):
+    """Загрузить реестр категорий и связей с родителями из БД"""
+    rows = await conn.fetch('SELECT id, name FROM categories ORDER BY id')
+    links = await conn.fetch('SELECT category_id, inv_category_id FROM categories_parent_lnk')
+    
+    category_ids.clear()
+    category_parents.clear()
+    
+    for row in rows:
+        if row['name'] is not None:
+            category_ids.setdefault(row['name'], row['id'])
+    
+    for row in links:
+        category_parents[row['category_id']] = row['inv_category_id']
+    
+    logger.info(f"✅ Loaded {len(category_ids)} categories into registry")
+
+async def create_category(conn, name: str, parent_name: str = None) -> int:
+    """
+    Создать категорию, если её ещё нет (upsert).
+    Уникального индекса на categories.name в Strapi нет, поэтому гонку
+    между процессами закрываем advisory-блокировкой по имени категории.
+    """
+    async with conn.transaction():
+        await conn.execute(
+            'SELECT pg_advisory_xact_lock(hashtext($1))',
+            f'categories:{name}'
         )
         
-        if cat_id:
-            return cat_id
-        
-        # Создаём новую
-        cat_id = await conn.fetchval('''
-            INSERT INTO categories (
-                name, expandable, editable,
-                created_at, updated_at, published_at
+        row = await conn.fetchrow('''
+            WITH existing AS (
+                SELECT id FROM categories WHERE name = $1 ORDER BY id LIMIT 1
+            ), inserted AS (
+                INSERT INTO categories (
+                    name, expandable, editable,
+                    created_at, updated_at, published_at
+                )
+                SELECT $1, TRUE, TRUE, NOW(), NOW(), NOW()
+                WHERE NOT EXISTS (SELECT 1 FROM existing)
+                RETURNING id
             )
-            VALUES ($1, TRUE, TRUE, NOW(), NOW(), NOW())
-            RETURNING id
+            SELECT id, FALSE AS created FROM existing
+            UNION ALL
+            SELECT id, TRUE AS created FROM inserted
         ''', name)
         
+        cat_id = row['id']
+        
         # Если указана родительская категория - создаём связь
-        if parent_name:
-            parent_id = await conn.fetchval(
-                'SELECT id FROM categories WHERE name = $1',
+        if row['created'] and parent_name:
+            parent_id = category_ids.get(parent_name) or await conn.fetchval(
+                'SELECT id FROM categories WHERE name = $1 ORDER BY id LIMIT 1',
                 parent_name
             )
             
@@ -600,9 +2933,30 @@ async def get_or_create_category(name: str, parent_name: str = None) -> int:
                     INSERT INTO categories_parent_lnk (category_id, inv_category_id)
                     VALUES ($1, $2)
                 ''', cat_id, parent_id)
+                category_parents[cat_id] = parent_id
         
+    category_ids[name] = cat_id
+    
+    if row['created']:
         logger.info(f"✅ Created category: {name}")
+    
+    return cat_id
+
+async def get_or_create_category(name: str, parent_name: str = None, conn=None) -> int:
+    """
+    Получить или создать категорию.
+    Известные категории отдаются из реестра без запросов к БД.
+    Если передан conn - используем его, а не берём второе соединение из пула.
+    """
+    cat_id = category_ids.get(name)
+    if cat_id:
         return cat_id
+    
+    if conn is not None:
+        return await create_category(conn, name, parent_name)
+    
+    async with db_acquire(('category', None)) as conn:
+        return await create_category(conn, name, parent_name)
 
 async def save_apartment_field(
     apt_id: int, 
@@ -612,131 +2966,109 @@ async def save_apartment_field(
     text_content: str = None,
     file_id: str = None,
     file_type: str = None
-):
+) -> Optional[Tuple[int, bool]]:
     """
     Сохранить информацию о квартире.
     ДОБАВЛЕНО: валидация - не сохраняем если нет контента.
+    Info и обе связи *_lnk создаются/обновляются одним атомарным запросом.
+    Возвращает (info_id, created) или None, если сохранять нечего.
     """
     # Валидация: не сохраняем пустые записи
     if not text_content and not file_id:
         logger.warning(f"⚠️ Attempted to save empty field {field_key} for apartment {apt_id}")
-        return
+        return None
     
-    async with db_pool.acquire() as conn:
-        # Получаем или создаём категории
+    async with db_acquire(('apartment', apt_id)) as conn:
+        # Получаем или создаём категории (обычно из реестра, без запросов)
         section_name = SECTION_TO_CATEGORY_MAP.get(section, section)
         field_category_name = FIELD_TO_CATEGORY_MAP.get(field_key, field_name)
         
-        section_cat_id = await get_or_create_category(section_name)
-        field_cat_id = await get_or_create_category(field_category_name, section_name)
-        
-        # Проверяем существует ли info
-        info_id = await conn.fetchval('''
-            SELECT i.id FROM infos i
-            JOIN infos_apartment_lnk ial ON i.id = ial.info_id
-            JOIN infos_category_lnk icl ON i.id = icl.info_id
-            WHERE ial.apartment_id = $1 
-            AND icl.category_id = $2
-            LIMIT 1
-        ''', apt_id, field_cat_id)
+        section_cat_id = await get_or_create_category(section_name, conn=conn)
+        field_cat_id = await get_or_create_category(field_category_name, section_name, conn=conn)
         
-        if info_id:
-            # Обновляем существующий
-            await conn.execute('''
+        # Один CTE-запрос: обновляем существующий info или создаём новый
+        # вместе со связями. Один statement - одна транзакция и один round trip.
+        row = await conn.fetchrow('''
+            WITH existing AS (
+                SELECT i.id FROM infos i
+                JOIN infos_apartment_lnk ial ON i.id = ial.info_id
+                JOIN infos_category_lnk icl ON i.id = icl.info_id
+                WHERE ial.apartment_id = $1 
+                AND icl.category_id = $2
+                LIMIT 1
+            ), updated AS (
                 UPDATE infos 
-                SET name = $1, text = $2, type = $3, caption = $4, updated_at = NOW()
-                WHERE id = $5
-            ''', field_name, text_content, file_type or 'text', file_id, info_id)
-            logger.info(f"✅ Updated field {field_key} for apartment {apt_id}")
-        else:
-            # Создаём новый
-            info_id = await conn.fetchval('''
+                SET name = $3, text = $4, type = $5, caption = $6, updated_at = NOW()
+                WHERE id IN (SELECT id FROM existing)
+                RETURNING id
+            ), inserted AS (
                 INSERT INTO infos (
                     name, text, type, caption,
                     created_at, updated_at, published_at
                 )
-                VALUES ($1, $2, $3, $4, NOW(), NOW(), NOW())
+                SELECT $3, $4, $5, $6, NOW(), NOW(), NOW()
+                WHERE NOT EXISTS (SELECT 1 FROM existing)
                 RETURNING id
-            ''', field_name, text_content, file_type or 'text', file_id)
-            
-            # Связываем с квартирой
-            await conn.execute('''
+            ), apartment_link AS (
                 INSERT INTO infos_apartment_lnk (info_id, apartment_id)
-                VALUES ($1, $2)
-            ''', info_id, apt_id)
-            
-            # Связываем с категорией
-            await conn.execute('''
+                SELECT id, $1 FROM inserted
+            ), category_link AS (
                 INSERT INTO infos_category_lnk (info_id, category_id)
-                VALUES ($1, $2)
-            ''', info_id, field_cat_id)
+                SELECT id, $2 FROM inserted
+            )
+            SELECT id, FALSE AS created FROM updated
+            UNION ALL
+            SELECT id, TRUE AS created FROM inserted
+        ''', apt_id, field_cat_id, field_name, text_content, file_type or 'text', file_id)
             
+        info_id, created = row['id'], row['created']
+        invalidate_apartment_snapshot(apt_id)
+            
+        if created:
             logger.info(f"✅ Created field {field_key} for apartment {apt_id}")
+        else:
+            logger.info(f"✅ Updated field {field_key} for apartment {apt_id}")
+            
+        return info_id, created
 
 async def get_apartment_field(apt_id: int, section: str, field_key: str) -> Optional[Dict]:
-    """Получить информацию о конкретном поле квартиры"""
+    """Получить информацию о конкретном поле квартиры (из снимка)"""
+    snapshot = await get_apartment_snapshot(apt_id)
+    field = snapshot.get_field(field_key)
     
-    # Пробуем найти по названию категории из маппинга
-    field_category_name = FIELD_TO_CATEGORY_MAP.get(field_key)
+    if not field:
+        return None
     
-    async with db_pool.acquire() as conn:
-        # Сначала пробуем точное совпадение по категории
-        if field_category_name:
-            row = await conn.fetchrow('''
-                SELECT i.name, i.text, i.type, i.caption
-                FROM infos i
-                JOIN infos_apartment_lnk ial ON i.id = ial.info_id
-                JOIN infos_category_lnk icl ON i.id = icl.info_id
-                JOIN categories c ON icl.category_id = c.id
-                WHERE ial.apartment_id = $1 AND c.name = $2
-                LIMIT 1
-            ''', apt_id, field_category_name)
-            
-            if row:
-                return {
-                    'text_content': row['text'],
-                    'file_id': row['caption'],
-                    'file_type': row['type']
-                }
-        
-        # Если не нашли - пробуем через поиск по названию
-        search_name = field_key.replace('_', ' ').title()
-        
-        row = await conn.fetchrow('''
-            SELECT i.name, i.text, i.type, i.caption
-            FROM infos i
-            JOIN infos_apartment_lnk ial ON i.id = ial.info_id
-            JOIN infos_category_lnk icl ON i.id = icl.info_id
-            JOIN categories c ON icl.category_id = c.id
-            WHERE ial.apartment_id = $1 
-            AND (c.name ILIKE $2 OR i.name ILIKE $2)
-            LIMIT 1
-        ''', apt_id, f'%{search_name}%')
-        
-        if not row:
-            return None
-        
-        return {
-            'text_content': row['text'],
-            'file_id': row['caption'],
-            'file_type': row['type']
-        }
+    return {
+        'text_content': field['text_content'],
+        'file_id': field['file_id'],
+        'file_type': field['file_type']
+    }
 
 async def get_section_fields(apt_id: int, section: str) -> List[Dict]:
-    """Получить все поля раздела - ИСПРАВЛЕНО: правильный field_key через маппинг"""
-    section_name = SECTION_TO_CATEGORY_MAP.get(section, section)
-    
-    async with db_pool.acquire() as conn:
-        # Получаем обычные поля
+    """Получить все поля раздела (из снимка) - field_key через маппинг категорий"""
+    snapshot = await get_apartment_snapshot(apt_id)
+    return snapshot.section_fields(section)
+
+@request_cached(entity='apartment')
+async def get_apartment_fields_state(apt_id: int) -> Dict[str, Dict[str, Dict]]:
+    """
+    Заполненность полей всех разделов квартиры одним агрегирующим запросом.
+    Возвращает {section: {field_key: {'info_id': ..., 'field_name': ..., 'filled': bool}}}.
+    Кастомные поля, как и в get_section_fields, попадают в каждый раздел.
+    """
+    async with db_acquire() as conn:
         rows = await conn.fetch('''
             SELECT 
-                i.id,
-                i.name as field_name,
-                i.text,
-                i.type,
-                i.caption,
+                COALESCE(parent_cat.name, child_cat.name) as section_name,
                 child_cat.name as category_name,
-                i.created_at
+                CASE WHEN child_cat.name LIKE 'Кастом %' THEN i.id END as custom_id,
+                (ARRAY_AGG(i.id ORDER BY i.created_at))[1] as info_id,
+                MIN(i.name) as field_name,
+                BOOL_OR(
+                    COALESCE(BTRIM(i.text, E' \\t\\r\\n'), '') <> ''
+                    OR COALESCE(i.caption, '') <> ''
+                ) as filled
             FROM infos i
             JOIN infos_apartment_lnk ial ON i.id = ial.info_id
             JOIN infos_category_lnk icl ON i.id = icl.info_id
@@ -744,81 +3076,378 @@ async def get_section_fields(apt_id: int, section: str) -> List[Dict]:
             LEFT JOIN categories_parent_lnk cpl ON child_cat.id = cpl.category_id
             LEFT JOIN categories parent_cat ON cpl.inv_category_id = parent_cat.id
             WHERE ial.apartment_id = $1
-            AND (parent_cat.name = $2 OR child_cat.name = $2)
-            GROUP BY i.id, i.name, i.text, i.type, i.caption, child_cat.name, i.created_at
-            ORDER BY i.created_at
-        ''', apt_id, section_name)
+            GROUP BY 1, 2, 3
+            ORDER BY MIN(i.created_at)
+        ''', apt_id)
+    
+    fields_state = {section: {} for section in SECTION_TO_CATEGORY_MAP}
+    custom_fields = {}
+    
+    for row in rows:
+        if row['custom_id'] is not None:
+            custom_fields[f"custom_{row['custom_id']}"] = {
+                'info_id': row['custom_id'],
+                'field_name': row['field_name'],
+                'filled': row['filled']
+            }
+            continue
+        
+        section = CATEGORY_TO_SECTION_MAP.get(row['section_name'])
+        if not section:
+            continue
+        
+        category_name = row['category_name']
+        field_key = CATEGORY_TO_FIELD_MAP.get(
+            category_name,
+            category_name.lower().replace(' ', '_').replace('ё', 'е')
+        )
+        
+        field = fields_state[section].setdefault(
+            field_key, {'info_id': row['info_id'], 'field_name': row['field_name'], 'filled': False}
+        )
+        field['filled'] = field['filled'] or row['filled']
+    
+    for section_fields in fields_state.values():
+        section_fields.update(custom_fields)
+    
+    return fields_state
+
+def filled_keys(fields_state: Dict[str, Dict[str, Dict]], *sections: str) -> set:
+    """Заполненные field_key указанных разделов из get_apartment_fields_state"""
+    filled = set()
+    for section in sections:
+        for field_key, field in fields_state.get(section, {}).items():
+            if field['filled']:
+                filled.add(field_key)
+    return filled
+
+# ============================================
+# СНИМОК КОНТЕНТА КВАРТИРЫ
+# ============================================
+
+class ApartmentSnapshot:
+    """
+    Весь контент квартиры (infos + категории), загруженный одним запросом
+    и проиндексированный по разделу и field_key.
+    """
+    
+    def __init__(self, apt_id: int, rows: List):
+        self.apt_id = apt_id
+        self.fields: List[Dict] = []
+        self.custom_fields: List[Dict] = []
+        self.by_info_id: Dict[int, Dict] = {}
+        self.by_category: Dict[str, Dict] = {}
+        self.by_section: Dict[str, List[Dict]] = {}
+        self.tokens: Dict[str, Dict] = {}
+        self.section_names = set()
         
-        result = []
         for row in rows:
             category_name = row['category_name']
+            parent_names = list(row['parent_names'] or [])
             
-            # ✅ ИСПРАВЛЕНИЕ: Используем обратный маппинг для получения правильного field_key
+            # ✅ Используем обратный маппинг для получения правильного field_key
             field_key = CATEGORY_TO_FIELD_MAP.get(
                 category_name,
                 category_name.lower().replace(' ', '_').replace('ё', 'е')
             )
             
-            result.append({
+            field = {
+                'info_id': row['id'],
                 'field_key': field_key,
                 'field_name': row['field_name'],
                 'text_content': row['text'],
                 'file_id': row['caption'],
-                'file_type': row['type']
-            })
+                'file_type': row['type'],
+                'category_name': category_name
+            }
+            
+            self.fields.append(field)
+            self.by_info_id.setdefault(row['id'], field)
+            self.by_category.setdefault(category_name, field)
+            
+            # Короткие токены для callback_data: новый формат указывает прямо
+            # на info, старый md5(field_key)[:8] поддерживаем для уже отправленных кнопок
+            self.tokens.setdefault(field_token(row['id']), field)
+            self.tokens.setdefault(hashlib.md5(field_key.encode()).hexdigest()[:8], field)
+            
+            # Поле относится к разделу-родителю или само является разделом
+            for section_name in set(parent_names + [category_name]):
+                self.by_section.setdefault(section_name, []).append(field)
+            
+            # Аналог COALESCE(parent_cat.name, child_cat.name)
+            self.section_names.update(parent_names or [category_name])
+            
+            if category_name.startswith('Кастом '):
+                custom_field = {**field, 'field_key': f"custom_{row['id']}"}
+                self.custom_fields.append(custom_field)
+                self.tokens[field_token(row['id'])] = custom_field
+                self.tokens.setdefault(
+                    hashlib.md5(custom_field['field_key'].encode()).hexdigest()[:8], custom_field
+                )
+    
+    def section_fields(self, section: str) -> List[Dict]:
+        """Поля раздела, затем кастомные поля - как раньше отдавал get_section_fields"""
+        section_name = SECTION_TO_CATEGORY_MAP.get(section, section)
+        return list(self.by_section.get(section_name, [])) + list(self.custom_fields)
+    
+    def get_field(self, field_key: str) -> Optional[Dict]:
+        """Поле по field_key: точная категория из маппинга, затем поиск по названию"""
+        if field_key.startswith('custom_') and field_key[7:].isdigit():
+            return self.by_info_id.get(int(field_key[7:]))
+        
+        field_category_name = FIELD_TO_CATEGORY_MAP.get(field_key)
+        if field_category_name and field_category_name in self.by_category:
+            return self.by_category[field_category_name]
         
-        # Получаем кастомные поля
-        custom_rows = await conn.fetch('''
+        # Если не нашли - пробуем через поиск по названию
+        search_name = field_key.replace('_', ' ').lower()
+        for field in self.fields:
+            if (search_name in field['category_name'].lower()
+                    or search_name in safe_str(field['field_name']).lower()):
+                return field
+        
+        return None
+    
+    def resolve_token(self, token: str) -> Optional[Dict]:
+        """Поле по короткому токену из callback_data (None - кнопка устарела)"""
+        return self.tokens.get(token)
+    
+    def resolve_callback(self, payload: 'FieldCallback') -> Optional[Dict]:
+        """Поле по кодированной кнопке: по id записи infos или по статическому ключу"""
+        if payload.info_id is not None:
+            return self.tokens.get(field_token(payload.info_id))
+        return self.get_field(payload.field_key)
+    
+    def available_sections(self) -> set:
+        """Разделы верхнего уровня, в которых есть хоть одно поле"""
+        return self.section_names & {'Заселение', 'Аренда', 'Впечатления', 'Выселение'}
+
+# Снимки по apt_id, вытесняются по размеру (LRU) и TTL
+apartment_snapshots = TTLCache(APARTMENT_SNAPSHOT_CACHE_SIZE, APARTMENT_SNAPSHOT_CACHE_TTL)
+
+# Счётчик инвалидаций: снимок, загруженный во время инвалидации, не кэшируем
+_snapshot_invalidations = 0
+
+async def load_apartment_snapshot(apt_id: int) -> ApartmentSnapshot:
+    """Загрузить весь контент квартиры одним запросом"""
+    async with db_acquire() as conn:
+        rows = await conn.fetch('''
             SELECT 
                 i.id,
                 i.name as field_name,
                 i.text,
                 i.type,
                 i.caption,
-                c.name as category_name,
+                child_cat.name as category_name,
+                ARRAY_REMOVE(ARRAY_AGG(DISTINCT parent_cat.name), NULL) as parent_names,
                 i.created_at
             FROM infos i
             JOIN infos_apartment_lnk ial ON i.id = ial.info_id
             JOIN infos_category_lnk icl ON i.id = icl.info_id
-            JOIN categories c ON icl.category_id = c.id
+            JOIN categories child_cat ON icl.category_id = child_cat.id
+            LEFT JOIN categories_parent_lnk cpl ON child_cat.id = cpl.category_id
+            LEFT JOIN categories parent_cat ON cpl.inv_category_id = parent_cat.id
             WHERE ial.apartment_id = $1
-            AND c.name LIKE 'Кастом %'
-            GROUP BY i.id, i.name, i.text, i.type, i.caption, c.name, i.created_at
+            GROUP BY i.id, i.name, i.text, i.type, i.caption, child_cat.name, i.created_at
             ORDER BY i.created_at
         ''', apt_id)
-        
-        # Добавляем кастомные поля
-        for row in custom_rows:
-            result.append({
-                'field_key': f"custom_{row['id']}",
-                'field_name': row['field_name'],
-                'text_content': row['text'],
-                'file_id': row['caption'],
-                'file_type': row['type']
-            })
-        
-        logger.info(f"✅ Found {len(result)} fields for apt {apt_id} section {section}")
-        return result
+    
+    return ApartmentSnapshot(apt_id, rows)
+
+@request_cached(entity='apartment')
+async def get_apartment_snapshot(apt_id: int) -> ApartmentSnapshot:
+    """Снимок контента квартиры из кэша, при промахе - загрузка из БД"""
+    snapshot = apartment_snapshots.get(apt_id)
+    if snapshot is not None:
+        return snapshot
+    
+    invalidations_before = _snapshot_invalidations
+    snapshot = await load_apartment_snapshot(apt_id)
+    
+    if invalidations_before == _snapshot_invalidations:
+        apartment_snapshots.set(apt_id, snapshot)
+    
+    return snapshot
+
+def invalidate_apartment_snapshot(apt_id: int):
+    """Сбросить снимок и гостевой гид квартиры после изменения её контента"""
+    global _snapshot_invalidations
+    _snapshot_invalidations += 1
+    note_db_write(('apartment', apt_id))
+    apartment_snapshots.pop(apt_id)
+    guest_guides.pop(apt_id)
+
+def invalidate_info_snapshots(info_id: int):
+    """Сбросить снимки (и гиды) всех квартир, в которых есть info_id"""
+    snapshots = list(apartment_snapshots.values()) + [guide.snapshot for guide in guest_guides.values()]
+    for snapshot in snapshots:
+        if info_id in snapshot.by_info_id:
+            invalidate_apartment_snapshot(snapshot.apt_id)
+
+def invalidate_all_snapshots():
+    """Сбросить снимки и гиды всех квартир"""
+    global _snapshot_invalidations
+    _snapshot_invalidations += 1
+    note_db_write(('apartment', None))
+    apartment_snapshots.clear()
+    guest_guides.clear()
+
+# ============================================
+# ГОСТЕВОЙ ГИД
+# ============================================
+
+GUEST_TOP_SECTIONS = (
+    ('rent', 'Аренда', "📹 Аренда"),
+    ('checkin', 'Заселение', "🧳 Заселение"),
+    ('experiences', 'Впечатления', "🍿 Впечатления"),
+    ('checkout', 'Выселение', "📦 Выселение")
+)
 
+GUEST_SUBSECTIONS = {
+    'help': ("Подраздел 🏠 Помощь", "🏠 Помощь"),
+    'stores': ("Подраздел 📍 Магазины", "📍 Магазины")
+}
 
+class GuestFieldCard:
+    """Готовая карточка поля для гостя: текст, медиа и клавиатура"""
+    
+    __slots__ = ('header', 'text_content', 'file_id', 'file_type', 'keyboard')
+    
+    def __init__(self, header: str, text_content: Optional[str], file_id: Optional[str],
+                 file_type: Optional[str], keyboard: InlineKeyboardMarkup):
+        self.header = header
+        self.text_content = text_content
+        self.file_id = file_id
+        self.file_type = file_type
+        self.keyboard = keyboard
+    
+    @property
+    def full_text(self) -> str:
+        return f"{self.header}\n\n{self.text_content}" if self.text_content else self.header
 
-async def get_filled_fields(apt_id: int, section: str) -> set:
+class GuestGuide:
     """
-    Получить список заполненных полей раздела.
-    НОВАЯ ФУНКЦИЯ для индикаторов заполненности ■
+    Весь режим гостя для квартиры, собранный заранее: приветствие, стартовый
+    экран, экраны разделов и подразделов, карточки полей. Гид не меняется
+    после сборки - при правке контента он сбрасывается и собирается заново,
+    поэтому клик гостя сводится к поиску в словаре.
     """
-    fields = await get_section_fields(apt_id, section)
     
-    filled = set()
-    for f in fields:
-        # Проверяем что есть хоть какой-то контент
-        text = f.get('text_content')
-        file_id = f.get('file_id')
+    def __init__(self, apt_info: Dict, snapshot: ApartmentSnapshot):
+        apt_id = snapshot.apt_id
+        self.apt_id = apt_id
+        self.snapshot = snapshot
+        
+        apt_name = safe_str(apt_info.get('name'), 'Объект')
+        address = safe_str(apt_info.get('address'), 'Адрес не указан')
+        
+        self.welcome_text = f"{apt_name}\n\nАдрес: {address}.\n\nИнформация для изучения:"
+        self.welcome_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="➡️ Начать", callback_data=f"guest_start_{apt_id}")],
+            [InlineKeyboardButton(text="🚕 Такси", url="https://taxi.yandex.ru")]
+        ])
+        
+        available_sections = snapshot.available_sections()
+        buttons = [
+            [InlineKeyboardButton(text=title, callback_data=f"guest_section_{section}_{apt_id}")]
+            for section, category_name, title in GUEST_TOP_SECTIONS
+            if category_name in available_sections
+        ]
+        buttons.append([InlineKeyboardButton(text="Режим владельца", callback_data="switch_to_owner")])
+        
+        self.start_text = f"{apt_info['name']}\n\nИнформация:"
+        self.start_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+        
+        self.sections: Dict[str, Tuple[str, InlineKeyboardMarkup]] = {}
+        self.subsections: Dict[str, Tuple[str, InlineKeyboardMarkup]] = {}
+        self.cards: Dict[Tuple[str, int], GuestFieldCard] = {}
+        
+        for section in SECTION_TO_CATEGORY_MAP:
+            fields = snapshot.section_fields(section)
+            self._build_cards(section, fields)
+            
+            section_screen = self._build_section(section, fields)
+            if section_screen:
+                self.sections[section] = section_screen
+            
+            if section in GUEST_SUBSECTIONS and fields:
+                text, _ = GUEST_SUBSECTIONS[section]
+                buttons = self._field_buttons(section, fields)
+                buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"guest_section_checkin_{apt_id}")])
+                self.subsections[section] = (text, InlineKeyboardMarkup(inline_keyboard=buttons))
+    
+    def _field_buttons(self, section: str, fields: List[Dict]) -> List[List[InlineKeyboardButton]]:
+        return [
+            [InlineKeyboardButton(
+                text=field['field_name'],
+                callback_data=field_callback(CB_GUEST_FIELD, self.apt_id, section, info_id=field['info_id'])
+            )]
+            for field in fields
+        ]
+    
+    def _build_section(self, section: str, fields: List[Dict]) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+        section_name = SECTION_NAMES.get(section, section)
+        section_icon = SECTION_ICONS.get(section, "📄")
+        
+        if section == 'checkin':
+            text = f"Раздел {section_icon} {section_name} ❤️"
+        else:
+            text = f"Раздел {section_icon} {section_name}"
+        
+        buttons = self._field_buttons(section, fields)
+        
+        if section == 'checkin':
+            for subsection, (_, title) in GUEST_SUBSECTIONS.items():
+                if self.snapshot.section_fields(subsection):
+                    buttons.append([InlineKeyboardButton(text=title, callback_data=f"guest_subsection_{subsection}_{self.apt_id}")])
+        
+        if not buttons:
+            return None
         
-        if (text and text.strip()) or file_id:
-            filled.add(f['field_key'])
+        buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"guest_start_{self.apt_id}")])
+        return text, InlineKeyboardMarkup(inline_keyboard=buttons)
     
-    return filled
+    def _build_cards(self, section: str, fields: List[Dict]):
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Назад", callback_data=f"guest_section_{section}_{self.apt_id}")]
+        ])
+        
+        for field in fields:
+            field_key = field['field_key']
+            field_name = (FIELD_NAMES.get(field_key) or field['field_name']
+                          or field_key.replace('_', ' ').title())
+            
+            self.cards.setdefault((section, field['info_id']), GuestFieldCard(
+                f"Поле: {field_name}",
+                field['text_content'],
+                field['file_id'],
+                field['file_type'],
+                keyboard
+            ))
+    
+    def field_card(self, section: str, field: Dict) -> Optional[GuestFieldCard]:
+        return self.cards.get((section, field['info_id']))
+
+# Гиды по apt_id; сбрасываются вместе со снимком квартиры
+guest_guides = TTLCache(GUEST_GUIDE_CACHE_SIZE, GUEST_GUIDE_CACHE_TTL)
+
+async def get_guest_guide(apt_id: int) -> Optional[GuestGuide]:
+    """Гостевой гид квартиры из кэша, при промахе - сборка из снимка (None - квартиры нет)"""
+    guide = guest_guides.get(apt_id)
+    if guide is not None:
+        return guide
+    
+    invalidations_before = _snapshot_invalidations
+    apt_info = await get_apartment_info(apt_id)
+    if not apt_info:
+        return None
+    
+    guide = GuestGuide(apt_info, await get_apartment_snapshot(apt_id))
+    
+    if invalidations_before == _snapshot_invalidations:
+        guest_guides.set(apt_id, guide)
+    
+    return guide
 
 # ============================================
 # DATABASE FUNCTIONS - BOOKINGS
@@ -831,7 +3460,7 @@ async def create_booking(apt_id: int, guest_name: str, checkin_date) -> Tuple[in
     if isinstance(checkin_date, str):
         checkin_date = datetime.strptime(checkin_date, '%Y-%m-%d').date()
     
-    async with db_pool.acquire() as conn:
+    async with db_acquire(('apartment', apt_id), ('booking', None)) as conn:
         # Создаём бронирование
         booking_id = await conn.fetchval('''
             INSERT INTO bookings (
@@ -851,9 +3480,10 @@ async def create_booking(apt_id: int, guest_name: str, checkin_date) -> Tuple[in
         logger.info(f"✅ Created booking {booking_id} for apartment {apt_id}")
         return booking_id, hash_code
 
+@request_cached(entity='apartment', related=('booking',))
 async def get_apartment_bookings(apt_id: int) -> List[Dict]:
     """Получить бронирования квартиры - ИСПРАВЛЕНО: добавлены COALESCE"""
-    async with db_pool.acquire() as conn:
+    async with db_acquire() as conn:
         rows = await conn.fetch('''
             SELECT b.id, b.guest_name, b.checkin, b.checkout, b.hash,
                    COALESCE(b.is_complete, FALSE) as is_complete, b.current_status
@@ -866,9 +3496,10 @@ async def get_apartment_bookings(apt_id: int) -> List[Dict]:
         return [dict(row) for row in rows]
 
 
+@request_cached(related=('booking',))
 async def get_booking_by_hash(hash_code: str) -> Optional[Dict]:
     """Получить бронирование по hash - ИСПРАВЛЕНО: добавлены COALESCE"""
-    async with db_pool.acquire() as conn:
+    async with db_acquire() as conn:
         row = await conn.fetchrow('''
             SELECT b.id, b.guest_name, b.checkin, COALESCE(b.is_complete, FALSE) as is_complete,
                    a.id as apartment_id, a.name as apartment_name, COALESCE(a.address, '') as address
@@ -881,9 +3512,25 @@ async def get_booking_by_hash(hash_code: str) -> Optional[Dict]:
         return dict(row) if row else None
 
 
+@request_cached(entity='booking')
+async def get_booking_by_id(booking_id: int) -> Optional[Dict]:
+    """Получить бронирование по id из подписанной ссылки"""
+    async with db_acquire() as conn:
+        row = await conn.fetchrow('''
+            SELECT b.id, b.guest_name, b.checkin, COALESCE(b.is_complete, FALSE) as is_complete,
+                   a.id as apartment_id, a.name as apartment_name, COALESCE(a.address, '') as address
+            FROM bookings b
+            JOIN bookings_apartment_lnk bal ON b.id = bal.booking_id
+            JOIN apartments a ON bal.apartment_id = a.id
+            WHERE b.id = $1
+        ''', booking_id)
+        
+        return dict(row) if row else None
+
+
 async def complete_booking(booking_id: int):
     """Завершить бронирование"""
-    async with db_pool.acquire() as conn:
+    async with db_acquire(('booking', booking_id)) as conn:
         await conn.execute('''
             UPDATE bookings 
             SET is_complete = TRUE, is_used = TRUE, 
@@ -895,9 +3542,10 @@ async def complete_booking(booking_id: int):
 # DATABASE FUNCTIONS - MANAGERS
 # ============================================
 
+@request_cached(entity='organization', related=('manager',))
 async def get_organization_managers(org_id: int) -> List[Dict]:
     """Получить менеджеров организации - ИСПРАВЛЕНО: добавлены COALESCE"""
-    async with db_pool.acquire() as conn:
+    async with db_acquire() as conn:
         rows = await conn.fetch('''
             SELECT m.id, m.telegram_id, m.name, m.lastname, 
                    COALESCE(m.is_admin, FALSE) as is_admin, 
@@ -919,9 +3567,10 @@ async def get_organization_managers(org_id: int) -> List[Dict]:
         
         return result
 
+@request_cached(related=('admin',))
 async def get_bot_admins() -> List[int]:
     """Получить список telegram_id админов бота из admin_users (кроме id=1)"""
-    async with db_pool.acquire() as conn:
+    async with db_acquire() as conn:
         rows = await conn.fetch('''
             SELECT 
                 CASE 
@@ -944,6 +3593,291 @@ async def get_bot_admins() -> List[int]:
         
         return admin_ids
 
+# ============================================
+# РАССЫЛКИ
+# ============================================
+
+BROADCAST_AUDIENCES = ('all', 'org', 'admins')
+
+# Будит отправителя сразу после постановки рассылки этой репликой
+broadcast_wakeup = asyncio.Event()
+
+broadcast_stats = {
+    'created': 0,
+    'sent': 0,
+    'blocked': 0,
+    'failed': 0,
+    'retried': 0,
+    'flood_waits': 0
+}
+
+async def setup_broadcast_tables(conn):
+    """Таблицы бота (не Strapi): задания рассылок и статус по каждому получателю"""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS bot_broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            audience TEXT NOT NULL,
+            organization_id INTEGER,
+            text TEXT NOT NULL,
+            created_by BIGINT,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ
+        );
+        CREATE TABLE IF NOT EXISTS bot_broadcast_recipients (
+            broadcast_id BIGINT NOT NULL REFERENCES bot_broadcasts(id) ON DELETE CASCADE,
+            telegram_id BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            locked_until TIMESTAMPTZ,
+            error TEXT,
+            sent_at TIMESTAMPTZ,
+            PRIMARY KEY (broadcast_id, telegram_id)
+        );
+        CREATE INDEX IF NOT EXISTS bot_broadcast_recipients_open
+            ON bot_broadcast_recipients (broadcast_id)
+            WHERE status IN ('pending', 'sending');
+    ''')
+
+class _EmptyBroadcast(Exception):
+    """Получателей нет - откат транзакции create_broadcast"""
+
+async def create_broadcast(audience: str, text: str, created_by: int,
+                           org_id: Optional[int] = None) -> Optional[Tuple[int, int]]:
+    """
+    Поставить рассылку в очередь: (id, число получателей) или None, если получателей нет.
+    Отправляет фоновый run_broadcast_sender - вызывающий хендлер не ждёт доставки.
+    """
+    if audience not in BROADCAST_AUDIENCES:
+        raise ValueError(f"Invalid audience: {audience}")
+    if audience == 'org' and not org_id:
+        raise ValueError("org_id is required for audience 'org'")
+    
+    admin_ids = await get_bot_admins() if audience == 'admins' else []
+    
+    async with db_acquire(('broadcast', None)) as conn:
+        try:
+            async with conn.transaction():
+                broadcast_id = await conn.fetchval('''
+                    INSERT INTO bot_broadcasts (audience, organization_id, text, created_by)
+                    VALUES ($1, $2, $3, $4)
+                    RETURNING id
+                ''', audience, org_id, text, created_by)
+                
+                if audience == 'admins':
+                    status = await conn.execute('''
+                        INSERT INTO bot_broadcast_recipients (broadcast_id, telegram_id)
+                        SELECT $1::bigint, admin_id FROM UNNEST($2::bigint[]) AS admin_id
+                        ON CONFLICT DO NOTHING
+                    ''', broadcast_id, admin_ids)
+                else:
+                    # В Strapi telegram_id - строка; нечисловые (мусорные) пропускаем
+                    status = await conn.execute('''
+                        INSERT INTO bot_broadcast_recipients (broadcast_id, telegram_id)
+                        SELECT DISTINCT $1::bigint, m.telegram_id::bigint
+                        FROM managers m
+                        WHERE m.telegram_id ~ '^[0-9]+$'
+                        AND ($2::int IS NULL OR EXISTS (
+                            SELECT 1 FROM managers_organization_lnk mol
+                            WHERE mol.manager_id = m.id AND mol.organization_id = $2
+                        ))
+                        ON CONFLICT DO NOTHING
+                    ''', broadcast_id, org_id if audience == 'org' else None)
+                
+                total = status_rows(status)
+                if not total:
+                    raise _EmptyBroadcast()
+                
+                await conn.execute(
+                    'UPDATE bot_broadcasts SET total = $2 WHERE id = $1',
+                    broadcast_id, total
+                )
+        except _EmptyBroadcast:
+            # Пустая рассылка не нужна - задание откачено вместе с транзакцией
+            return None
+    
+    broadcast_stats['created'] += 1
+    broadcast_wakeup.set()
+    logger.info(f"📣 Broadcast {broadcast_id} ({audience}) queued for {total} recipients")
+    return broadcast_id, total
+
+async def refresh_broadcast_counts(conn, broadcast_ids: List[int]):
+    """Пересчитать счётчики и статус рассылок по их получателям"""
+    await conn.execute('''
+        UPDATE bot_broadcasts b
+        SET sent = c.sent, failed = c.failed,
+            status = CASE WHEN c.open = 0 THEN 'done' ELSE 'running' END,
+            finished_at = CASE WHEN c.open = 0 THEN NOW() END
+        FROM (
+            SELECT broadcast_id,
+                   COUNT(*) FILTER (WHERE status = 'sent') AS sent,
+                   COUNT(*) FILTER (WHERE status IN ('failed', 'blocked')) AS failed,
+                   COUNT(*) FILTER (WHERE status IN ('pending', 'sending')) AS open
+            FROM bot_broadcast_recipients
+            WHERE broadcast_id = ANY($1::bigint[])
+            GROUP BY broadcast_id
+        ) c
+        WHERE b.id = c.broadcast_id
+    ''', broadcast_ids)
+
+async def claim_broadcast_batch(limit: int) -> List[Dict]:
+    """
+    Захватить пачку получателей. SKIP LOCKED - реплики делят очередь без пересечений;
+    'sending' с истёкшей блокировкой (реплика упала посреди отправки) захватывается заново,
+    пока не исчерпаны попытки, после - 'failed'.
+    У 'pending' locked_until - время, раньше которого повтор не отправляем.
+    """
+    async with db_acquire(('broadcast', None)) as conn:
+        async with conn.transaction():
+            abandoned = await conn.fetch('''
+                UPDATE bot_broadcast_recipients
+                SET status = 'failed', error = 'sender lost during delivery', locked_until = NULL
+                WHERE status = 'sending' AND locked_until < NOW() AND attempts >= $1
+                RETURNING broadcast_id
+            ''', BROADCAST_MAX_ATTEMPTS)
+            if abandoned:
+                await refresh_broadcast_counts(conn, list({row['broadcast_id'] for row in abandoned}))
+            
+            rows = await conn.fetch('''
+                WITH claimed AS (
+                    SELECT broadcast_id, telegram_id
+                    FROM bot_broadcast_recipients
+                    WHERE (status = 'pending' AND (locked_until IS NULL OR locked_until <= NOW()))
+                    OR (status = 'sending' AND locked_until < NOW() AND attempts < $2)
+                    ORDER BY broadcast_id, telegram_id
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE bot_broadcast_recipients r
+                SET status = 'sending', attempts = r.attempts + 1,
+                    locked_until = NOW() + INTERVAL '5 minutes'
+                FROM claimed c, bot_broadcasts b
+                WHERE r.broadcast_id = c.broadcast_id AND r.telegram_id = c.telegram_id
+                AND b.id = r.broadcast_id
+                RETURNING r.broadcast_id, r.telegram_id, r.attempts, b.text
+            ''', limit, BROADCAST_MAX_ATTEMPTS)
+        
+        return [dict(row) for row in rows]
+
+async def finish_broadcast_batch(results: List[Tuple[int, int, str, Optional[str], float]]):
+    """
+    Записать исходы пачки (broadcast_id, telegram_id, status, error, retry_in) и обновить
+    счётчики рассылок. 'pending' и 'requeue' возвращаются в очередь не раньше чем через
+    retry_in секунд; 'requeue' (flood control, выключение) попыткой не считается.
+    """
+    async with db_acquire(('broadcast', None)) as conn:
+        await conn.execute('''
+            UPDATE bot_broadcast_recipients r
+            SET status = CASE WHEN u.status = 'requeue' THEN 'pending' ELSE u.status END,
+                attempts = r.attempts - (u.status = 'requeue')::int,
+                error = u.error,
+                locked_until = CASE WHEN u.status IN ('pending', 'requeue')
+                                    THEN NOW() + make_interval(secs => u.retry_in) END,
+                sent_at = CASE WHEN u.status = 'sent' THEN NOW() END
+            FROM UNNEST($1::bigint[], $2::bigint[], $3::text[], $4::text[], $5::float8[])
+                AS u(broadcast_id, telegram_id, status, error, retry_in)
+            WHERE r.broadcast_id = u.broadcast_id AND r.telegram_id = u.telegram_id
+        ''', *(list(column) for column in zip(*results)))
+        
+        await refresh_broadcast_counts(conn, list({result[0] for result in results}))
+
+async def get_recent_broadcasts(limit: int = 5) -> List[Dict]:
+    async with db_acquire() as conn:
+        rows = await conn.fetch('''
+            SELECT id, audience, organization_id, status, total, sent, failed, created_at
+            FROM bot_broadcasts
+            ORDER BY id DESC
+            LIMIT $1
+        ''', limit)
+        
+        return [dict(row) for row in rows]
+
+# Свой темп рассылок поверх общего ограничителя Bot API
+broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_CONCURRENCY) if BROADCAST_RATE > 0 else None
+
+async def deliver_broadcast(recipient: Dict) -> Tuple[int, int, str, Optional[str], float]:
+    """
+    Одна отправка: короткие 429 и паузы чата пережидает rate_limit_middleware;
+    если он сдался, получатель ждёт retry_after в очереди, не тратя попытку.
+    """
+    if broadcast_bucket is not None:
+        wait = broadcast_bucket.take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = broadcast_bucket.take()
+    
+    key = (recipient['broadcast_id'], recipient['telegram_id'])
+    try:
+        await bot.send_message(recipient['telegram_id'], recipient['text'])
+        broadcast_stats['sent'] += 1
+        return (*key, 'sent', None, 0.0)
+    except TelegramRetryAfter as e:
+        broadcast_stats['flood_waits'] += 1
+        return (*key, 'requeue', str(e), float(e.retry_after))
+    except TelegramForbiddenError as e:
+        # Пользователь заблокировал бота - повторять бессмысленно
+        broadcast_stats['blocked'] += 1
+        return (*key, 'blocked', str(e), 0.0)
+    except TelegramBadRequest as e:
+        broadcast_stats['failed'] += 1
+        return (*key, 'failed', str(e), 0.0)
+    except Exception as e:
+        if recipient['attempts'] < BROADCAST_MAX_ATTEMPTS:
+            broadcast_stats['retried'] += 1
+            return (*key, 'pending', str(e), BROADCAST_RETRY_DELAY * 2 ** (recipient['attempts'] - 1))
+        broadcast_stats['failed'] += 1
+        return (*key, 'failed', str(e), 0.0)
+
+async def run_broadcast_sender():
+    """
+    Фоновый отправитель: захватывает пачки, шлёт до BROADCAST_CONCURRENCY сообщений
+    параллельно и записывает статусы. Незавершённые рассылки продолжаются после рестарта.
+    """
+    while True:
+        # Сбрасываем до захвата: рассылка, созданная после него, разбудит ожидание ниже
+        broadcast_wakeup.clear()
+        try:
+            recipients = await claim_broadcast_batch(BROADCAST_BATCH)
+        except Exception as e:
+            logger.error(f"❌ Broadcast claim failed: {e}")
+            recipients = []
+        
+        if not recipients:
+            try:
+                await asyncio.wait_for(broadcast_wakeup.wait(), BROADCAST_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        slots = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        
+        async def send(recipient):
+            async with slots:
+                return await deliver_broadcast(recipient)
+        
+        sends = [asyncio.create_task(send(recipient)) for recipient in recipients]
+        try:
+            results = await asyncio.gather(*sends)
+        except asyncio.CancelledError:
+            # Выключение: исходы завершённых отправок пишем, остальных возвращаем в очередь
+            results = [
+                task.result() if task.done() and not task.cancelled()
+                else (recipient['broadcast_id'], recipient['telegram_id'], 'requeue', 'interrupted by shutdown', 0.0)
+                for task, recipient in zip(sends, recipients)
+            ]
+            await finish_broadcast_batch(results)
+            raise
+        
+        try:
+            await finish_broadcast_batch(results)
+        except Exception as e:
+            # Статусы не записаны: блокировка истечёт, получатели будут захвачены заново
+            logger.error(f"❌ Broadcast status update failed: {e}")
+            await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+
 # ============================================
 # KEYBOARD FUNCTIONS
 # ============================================
@@ -1040,7 +3974,7 @@ def get_apartment_menu_keyboard(apt_id: int, is_long: bool = False):
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="objects_menu")]
     ])
 
-async def get_checkin_section_keyboard_async(apt_id: int, filled_fields: set = None):
+async def get_checkin_section_keyboard_async(apt_id: int, filled_fields: set = None, fields_state: Dict = None):
     """
     Клавиатура раздела Заселение с кастомными кнопками.
     НОВОЕ: добавлен индикатор заполненности ■
@@ -1052,33 +3986,28 @@ async def get_checkin_section_keyboard_async(apt_id: int, filled_fields: set = N
         return f"{name} ■" if key in filled_fields else name
     
     buttons = [
-        [InlineKeyboardButton(text=field_text("🕐 Время заселения", "checkin_time"), callback_data=f"field_checkin_time_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🚗 Парковка", "parking"), callback_data=f"field_parking_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🌐 Wi-Fi", "wifi"), callback_data=f"field_wifi_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🔑 Ключ от двери", "door_key"), callback_data=f"field_door_key_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🗺 Как найти объект?", "how_to_find"), callback_data=f"field_how_to_find_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🚶 Как дойти", "how_to_reach"), callback_data=f"field_how_to_reach_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("📄 Документы", "documents"), callback_data=f"field_documents_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("💰 Депозит", "deposit"), callback_data=f"field_deposit_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🔐 Дист. заселение", "remote_checkin"), callback_data=f"field_remote_checkin_{apt_id}")],
+        [InlineKeyboardButton(text=field_text("🕐 Время заселения", "checkin_time"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkin', 'checkin_time'))],
+        [InlineKeyboardButton(text=field_text("🚗 Парковка", "parking"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkin', 'parking'))],
+        [InlineKeyboardButton(text=field_text("🌐 Wi-Fi", "wifi"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkin', 'wifi'))],
+        [InlineKeyboardButton(text=field_text("🔑 Ключ от двери", "door_key"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkin', 'door_key'))],
+        [InlineKeyboardButton(text=field_text("🗺 Как найти объект?", "how_to_find"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkin', 'how_to_find'))],
+        [InlineKeyboardButton(text=field_text("🚶 Как дойти", "how_to_reach"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkin', 'how_to_reach'))],
+        [InlineKeyboardButton(text=field_text("📄 Документы", "documents"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkin', 'documents'))],
+        [InlineKeyboardButton(text=field_text("💰 Депозит", "deposit"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkin', 'deposit'))],
+        [InlineKeyboardButton(text=field_text("🔐 Дист. заселение", "remote_checkin"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkin', 'remote_checkin'))],
         [InlineKeyboardButton(text="🏠 Помощь с проживанием", callback_data=f"subsection_help_{apt_id}")],
         [InlineKeyboardButton(text="📍 Магазины, аптеки", callback_data=f"subsection_stores_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("📢 Правила", "rules"), callback_data=f"field_rules_{apt_id}")],
+        [InlineKeyboardButton(text=field_text("📢 Правила", "rules"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkin', 'rules'))],
     ]
     
     # Добавляем кастомные кнопки
-    custom_fields = await get_section_fields(apt_id, 'checkin')
-    for field in custom_fields:
-        if field['field_key'].startswith('custom_'):
+    if fields_state is None:
+        fields_state = await get_apartment_fields_state(apt_id)
+    for field_key, field in fields_state['checkin'].items():
+        if field_key.startswith('custom_'):
             field_name = field['field_name']
-            field_key = field['field_key']
-            
-            safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-            callback_data = f"custom_field_{apt_id}_checkin_{safe_field_key}"
             
-            if len(callback_data.encode('utf-8')) > 64:
-                field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-                callback_data = f"cust_f_{apt_id}_checkin_{field_hash}"
+            callback_data = field_callback(CB_CUSTOM_VIEW, apt_id, 'checkin', info_id=field['info_id'])
             
             buttons.append([InlineKeyboardButton(text=f"✨ {field_name}", callback_data=callback_data)])
     
@@ -1087,7 +4016,7 @@ async def get_checkin_section_keyboard_async(apt_id: int, filled_fields: set = N
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-async def get_rent_section_keyboard(apt_id: int, filled_fields: set = None):
+async def get_rent_section_keyboard(apt_id: int, filled_fields: set = None, fields_state: Dict = None):
     """Клавиатура раздела Аренда с индикаторами заполненности"""
     filled_fields = filled_fields or set()
     
@@ -1095,27 +4024,22 @@ async def get_rent_section_keyboard(apt_id: int, filled_fields: set = None):
         return f"{name} ■" if key in filled_fields else name
     
     buttons = [
-        [InlineKeyboardButton(text=field_text("📱 Телефоны УК", "uk_phones"), callback_data=f"field_uk_phones_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("👨‍💼 Диспетчер", "dispatcher"), callback_data=f"field_dispatcher_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🆘 Аварийка", "emergency"), callback_data=f"field_emergency_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("💬 Чаты", "chats"), callback_data=f"field_chats_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("📝 Обратная связь", "feedback_form"), callback_data=f"field_feedback_form_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🌐 Интернет", "internet"), callback_data=f"field_internet_{apt_id}")],
+        [InlineKeyboardButton(text=field_text("📱 Телефоны УК", "uk_phones"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'rent', 'uk_phones'))],
+        [InlineKeyboardButton(text=field_text("👨‍💼 Диспетчер", "dispatcher"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'rent', 'dispatcher'))],
+        [InlineKeyboardButton(text=field_text("🆘 Аварийка", "emergency"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'rent', 'emergency'))],
+        [InlineKeyboardButton(text=field_text("💬 Чаты", "chats"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'rent', 'chats'))],
+        [InlineKeyboardButton(text=field_text("📝 Обратная связь", "feedback_form"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'rent', 'feedback_form'))],
+        [InlineKeyboardButton(text=field_text("🌐 Интернет", "internet"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'rent', 'internet'))],
     ]
     
     # Добавляем кастомные кнопки
-    custom_fields = await get_section_fields(apt_id, 'rent')
-    for field in custom_fields:
-        if field['field_key'].startswith('custom_'):
+    if fields_state is None:
+        fields_state = await get_apartment_fields_state(apt_id)
+    for field_key, field in fields_state['rent'].items():
+        if field_key.startswith('custom_'):
             field_name = field['field_name']
-            field_key = field['field_key']
-            
-            safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-            callback_data = f"custom_field_{apt_id}_rent_{safe_field_key}"
             
-            if len(callback_data.encode('utf-8')) > 64:
-                field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-                callback_data = f"cust_f_{apt_id}_rent_{field_hash}"
+            callback_data = field_callback(CB_CUSTOM_VIEW, apt_id, 'rent', info_id=field['info_id'])
             
             buttons.append([InlineKeyboardButton(text=f"✨ {field_name}", callback_data=callback_data)])
     
@@ -1124,7 +4048,7 @@ async def get_rent_section_keyboard(apt_id: int, filled_fields: set = None):
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-async def get_help_subsection_keyboard(apt_id: int, filled_fields: set = None):
+async def get_help_subsection_keyboard(apt_id: int, filled_fields: set = None, fields_state: Dict = None):
     """Клавиатура подраздела Помощь с индикаторами заполненности"""
     filled_fields = filled_fields or set()
     
@@ -1132,26 +4056,21 @@ async def get_help_subsection_keyboard(apt_id: int, filled_fields: set = None):
         return f"{name} ■" if key in filled_fields else name
     
     buttons = [
-        [InlineKeyboardButton(text=field_text("🥐 Завтрак", "breakfast"), callback_data=f"field_breakfast_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🛏 Бельё", "linen"), callback_data=f"field_linen_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("📱 Менеджер", "manager_contact"), callback_data=f"field_manager_contact_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("📺 ТВ", "tv_setup"), callback_data=f"field_tv_setup_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("❄️ Кондиционер", "ac"), callback_data=f"field_ac_{apt_id}")],
+        [InlineKeyboardButton(text=field_text("🥐 Завтрак", "breakfast"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'help', 'breakfast'))],
+        [InlineKeyboardButton(text=field_text("🛏 Бельё", "linen"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'help', 'linen'))],
+        [InlineKeyboardButton(text=field_text("📱 Менеджер", "manager_contact"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'help', 'manager_contact'))],
+        [InlineKeyboardButton(text=field_text("📺 ТВ", "tv_setup"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'help', 'tv_setup'))],
+        [InlineKeyboardButton(text=field_text("❄️ Кондиционер", "ac"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'help', 'ac'))],
     ]
     
     # Добавляем кастомные кнопки
-    custom_fields = await get_section_fields(apt_id, 'help')
-    for field in custom_fields:
-        if field['field_key'].startswith('custom_'):
+    if fields_state is None:
+        fields_state = await get_apartment_fields_state(apt_id)
+    for field_key, field in fields_state['help'].items():
+        if field_key.startswith('custom_'):
             field_name = field['field_name']
-            field_key = field['field_key']
-            
-            safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-            callback_data = f"custom_field_{apt_id}_help_{safe_field_key}"
             
-            if len(callback_data.encode('utf-8')) > 64:
-                field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-                callback_data = f"cust_f_{apt_id}_help_{field_hash}"
+            callback_data = field_callback(CB_CUSTOM_VIEW, apt_id, 'help', info_id=field['info_id'])
             
             buttons.append([InlineKeyboardButton(text=f"✨ {field_name}", callback_data=callback_data)])
     
@@ -1160,7 +4079,7 @@ async def get_help_subsection_keyboard(apt_id: int, filled_fields: set = None):
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-async def get_stores_subsection_keyboard(apt_id: int, filled_fields: set = None):
+async def get_stores_subsection_keyboard(apt_id: int, filled_fields: set = None, fields_state: Dict = None):
     """Клавиатура подраздела Магазины с индикаторами заполненности"""
     filled_fields = filled_fields or set()
     
@@ -1168,25 +4087,20 @@ async def get_stores_subsection_keyboard(apt_id: int, filled_fields: set = None)
         return f"{name} ■" if key in filled_fields else name
     
     buttons = [
-        [InlineKeyboardButton(text=field_text("🛒 Магазины", "shops"), callback_data=f"field_shops_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🚗 Аренда авто", "car_rental"), callback_data=f"field_car_rental_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🏃 Спорт", "sport"), callback_data=f"field_sport_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("💊 Больницы", "hospitals"), callback_data=f"field_hospitals_{apt_id}")],
+        [InlineKeyboardButton(text=field_text("🛒 Магазины", "shops"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'stores', 'shops'))],
+        [InlineKeyboardButton(text=field_text("🚗 Аренда авто", "car_rental"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'stores', 'car_rental'))],
+        [InlineKeyboardButton(text=field_text("🏃 Спорт", "sport"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'stores', 'sport'))],
+        [InlineKeyboardButton(text=field_text("💊 Больницы", "hospitals"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'stores', 'hospitals'))],
     ]
     
     # Добавляем кастомные кнопки
-    custom_fields = await get_section_fields(apt_id, 'stores')
-    for field in custom_fields:
-        if field['field_key'].startswith('custom_'):
+    if fields_state is None:
+        fields_state = await get_apartment_fields_state(apt_id)
+    for field_key, field in fields_state['stores'].items():
+        if field_key.startswith('custom_'):
             field_name = field['field_name']
-            field_key = field['field_key']
-            
-            safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-            callback_data = f"custom_field_{apt_id}_stores_{safe_field_key}"
             
-            if len(callback_data.encode('utf-8')) > 64:
-                field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-                callback_data = f"cust_f_{apt_id}_stores_{field_hash}"
+            callback_data = field_callback(CB_CUSTOM_VIEW, apt_id, 'stores', info_id=field['info_id'])
             
             buttons.append([InlineKeyboardButton(text=f"✨ {field_name}", callback_data=callback_data)])
     
@@ -1195,7 +4109,7 @@ async def get_stores_subsection_keyboard(apt_id: int, filled_fields: set = None)
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-async def get_experiences_section_keyboard(apt_id: int, filled_fields: set = None):
+async def get_experiences_section_keyboard(apt_id: int, filled_fields: set = None, fields_state: Dict = None):
     """Клавиатура раздела Впечатления с индикаторами заполненности"""
     filled_fields = filled_fields or set()
     
@@ -1203,34 +4117,29 @@ async def get_experiences_section_keyboard(apt_id: int, filled_fields: set = Non
         return f"{name} ■" if key in filled_fields else name
     
     buttons = [
-        [InlineKeyboardButton(text=field_text("🗿 Экскурсии", "excursions"), callback_data=f"field_excursions_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🏛 Музеи", "museums"), callback_data=f"field_museums_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🌳 Парки", "parks"), callback_data=f"field_parks_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🎬 Развлечения", "entertainment"), callback_data=f"field_entertainment_{apt_id}")],
+        [InlineKeyboardButton(text=field_text("🗿 Экскурсии", "excursions"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'experiences', 'excursions'))],
+        [InlineKeyboardButton(text=field_text("🏛 Музеи", "museums"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'experiences', 'museums'))],
+        [InlineKeyboardButton(text=field_text("🌳 Парки", "parks"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'experiences', 'parks'))],
+        [InlineKeyboardButton(text=field_text("🎬 Развлечения", "entertainment"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'experiences', 'entertainment'))],
     ]
     
     # Добавляем кастомные кнопки
-    custom_fields = await get_section_fields(apt_id, 'experiences')
-    for field in custom_fields:
-        if field['field_key'].startswith('custom_'):
+    if fields_state is None:
+        fields_state = await get_apartment_fields_state(apt_id)
+    for field_key, field in fields_state['experiences'].items():
+        if field_key.startswith('custom_'):
             field_name = field['field_name']
-            field_key = field['field_key']
-            
-            safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-            callback_data = f"custom_field_{apt_id}_experiences_{safe_field_key}"
             
-            if len(callback_data.encode('utf-8')) > 64:
-                field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-                callback_data = f"cust_f_{apt_id}_exp_{field_hash}"
+            callback_data = field_callback(CB_CUSTOM_VIEW, apt_id, 'experiences', info_id=field['info_id'])
             
             buttons.append([InlineKeyboardButton(text=f"✨ {field_name}", callback_data=callback_data)])
     
-    buttons.append([InlineKeyboardButton(text="➕ Добавить", callback_data=f"add_custom_exp_{apt_id}")])
+    buttons.append([InlineKeyboardButton(text="➕ Добавить", callback_data=f"add_custom_experiences_{apt_id}")])
     buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"apartment_{apt_id}")])
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-async def get_checkout_section_keyboard(apt_id: int, filled_fields: set = None):
+async def get_checkout_section_keyboard(apt_id: int, filled_fields: set = None, fields_state: Dict = None):
     """Клавиатура раздела Выселение с индикаторами заполненности"""
     filled_fields = filled_fields or set()
     
@@ -1238,25 +4147,20 @@ async def get_checkout_section_keyboard(apt_id: int, filled_fields: set = None):
         return f"{name} ■" if key in filled_fields else name
     
     buttons = [
-        [InlineKeyboardButton(text=field_text("🚪 Выезд без менеджера", "self_checkout"), callback_data=f"field_self_checkout_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("💸 Возврат депозита", "deposit_return"), callback_data=f"field_deposit_return_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("📅 Продление", "extend_stay"), callback_data=f"field_extend_stay_{apt_id}")],
-        [InlineKeyboardButton(text=field_text("🎁 Скидки", "discounts"), callback_data=f"field_discounts_{apt_id}")],
+        [InlineKeyboardButton(text=field_text("🚪 Выезд без менеджера", "self_checkout"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkout', 'self_checkout'))],
+        [InlineKeyboardButton(text=field_text("💸 Возврат депозита", "deposit_return"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkout', 'deposit_return'))],
+        [InlineKeyboardButton(text=field_text("📅 Продление", "extend_stay"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkout', 'extend_stay'))],
+        [InlineKeyboardButton(text=field_text("🎁 Скидки", "discounts"), callback_data=field_callback(CB_FIELD_EDIT, apt_id, 'checkout', 'discounts'))],
     ]
     
     # Добавляем кастомные кнопки
-    custom_fields = await get_section_fields(apt_id, 'checkout')
-    for field in custom_fields:
-        if field['field_key'].startswith('custom_'):
+    if fields_state is None:
+        fields_state = await get_apartment_fields_state(apt_id)
+    for field_key, field in fields_state['checkout'].items():
+        if field_key.startswith('custom_'):
             field_name = field['field_name']
-            field_key = field['field_key']
-            
-            safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-            callback_data = f"custom_field_{apt_id}_checkout_{safe_field_key}"
             
-            if len(callback_data.encode('utf-8')) > 64:
-                field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-                callback_data = f"cust_f_{apt_id}_checkout_{field_hash}"
+            callback_data = field_callback(CB_CUSTOM_VIEW, apt_id, 'checkout', info_id=field['info_id'])
             
             buttons.append([InlineKeyboardButton(text=f"✨ {field_name}", callback_data=callback_data)])
     
@@ -1271,6 +4175,41 @@ def get_field_edit_keyboard(apt_id: int, section: str):
         [InlineKeyboardButton(text="⏭ Пропустить", callback_data=f"skip_field_{section}_{apt_id}")]
     ])
 
+async def get_section_screen(apt_id: int, section: str) -> Tuple[str, InlineKeyboardMarkup]:
+    """
+    Заголовок и клавиатура раздела с индикаторами заполненности.
+    Заполненность всех разделов берётся одним запросом.
+    """
+    fields_state = await get_apartment_fields_state(apt_id)
+    
+    if section == "help":
+        filled_fields = filled_keys(fields_state, 'help')
+        keyboard = await get_help_subsection_keyboard(apt_id, filled_fields, fields_state)
+        text = "Подраздел 🏠 Помощь"
+    elif section == "stores":
+        filled_fields = filled_keys(fields_state, 'stores')
+        keyboard = await get_stores_subsection_keyboard(apt_id, filled_fields, fields_state)
+        text = "Подраздел 📍 Магазины"
+    elif section == "rent":
+        filled_fields = filled_keys(fields_state, 'rent')
+        keyboard = await get_rent_section_keyboard(apt_id, filled_fields, fields_state)
+        text = "Раздел 📹 Аренда"
+    elif section == "experiences":
+        filled_fields = filled_keys(fields_state, 'experiences')
+        keyboard = await get_experiences_section_keyboard(apt_id, filled_fields, fields_state)
+        text = "Раздел 🍿 Впечатления"
+    elif section == "checkout":
+        filled_fields = filled_keys(fields_state, 'checkout')
+        keyboard = await get_checkout_section_keyboard(apt_id, filled_fields, fields_state)
+        text = "Раздел 📦 Выселение"
+    else:
+        # Заселение показывает индикаторы и для подразделов
+        all_filled = filled_keys(fields_state, 'checkin', 'help', 'stores')
+        keyboard = await get_checkin_section_keyboard_async(apt_id, all_filled, fields_state)
+        text = "Раздел 🧳 Заселение"
+    
+    return text, keyboard
+
 # ============================================
 # КОМАНДЫ
 # ============================================
@@ -1286,22 +4225,27 @@ async def cmd_start(message: types.Message, state: FSMContext):
     
     # Режим гостя
     if start_param and start_param.startswith("guest_"):
-        hash_code = start_param.replace("guest_", "")
-        booking = await get_booking_by_hash(hash_code)
+        token = start_param.replace("guest_", "")
+        booking = None
+        
+        # Подделки и истёкшие ссылки отсекаются проверкой подписи, без запроса к БД
+        booking_id = verify_link_token(LINK_KIND_GUEST, token)
+        if booking_id is not None:
+            link_token_stats['signed'] += 1
+            booking = await get_booking_by_id(booking_id)
+        elif is_legacy_link_hash(token):
+            link_token_stats['legacy'] += 1
+            booking = await get_booking_by_hash(token)
+        else:
+            link_token_stats['rejected'] += 1
         
+        guide = None
         if booking and not booking['is_complete']:
-            apt_id = booking['apartment_id']
-            apt_name = safe_str(booking['apartment_name'], 'Объект')
-            address = safe_str(booking['address'], 'Адрес не указан')
-            
-            text = f"{apt_name}\n\nАдрес: {address}.\n\nИнформация для изучения:"
+            # Первый вход гостя собирает гид; дальше все клики - из памяти
+            guide = await get_guest_guide(booking['apartment_id'])
             
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="➡️ Начать", callback_data=f"guest_start_{apt_id}")],
-                [InlineKeyboardButton(text="🚕 Такси", url="https://taxi.yandex.ru")]
-            ])
-            
-            await message.answer(text, reply_markup=keyboard)
+        if guide:
+            await message.answer(guide.welcome_text, reply_markup=guide.welcome_keyboard)
             return
         else:
             await message.answer("Бронирование не найдено или завершено.")
@@ -1309,8 +4253,18 @@ async def cmd_start(message: types.Message, state: FSMContext):
     
     # Присоединение по hash
     if start_param and start_param.startswith("org_"):
-        hash_code = start_param.replace("org_", "")
-        org_id = await join_organization_by_hash(telegram_id, hash_code)
+        token = start_param.replace("org_", "")
+        org_id = None
+        
+        invited_org_id = verify_link_token(LINK_KIND_ORG, token)
+        if invited_org_id is not None:
+            link_token_stats['signed'] += 1
+            org_id = await join_organization(telegram_id, invited_org_id)
+        elif is_legacy_link_hash(token):
+            link_token_stats['legacy'] += 1
+            org_id = await join_organization_by_hash(telegram_id, token)
+        else:
+            link_token_stats['rejected'] += 1
         
         if org_id:
             await state.update_data(current_organization_id=org_id)
@@ -1371,7 +4325,7 @@ async def cmd_home(message: types.Message):
 # ОСНОВНЫЕ ОБРАБОТЧИКИ
 # ============================================
 
-@dp.callback_query(F.data == "main_menu")
+@callback_router.exact("main_menu")
 async def main_menu(callback: types.CallbackQuery):
     await callback.message.edit_text(
         "Главное меню бота 🏠",
@@ -1379,7 +4333,7 @@ async def main_menu(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "home_main_menu")
+@callback_router.exact("home_main_menu")
 async def home_main_menu_handler(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     org_id = data.get('current_organization_id')
@@ -1396,7 +4350,7 @@ async def home_main_menu_handler(callback: types.CallbackQuery, state: FSMContex
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "home_useful_sections")
+@callback_router.exact("home_useful_sections")
 async def home_useful_sections_handler(callback: types.CallbackQuery):
     await callback.message.edit_text(
         "Полезные разделы",
@@ -1404,7 +4358,7 @@ async def home_useful_sections_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "back_to_home")
+@callback_router.exact("back_to_home")
 async def back_to_home_handler(callback: types.CallbackQuery):
     await callback.message.edit_text(
         "Вы в боте 🤖",
@@ -1416,7 +4370,7 @@ async def back_to_home_handler(callback: types.CallbackQuery):
 # СОЗДАНИЕ ОРГАНИЗАЦИИ
 # ============================================
 
-@dp.callback_query(F.data == "add_organization")
+@callback_router.exact("add_organization")
 async def add_organization(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
         "Напишите название компании:",
@@ -1458,7 +4412,7 @@ async def process_organization_city(message: types.Message, state: FSMContext):
     
     await state.set_data({'current_organization_id': org_id})
 
-@dp.callback_query(F.data == "cancel")
+@callback_router.exact("cancel")
 async def cancel_creation(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     
@@ -1482,7 +4436,7 @@ async def cancel_creation(callback: types.CallbackQuery, state: FSMContext):
 # ЛИЧНЫЙ КАБИНЕТ ОРГАНИЗАЦИИ  
 # ============================================
 
-@dp.callback_query(F.data == "organization_cabinet")
+@callback_router.exact("organization_cabinet")
 async def organization_cabinet(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     org_id = data.get('current_organization_id')
@@ -1512,22 +4466,21 @@ async def organization_cabinet(callback: types.CallbackQuery, state: FSMContext)
     
     await callback.answer()
 
-@dp.callback_query(F.data == "invite_manager")
+@callback_router.exact("invite_manager")
 async def invite_manager(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     org_id = data.get('current_organization_id')
     
-    org_info = await get_organization_info(org_id)
     bot_username = (await bot.get_me()).username
-    hash_code = safe_str(org_info.get('hash'), 'hash')
-    invite_link = f"https://t.me/{bot_username}?start=org_{hash_code}"
+    token = sign_link_token(LINK_KIND_ORG, org_id, INVITE_LINK_TTL_DAYS)
+    invite_link = f"https://t.me/{bot_username}?start=org_{token}"
     
     text = f"Ссылка для приглашения:\n\n{invite_link}"
     
     await callback.message.answer(text)
     await callback.answer()
 
-@dp.callback_query(F.data == "managers_list")
+@callback_router.exact("managers_list")
 async def managers_list(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     org_id = data.get('current_organization_id')
@@ -1561,7 +4514,7 @@ async def managers_list(callback: types.CallbackQuery, state: FSMContext):
 # МЕНЮ ОБЪЕКТОВ
 # ============================================
 
-@dp.callback_query(F.data == "objects_menu")
+@callback_router.exact("objects_menu")
 async def objects_menu(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     org_id = data.get('current_organization_id')
@@ -1582,7 +4535,7 @@ async def objects_menu(callback: types.CallbackQuery, state: FSMContext):
             return
     
     # ✅ ДОБАВЛЕНО: проверка прав доступа
-    async with db_pool.acquire() as conn:
+    async with db_acquire() as conn:
         is_manager = await conn.fetchval('''
             SELECT 1 FROM managers_organization_lnk mol
             JOIN managers m ON mol.manager_id = m.id
@@ -1621,7 +4574,7 @@ async def objects_menu(callback: types.CallbackQuery, state: FSMContext):
 # ДОБАВЛЕНИЕ КВАРТИРЫ
 # ============================================
 
-@dp.callback_query(F.data == "add_apartment")
+@callback_router.exact("add_apartment")
 async def add_apartment(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
         "Введите название объекта:",
@@ -1669,7 +4622,7 @@ async def process_apartment_address(message: types.Message, state: FSMContext):
     
     await message.answer("Сохранить объект?", reply_markup=keyboard)
 
-@dp.callback_query(F.data.startswith("confirm_save_"))
+@callback_router.prefix("confirm_save_")
 async def confirm_save(callback: types.CallbackQuery, state: FSMContext):
     """
     ДОБАВЛЕНО: уведомление о сохранении
@@ -1687,7 +4640,7 @@ async def confirm_save(callback: types.CallbackQuery, state: FSMContext):
     # НОВОЕ: уведомление
     await callback.answer("✅ Объект сохранен!")
 
-@dp.callback_query(F.data == "skip_address")
+@callback_router.exact("skip_address")
 async def skip_address(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     apt_name = data.get('apartment_name')
@@ -1717,7 +4670,7 @@ async def skip_address(callback: types.CallbackQuery, state: FSMContext):
 # ПРОСМОТР КВАРТИРЫ
 # ============================================
 
-@dp.callback_query(F.data.startswith("apartment_") & ~F.data.startswith("apt_preview_"))
+@callback_router.prefix("apartment_")
 async def view_apartment(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[1])
     apt_info = await get_apartment_info(apt_id)
@@ -1731,7 +4684,7 @@ async def view_apartment(callback: types.CallbackQuery):
     
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("toggle_term_"))
+@callback_router.prefix("toggle_term_")
 async def toggle_term_handler(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[2])
     await toggle_apartment_term(apt_id)
@@ -1746,7 +4699,7 @@ async def toggle_term_handler(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=get_apartment_menu_keyboard(apt_id, is_long))
     await callback.answer(f"✅ {mode_text}")
 
-@dp.callback_query(F.data.startswith("delete_apartment_"))
+@callback_router.prefix("delete_apartment_")
 async def confirm_delete_apartment(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[2])
     
@@ -1758,7 +4711,7 @@ async def confirm_delete_apartment(callback: types.CallbackQuery):
     await callback.message.edit_text("Удалить объект?", reply_markup=keyboard)
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("confirm_delete_"))
+@callback_router.prefix("confirm_delete_")
 async def delete_apartment_confirmed(callback: types.CallbackQuery, state: FSMContext):
     apt_id = int(callback.data.split("_")[2])
     await delete_apartment(apt_id)
@@ -1777,78 +4730,71 @@ async def delete_apartment_confirmed(callback: types.CallbackQuery, state: FSMCo
 # РАЗДЕЛЫ КВАРТИРЫ
 # ============================================
 
-@dp.callback_query(F.data.startswith("section_checkin_"))
+@callback_router.prefix("section_checkin_")
 async def section_checkin(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[2])
     
-    # НОВОЕ: получаем заполненные поля для индикаторов
-    filled_checkin = await get_filled_fields(apt_id, 'checkin')
-    filled_help = await get_filled_fields(apt_id, 'help')
-    filled_stores = await get_filled_fields(apt_id, 'stores')
-    
-    # Объединяем все заполненные поля для подразделов
-    all_filled = filled_checkin | filled_help | filled_stores
-    
-    keyboard = await get_checkin_section_keyboard_async(apt_id, all_filled)
+    # НОВОЕ: получаем заполненные поля для индикаторов (все разделы одним запросом)
+    text, keyboard = await get_section_screen(apt_id, 'checkin')
     
     await callback.message.edit_text(
-        "Раздел 🧳 Заселение",
+        text,
         reply_markup=keyboard
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("section_rent_"))
+@callback_router.prefix("section_rent_")
 async def section_rent(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[2])
-    filled_fields = await get_filled_fields(apt_id, 'rent')
+    text, keyboard = await get_section_screen(apt_id, 'rent')
     
     await callback.message.edit_text(
-        "Раздел 📹 Аренда",
-        reply_markup=await get_rent_section_keyboard(apt_id, filled_fields)
+        text,
+        reply_markup=keyboard
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("subsection_help_"))
+@callback_router.prefix("subsection_help_")
 async def subsection_help(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[2])
-    filled_fields = await get_filled_fields(apt_id, 'help')
+    text, keyboard = await get_section_screen(apt_id, 'help')
     
     await callback.message.edit_text(
-        "Подраздел 🏠 Помощь",
-        reply_markup=await get_help_subsection_keyboard(apt_id, filled_fields)
+        text,
+        reply_markup=keyboard
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("subsection_stores_"))
+@callback_router.prefix("subsection_stores_")
 async def subsection_stores(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[2])
-    filled_fields = await get_filled_fields(apt_id, 'stores')
+    text, keyboard = await get_section_screen(apt_id, 'stores')
     
     await callback.message.edit_text(
-        "Подраздел 📍 Магазины",
-        reply_markup=await get_stores_subsection_keyboard(apt_id, filled_fields)
+        text,
+        reply_markup=keyboard
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("section_experiences_"))
+@callback_router.prefix("section_experiences_")
 async def section_experiences(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[2])
-    filled_fields = await get_filled_fields(apt_id, 'experiences')
+    text, keyboard = await get_section_screen(apt_id, 'experiences')
     
     await callback.message.edit_text(
-        "Раздел 🍿 Впечатления",
-        reply_markup=await get_experiences_section_keyboard(apt_id, filled_fields)
+        text,
+        reply_markup=keyboard
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("section_checkout_"))
+@callback_router.prefix("section_checkout_")
 async def section_checkout(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[2])
-    filled_fields = await get_filled_fields(apt_id, 'checkout')
+    text, keyboard = await get_section_screen(apt_id, 'checkout')
     
     await callback.message.edit_text(
-        "Раздел 📦 Выселение",
-        reply_markup=await get_checkout_section_keyboard(apt_id, filled_fields)
+        text,
+        reply_markup=keyboard
     )
     await callback.answer()
 
@@ -1856,18 +4802,8 @@ async def section_checkout(callback: types.CallbackQuery):
 # РЕДАКТИРОВАНИЕ ПОЛЕЙ
 # ============================================
 
-@dp.callback_query(F.data.startswith("field_"))
-async def edit_field(callback: types.CallbackQuery, state: FSMContext):
-    await callback.answer()
-    
-    parts = callback.data.split("_")
-    field_key = "_".join(parts[1:-1])
-    apt_id = int(parts[-1])
-    
-    field_name = FIELD_NAMES.get(field_key, "Поле")
-    field_desc = FIELD_DESCRIPTIONS.get(field_key, "Введите содержимое:")
-    
-    # Определяем секцию
+def legacy_field_section(field_key: str) -> str:
+    """Раздел статического поля для кнопок старого формата field_<key>_<apt_id>"""
     section = "checkin"
     if field_key in ['breakfast', 'linen', 'manager_contact', 'tv_setup', 'ac']:
         section = "help"
@@ -1879,6 +4815,26 @@ async def edit_field(callback: types.CallbackQuery, state: FSMContext):
         section = "experiences"
     elif field_key in ['self_checkout', 'deposit_return', 'extend_stay', 'discounts']:
         section = "checkout"
+    return section
+
+@callback_router.prefix("field_")
+@callback_router.action(CB_FIELD_EDIT)
+async def edit_field(callback: types.CallbackQuery, state: FSMContext, payload: FieldCallback = None):
+    await callback.answer()
+    
+    if payload:
+        field_key = payload.field_key
+        apt_id = payload.apt_id
+        section = payload.section
+    else:
+        # Старый формат field_<field_key>_<apt_id>
+        parts = callback.data.split("_")
+        field_key = "_".join(parts[1:-1])
+        apt_id = int(parts[-1])
+        section = legacy_field_section(field_key)
+    
+    field_name = FIELD_NAMES.get(field_key, "Поле")
+    field_desc = FIELD_DESCRIPTIONS.get(field_key, "Введите содержимое:")
     
     await state.update_data(
         editing_apartment_id=apt_id,
@@ -1929,72 +4885,22 @@ async def process_field_content(message: types.Message, state: FSMContext):
     # ✅ ДОБАВЛЕНО: уведомление о сохранении
     success_message = "✅ Информация успешно сохранена!"
     
-    filled_fields = await get_filled_fields(apt_id, section)
-    
-    if section == "help":
-        keyboard = await get_help_subsection_keyboard(apt_id, filled_fields)
-        text = f"Подраздел 🏠 Помощь\n\n{success_message}"
-    elif section == "stores":
-        keyboard = await get_stores_subsection_keyboard(apt_id, filled_fields)
-        text = f"Подраздел 📍 Магазины\n\n{success_message}"
-    elif section == "rent":
-        keyboard = await get_rent_section_keyboard(apt_id, filled_fields)
-        text = f"Раздел 📹 Аренда\n\n{success_message}"
-    elif section == "experiences":
-        keyboard = await get_experiences_section_keyboard(apt_id, filled_fields)
-        text = f"Раздел 🍿 Впечатления\n\n{success_message}"
-    elif section == "checkout":
-        keyboard = await get_checkout_section_keyboard(apt_id, filled_fields)
-        text = f"Раздел 📦 Выселение\n\n{success_message}"
-    else:
-        filled_checkin = await get_filled_fields(apt_id, 'checkin')
-        filled_help = await get_filled_fields(apt_id, 'help')
-        filled_stores = await get_filled_fields(apt_id, 'stores')
-        all_filled = filled_checkin | filled_help | filled_stores
-        
-        keyboard = await get_checkin_section_keyboard_async(apt_id, all_filled)
-        text = f"Раздел 🧳 Заселение\n\n{success_message}"
+    section_title, keyboard = await get_section_screen(apt_id, section)
+    text = f"{section_title}\n\n{success_message}"
     
     await message.answer(text, reply_markup=keyboard)
     await state.clear()
     
     logger.info(f"✅ Saved field {field_key} for apt {apt_id}")
 
-@dp.callback_query(F.data.startswith("skip_field_"))
+@callback_router.prefix("skip_field_")
 async def skip_field(callback: types.CallbackQuery, state: FSMContext):
     parts = callback.data.split("_")
     section = parts[2]
     apt_id = int(parts[3])
     
     # Определяем клавиатуру
-    if section == "help":
-        filled_fields = await get_filled_fields(apt_id, 'help')
-        keyboard = await get_help_subsection_keyboard(apt_id, filled_fields)
-        text = "Подраздел 🏠 Помощь"
-    elif section == "stores":
-        filled_fields = await get_filled_fields(apt_id, 'stores')
-        keyboard = await get_stores_subsection_keyboard(apt_id, filled_fields)
-        text = "Подраздел 📍 Магазины"
-    elif section == "rent":
-        filled_fields = await get_filled_fields(apt_id, 'rent')
-        keyboard = await get_rent_section_keyboard(apt_id, filled_fields)
-        text = "Раздел 📹 Аренда"
-    elif section == "experiences":
-        filled_fields = await get_filled_fields(apt_id, 'experiences')
-        keyboard = await get_experiences_section_keyboard(apt_id, filled_fields)
-        text = "Раздел 🍿 Впечатления"
-    elif section == "checkout":
-        filled_fields = await get_filled_fields(apt_id, 'checkout')
-        keyboard = await get_checkout_section_keyboard(apt_id, filled_fields)
-        text = "Раздел 📦 Выселение"
-    else:
-        filled_checkin = await get_filled_fields(apt_id, 'checkin')
-        filled_help = await get_filled_fields(apt_id, 'help')
-        filled_stores = await get_filled_fields(apt_id, 'stores')
-        all_filled = filled_checkin | filled_help | filled_stores
-        
-        keyboard = await get_checkin_section_keyboard_async(apt_id, all_filled)
-        text = "Раздел 🧳 Заселение"
+    text, keyboard = await get_section_screen(apt_id, section)
     
     await callback.message.edit_text(text, reply_markup=keyboard)
     await state.clear()
@@ -2004,7 +4910,7 @@ async def skip_field(callback: types.CallbackQuery, state: FSMContext):
 # РЕДАКТИРОВАНИЕ ОРГАНИЗАЦИИ
 # ============================================
 
-@dp.callback_query(F.data == "edit_org_name")
+@callback_router.exact("edit_org_name")
 async def edit_org_name(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
         "Напишите название компании:",
@@ -2031,7 +4937,7 @@ async def process_edit_org_name(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=get_organization_cabinet_keyboard(org_info))
     await state.set_data({'current_organization_id': org_id})
 
-@dp.callback_query(F.data == "edit_org_city")
+@callback_router.exact("edit_org_city")
 async def edit_org_city(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
         "Напишите город компании:",
@@ -2058,7 +4964,7 @@ async def process_edit_org_city(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=get_organization_cabinet_keyboard(org_info))
     await clear_state_keep_company(state)
 
-@dp.callback_query(F.data == "edit_org_greeting")
+@callback_router.exact("edit_org_greeting")
 async def edit_org_greeting(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
         "Введите приветствие:",
@@ -2088,7 +4994,7 @@ async def process_edit_org_greeting(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=get_organization_cabinet_keyboard(org_info))
     await clear_state_keep_company(state)
 
-@dp.callback_query(F.data == "edit_org_timezone")
+@callback_router.exact("edit_org_timezone")
 async def edit_org_timezone(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
         "Введите часовой пояс.\n\nПримеры:\nUTC+3 для Москвы\nUTC+5 для Екатеринбурга\nUTC+7 для Новосибирска",
@@ -2115,7 +5021,7 @@ async def process_edit_timezone(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=get_organization_cabinet_keyboard(org_info))
     await clear_state_keep_company(state)
 
-@dp.callback_query(F.data == "edit_checkin_time")
+@callback_router.exact("edit_checkin_time")
 async def edit_checkin_time(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
         "Введите время заезда в формате 12:00:",
@@ -2142,7 +5048,7 @@ async def process_edit_checkin_time(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=get_organization_cabinet_keyboard(org_info))
     await clear_state_keep_company(state)
 
-@dp.callback_query(F.data == "edit_checkout_time")
+@callback_router.exact("edit_checkout_time")
 async def edit_checkout_time(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
         "Введите время выезда в формате 12:00:",
@@ -2169,13 +5075,13 @@ async def process_edit_checkout_time(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=get_organization_cabinet_keyboard(org_info))
     await clear_state_keep_company(state)
 
-@dp.callback_query(F.data == "toggle_long_term")
+@callback_router.exact("toggle_long_term")
 async def toggle_long_term(callback: types.CallbackQuery, state: FSMContext):
     """ДОБАВЛЕНО: уведомление о сохранении"""
     data = await state.get_data()
     org_id = data.get('current_organization_id')
     
-    async with db_pool.acquire() as conn:
+    async with db_acquire(('organization', org_id)) as conn:
         await conn.execute('''
             UPDATE organizations 
             SET is_long = NOT COALESCE(is_long, FALSE), updated_at = NOW()
@@ -2195,7 +5101,7 @@ async def toggle_long_term(callback: types.CallbackQuery, state: FSMContext):
 # РЕДАКТИРОВАНИЕ ОБЪЕКТОВ
 # ============================================
 
-@dp.callback_query(F.data.startswith("edit_apartment_"))
+@callback_router.prefix("edit_apartment_")
 async def edit_apartment_info(callback: types.CallbackQuery, state: FSMContext):
     apt_id = int(callback.data.split("_")[2])
     
@@ -2219,7 +5125,7 @@ async def edit_apartment_info(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("edit_apt_name_"))
+@callback_router.prefix("edit_apt_name_")
 async def edit_apartment_name_start(callback: types.CallbackQuery, state: FSMContext):
     apt_id = int(callback.data.split("_")[3])
     
@@ -2253,7 +5159,7 @@ async def process_edit_apartment_name(message: types.Message, state: FSMContext)
     
     await message.answer("Сохранить объект?", reply_markup=keyboard)
 
-@dp.callback_query(F.data.startswith("edit_apt_addr_"))
+@callback_router.prefix("edit_apt_addr_")
 async def edit_apartment_address_start(callback: types.CallbackQuery, state: FSMContext):
     apt_id = int(callback.data.split("_")[3])
     
@@ -2287,7 +5193,7 @@ async def process_edit_apartment_address(message: types.Message, state: FSMConte
     
     await message.answer("Сохранить объект?", reply_markup=keyboard)
 
-@dp.callback_query(F.data.startswith("confirm_apt_edit_"))
+@callback_router.prefix("confirm_apt_edit_")
 async def confirm_apartment_edit(callback: types.CallbackQuery, state: FSMContext):
     """ДОБАВЛЕНО: уведомление о сохранении"""
     apt_id = int(callback.data.split("_")[3])
@@ -2296,7 +5202,7 @@ async def confirm_apartment_edit(callback: types.CallbackQuery, state: FSMContex
     # Обновляем название если было изменено
     new_name = data.get('new_apartment_name')
     if new_name:
-        async with db_pool.acquire() as conn:
+        async with db_acquire(('apartment', apt_id)) as conn:
             await conn.execute('''
                 UPDATE apartments 
                 SET name = $1, updated_at = NOW()
@@ -2306,13 +5212,17 @@ async def confirm_apartment_edit(callback: types.CallbackQuery, state: FSMContex
     # Обновляем адрес если был изменен
     new_address = data.get('new_apartment_address')
     if new_address:
-        async with db_pool.acquire() as conn:
+        async with db_acquire(('apartment', apt_id)) as conn:
             await conn.execute('''
                 UPDATE apartments 
                 SET address = $1, updated_at = NOW()
                 WHERE id = $2
             ''', new_address, apt_id)
     
+    if new_name or new_address:
+        # Название и адрес входят в гостевой гид
+        invalidate_apartment_snapshot(apt_id)
+    
     await clear_state_keep_company(state)
     
     apt_info = await get_apartment_info(apt_id)
@@ -2328,48 +5238,30 @@ async def confirm_apartment_edit(callback: types.CallbackQuery, state: FSMContex
 # ============================================
 
 async def get_custom_fields(apt_id: int, section: str) -> List[Dict]:
-    """Получить кастомные поля раздела"""
+    """Получить кастомные поля раздела (из снимка)"""
     section_name = SECTION_TO_CATEGORY_MAP.get(section, section)
+    snapshot = await get_apartment_snapshot(apt_id)
     
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch('''
-            SELECT i.id, i.name as field_name, i.text, i.type, i.caption,
-                   c.name as category_name
-            FROM infos i
-            JOIN infos_apartment_lnk ial ON i.id = ial.info_id
-            JOIN infos_category_lnk icl ON i.id = icl.info_id
-            JOIN categories c ON icl.category_id = c.id
-            WHERE ial.apartment_id = $1 
-            AND c.name LIKE 'Кастом %'
-            AND i.name LIKE '%' || $2 || '%'
-            ORDER BY i.created_at
-        ''', apt_id, section_name)
-        
-        result = []
-        for row in rows:
-            result.append({
-                'field_key': f"custom_{row['id']}",
-                'field_name': row['field_name'],
-                'text_content': row['text'],
-                'file_id': row['caption'],
-                'file_type': row['type']
-            })
-        
-        return result
+    return [
+        field for field in snapshot.custom_fields
+        if section_name in safe_str(field['field_name'])
+    ]
 
 async def delete_custom_field(apt_id: int, section: str, field_key: str):
     """Удалить кастомное поле"""
     info_id = int(field_key.split('_')[1])
     
-    async with db_pool.acquire() as conn:
+    async with db_acquire(('apartment', apt_id)) as conn:
         await conn.execute('DELETE FROM infos_apartment_lnk WHERE info_id = $1', info_id)
         await conn.execute('DELETE FROM infos_category_lnk WHERE info_id = $1', info_id)
         await conn.execute('DELETE FROM infos WHERE id = $1', info_id)
+    
+    invalidate_apartment_snapshot(apt_id)
 
-@dp.callback_query(F.data.startswith("add_custom_"))
+@callback_router.prefix("add_custom_")
 async def add_custom_button_start(callback: types.CallbackQuery, state: FSMContext):
     parts = callback.data.split("_")
-    section = parts[2]
+    section = normalize_section(parts[2])
     apt_id = int(parts[3])
     
     await state.update_data(
@@ -2471,7 +5363,7 @@ async def process_custom_button_content(message: types.Message, state: FSMContex
     )
     await state.set_state(ApartmentStates.waiting_custom_confirm)
 
-@dp.callback_query(F.data.startswith("save_custom_"))
+@callback_router.prefix("save_custom_")
 async def save_custom_field(callback: types.CallbackQuery, state: FSMContext):
     """ДОБАВЛЕНО: уведомление о сохранении"""
     parts = callback.data.split("_")
@@ -2488,7 +5380,7 @@ async def save_custom_field(callback: types.CallbackQuery, state: FSMContext):
     section_name = SECTION_TO_CATEGORY_MAP.get(section, section)
     custom_category_name = f"Кастом {field_name}"
     
-    async with db_pool.acquire() as conn:
+    async with db_acquire(('apartment', apt_id), ('category', None)) as conn:
         # Создаём категорию
         cat_id = await conn.fetchval('''
             INSERT INTO categories (
@@ -2521,9 +5413,9 @@ async def save_custom_field(callback: types.CallbackQuery, state: FSMContext):
             VALUES ($1, $2)
         ''', info_id, cat_id)
     
-    # Показываем страницу кастомной кнопки
-    field_key = f"custom_{info_id}"
+    invalidate_apartment_snapshot(apt_id)
     
+    # Показываем страницу кастомной кнопки
     # Определяем правильный callback для кнопки "Назад"
     if section in ['help', 'stores']:
         back_callback = f"subsection_{section}_{apt_id}"
@@ -2532,7 +5424,7 @@ async def save_custom_field(callback: types.CallbackQuery, state: FSMContext):
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Назад", callback_data=back_callback)],
-        [InlineKeyboardButton(text="Удалить кнопку", callback_data=f"delete_custom_{apt_id}_{section}_{field_key}")]
+        [InlineKeyboardButton(text="Удалить кнопку", callback_data=field_callback(CB_CUSTOM_DELETE, apt_id, section, info_id=info_id))]
     ])
     
     preview_text = text_content[:50] + "..." if text_content and len(text_content) > 50 else text_content or "(контент)"
@@ -2543,54 +5435,37 @@ async def save_custom_field(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer("✅ Кнопка сохранена!")
 
-@dp.callback_query(F.data.startswith("delete_custom_"))
-async def delete_custom_field_handler(callback: types.CallbackQuery):
+@callback_router.prefix("delete_custom_")
+@callback_router.action(CB_CUSTOM_DELETE)
+async def delete_custom_field_handler(callback: types.CallbackQuery, payload: FieldCallback = None):
     """ДОБАВЛЕНО: уведомление об удалении"""
-    parts = callback.data.split("_")
-    apt_id = int(parts[2])
-    section = parts[3]
-    field_key = "_".join(parts[4:])
+    if payload:
+        apt_id = payload.apt_id
+        section = payload.section
+        field_key = f"custom_{payload.info_id}"
+    else:
+        parts = callback.data.split("_")
+        apt_id = int(parts[2])
+        section = normalize_section(parts[3])
+        field_key = "_".join(parts[4:])
     
     await delete_custom_field(apt_id, section, field_key)
     
-    filled_fields = await get_filled_fields(apt_id, section)
-    
-    if section == "checkin":
-        filled_checkin = await get_filled_fields(apt_id, 'checkin')
-        filled_help = await get_filled_fields(apt_id, 'help')
-        filled_stores = await get_filled_fields(apt_id, 'stores')
-        all_filled = filled_checkin | filled_help | filled_stores
-        keyboard = await get_checkin_section_keyboard_async(apt_id, all_filled)
-        text = "Раздел 🧳 Заселение"
-    elif section == "rent":
-        keyboard = await get_rent_section_keyboard(apt_id, filled_fields)
-        text = "Раздел 📹 Аренда"
-    elif section == "experiences":
-        keyboard = await get_experiences_section_keyboard(apt_id, filled_fields)
-        text = "Раздел 🍿 Впечатления"
-    elif section == "checkout":
-        keyboard = await get_checkout_section_keyboard(apt_id, filled_fields)
-        text = "Раздел 📦 Выселение"
-    elif section == "help":
-        keyboard = await get_help_subsection_keyboard(apt_id, filled_fields)
-        text = "Подраздел 🏠 Помощь"
-    else:
-        keyboard = await get_stores_subsection_keyboard(apt_id, filled_fields)
-        text = "Подраздел 📍 Магазины"
+    text, keyboard = await get_section_screen(apt_id, section)
     
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer("✅ Кнопка удалена!")
 
-@dp.callback_query(F.data.startswith("custom_field_"))
+@callback_router.prefix("custom_field_")
 async def view_custom_field(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     apt_id = int(parts[2])
-    section = parts[3]
+    section = normalize_section(parts[3])
     field_key = "_".join(parts[4:])
     
     info_id = int(field_key.split('_')[1])
     
-    async with db_pool.acquire() as conn:
+    async with db_acquire() as conn:
         row = await conn.fetchrow('''
             SELECT name, text, type, caption
             FROM infos
@@ -2609,7 +5484,7 @@ async def view_custom_field(callback: types.CallbackQuery):
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Назад", callback_data=back_callback)],
-        [InlineKeyboardButton(text="Удалить кнопку", callback_data=f"delete_custom_{apt_id}_{section}_{field_key}")]
+        [InlineKeyboardButton(text="Удалить кнопку", callback_data=field_callback(CB_CUSTOM_DELETE, apt_id, section, info_id=info_id))]
     ])
     
     text_content = row['text']
@@ -2620,41 +5495,28 @@ async def view_custom_field(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
-# Обработчик для коротких callback кастомных полей (cust_f_)
-@dp.callback_query(F.data.startswith("cust_f_"))
-async def view_custom_field_short(callback: types.CallbackQuery):
-    """Обработчик для кастомных полей с хешированными callback"""
-    parts = callback.data.split("_")
-    apt_id = int(parts[2])
-    section = parts[3]
-    field_hash = parts[4]
-    
-    # Находим поле по хешу
-    custom_fields = await get_section_fields(apt_id, section)
-    
-    field_key = None
-    for field in custom_fields:
-        if field['field_key'].startswith('custom_'):
-            if hashlib.md5(field['field_key'].encode()).hexdigest()[:8] == field_hash:
-                field_key = field['field_key']
-                break
+# Кастомные поля: кодированные кнопки и старые короткие callback (cust_f_)
+@callback_router.prefix("cust_f_")
+@callback_router.action(CB_CUSTOM_VIEW)
+async def view_custom_field_short(callback: types.CallbackQuery, payload: FieldCallback = None):
+    """Просмотр кастомного поля по id записи infos"""
+    if payload:
+        apt_id = payload.apt_id
+        section = payload.section
+        snapshot = await get_apartment_snapshot(apt_id)
+        field = snapshot.resolve_callback(payload)
+    else:
+        parts = callback.data.split("_")
+        apt_id = int(parts[2])
+        section = normalize_section(parts[3])
+        snapshot = await get_apartment_snapshot(apt_id)
+        field = snapshot.resolve_token(parts[4])
     
-    if not field_key:
-        await callback.answer("Кнопка не найдена", show_alert=True)
+    if not field or not field['field_key'].startswith('custom_'):
+        await callback.answer("⚠️ Кнопка устарела. Откройте раздел заново.", show_alert=True)
         return
     
-    info_id = int(field_key.split('_')[1])
-    
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow('''
-            SELECT name, text, type, caption
-            FROM infos
-            WHERE id = $1
-        ''', info_id)
-    
-    if not row:
-        await callback.answer("Кнопка не найдена", show_alert=True)
-        return
+    info_id = field['info_id']
     
     # Определяем правильный callback для кнопки "Назад"
     if section in ['help', 'stores']:
@@ -2664,14 +5526,14 @@ async def view_custom_field_short(callback: types.CallbackQuery):
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Назад", callback_data=back_callback)],
-        [InlineKeyboardButton(text="Удалить кнопку", callback_data=f"delete_custom_{apt_id}_{section}_{field_key}")]
+        [InlineKeyboardButton(text="Удалить кнопку", callback_data=field_callback(CB_CUSTOM_DELETE, apt_id, section, info_id=info_id))]
     ])
     
-    text_content = row['text']
-    file_id = row['caption']
-    file_type = row['type']
+    text_content = field['text_content']
+    file_id = field['file_id']
+    file_type = field['file_type']
     
-    header = f"Кастомная кнопка: {row['name']}"
+    header = f"Кастомная кнопка: {field['field_name']}"
     
     # Если есть медиа - отправляем с медиа
     if file_id:
@@ -2708,7 +5570,7 @@ async def view_custom_field_short(callback: types.CallbackQuery):
 # БРОНИРОВАНИЯ
 # ============================================
 
-@dp.callback_query(F.data.startswith("bookings_"))
+@callback_router.prefix("bookings_")
 async def bookings_menu(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[1])
     
@@ -2739,7 +5601,7 @@ async def bookings_menu(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("add_booking_"))
+@callback_router.prefix("add_booking_")
 async def add_booking(callback: types.CallbackQuery, state: FSMContext):
     apt_id = int(callback.data.split("_")[2])
     
@@ -2795,8 +5657,12 @@ async def process_checkin_date(message: types.Message, state: FSMContext):
         checkin_date = datetime.strptime(message.text, '%d.%m.%Y').date()
         booking_id, hash_code = await create_booking(apt_id, guest_name, checkin_date)
         
+        # Собираем гостевой гид заранее, чтобы первый клик гостя не ждал БД
+        await get_guest_guide(apt_id)
+        
         bot_username = (await bot.get_me()).username
-        guest_link = f"https://t.me/{bot_username}?start=guest_{hash_code}"
+        token = sign_link_token(LINK_KIND_GUEST, booking_id, GUEST_LINK_TTL_DAYS)
+        guest_link = f"https://t.me/{bot_username}?start=guest_{token}"
         
         bookings = await get_apartment_bookings(apt_id)
         
@@ -2824,11 +5690,11 @@ async def process_checkin_date(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("Неверный формат даты. Используйте: 20.06.2025")
 
-@dp.callback_query(F.data.startswith("view_booking_"))
+@callback_router.prefix("view_booking_")
 async def view_booking(callback: types.CallbackQuery):
     booking_id = int(callback.data.split("_")[2])
     
-    async with db_pool.acquire() as conn:
+    async with db_acquire() as conn:
         booking = await conn.fetchrow('''
             SELECT b.*, bal.apartment_id
             FROM bookings b
@@ -2854,7 +5720,7 @@ async def view_booking(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("complete_booking_"))
+@callback_router.prefix("complete_booking_")
 async def complete_booking_handler(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     booking_id = int(parts[2])
@@ -2887,7 +5753,7 @@ async def complete_booking_handler(callback: types.CallbackQuery):
     
     await callback.answer("✅ Завершено")
 
-@dp.callback_query(F.data.startswith("owner_link_"))
+@callback_router.prefix("owner_link_")
 async def generate_owner_link(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[2])
     
@@ -2910,7 +5776,7 @@ async def generate_owner_link(callback: types.CallbackQuery):
 # ПРЕДПРОСМОТР ОБЪЕКТА
 # ============================================
 
-@dp.callback_query(F.data.startswith("apt_preview_"))
+@callback_router.prefix("apt_preview_")
 async def preview_apartment(callback: types.CallbackQuery, state: FSMContext):
     apt_id = int(callback.data.split("_")[2])
     
@@ -2923,329 +5789,36 @@ async def preview_apartment(callback: types.CallbackQuery, state: FSMContext):
     text = f"{apt_name}\n\nАдрес: {address}.\n\nИнформация для изучения:"
     
     buttons = []
-    buttons.append([InlineKeyboardButton(text="➡️ Начать", callback_data=f"prevw_start_{apt_id}")])
-    buttons.append([InlineKeyboardButton(text="🚕 Такси", url="https://taxi.yandex.ru")])
-    buttons.append([InlineKeyboardButton(text="Режим владельца", callback_data=f"exit_preview_{apt_id}")])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    
-    await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith("prevw_start_"))
-async def preview_start(callback: types.CallbackQuery):
-    apt_id = int(callback.data.split("_")[2])
-    
-    apt_info = await get_apartment_info(apt_id)
-    apt_name = apt_info['name']
-    
-    async with db_pool.acquire() as conn:
-        # ✅ ИСПРАВЛЕНО: добавлен GROUP BY
-        sections_data = await conn.fetch('''
-            SELECT COALESCE(parent_cat.name, child_cat.name) as section_name
-            FROM infos i
-            JOIN infos_apartment_lnk ial ON i.id = ial.info_id
-            JOIN infos_category_lnk icl ON i.id = icl.info_id
-            JOIN categories child_cat ON icl.category_id = child_cat.id
-            LEFT JOIN categories_parent_lnk cpl ON child_cat.id = cpl.category_id
-            LEFT JOIN categories parent_cat ON cpl.inv_category_id = parent_cat.id
-            WHERE ial.apartment_id = $1
-            AND COALESCE(parent_cat.name, child_cat.name) IN ('Заселение', 'Аренда', 'Впечатления', 'Выселение')
-            GROUP BY COALESCE(parent_cat.name, child_cat.name)
-        ''', apt_id)
-    
-    available_sections = set(row['section_name'] for row in sections_data)
-    
-    buttons = []
-    if 'Аренда' in available_sections:
-        buttons.append([InlineKeyboardButton(text="📹 Аренда", callback_data=f"prevw_section_rent_{apt_id}")])
-    if 'Заселение' in available_sections:
-        buttons.append([InlineKeyboardButton(text="🧳 Заселение", callback_data=f"prevw_section_checkin_{apt_id}")])
-    if 'Впечатления' in available_sections:
-        buttons.append([InlineKeyboardButton(text="🍿 Впечатления", callback_data=f"prevw_section_experiences_{apt_id}")])
-    if 'Выселение' in available_sections:
-        buttons.append([InlineKeyboardButton(text="📦 Выселение", callback_data=f"prevw_section_checkout_{apt_id}")])
-    
-    buttons.append([InlineKeyboardButton(text="Режим владельца", callback_data=f"exit_preview_{apt_id}")])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    
-    text = f"{apt_name}\n\nИнформация:"
-    
-    await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
-
-
-@dp.callback_query(F.data.startswith("prevw_section_"))
-async def preview_section(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    section = parts[2]
-    apt_id = int(parts[3])
-    
-    fields = await get_section_fields(apt_id, section)
-    
-    section_name = SECTION_NAMES.get(section, section)
-    section_icon = SECTION_ICONS.get(section, "📄")
-    
-    text = f"Раздел {section_icon} {section_name}"
-    
-    buttons = []
-    
-    for field in fields:
-        field_name = field['field_name']
-        field_key = field['field_key']
-        
-        safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-        callback_data = f"prevw_field_{apt_id}_{section}_{safe_field_key}"
-        
-        if len(callback_data.encode('utf-8')) > 64:
-            field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-            callback_data = f"prevw_f_{apt_id}_{section}_{field_hash}"
-        
-        buttons.append([InlineKeyboardButton(text=field_name, callback_data=callback_data)])
-    
-    if section == 'checkin':
-        help_fields = await get_section_fields(apt_id, 'help')
-        if help_fields:
-            buttons.append([InlineKeyboardButton(text="🏠 Помощь", callback_data=f"prevw_subsection_help_{apt_id}")])
-        
-        stores_fields = await get_section_fields(apt_id, 'stores')
-        if stores_fields:
-            buttons.append([InlineKeyboardButton(text="📍 Магазины", callback_data=f"prevw_subsection_stores_{apt_id}")])
-    
-    if not buttons:
-        await callback.answer("Раздел пуст", show_alert=True)
-        return
-    
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"prevw_start_{apt_id}")])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    
-    # Проверяем тип сообщения
-    if callback.message.photo or callback.message.video or callback.message.document:
-        try:
-            await callback.message.delete()
-            await callback.message.answer(text, reply_markup=keyboard)
-        except:
-            await callback.message.edit_caption(caption=text, reply_markup=keyboard)
-    else:
-        await callback.message.edit_text(text, reply_markup=keyboard)
-    
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith("prevw_subsection_help_"))
-async def preview_subsection_help(callback: types.CallbackQuery):
-    apt_id = int(callback.data.split("_")[3])
-    
-    fields = await get_section_fields(apt_id, 'help')
-    
-    if not fields:
-        await callback.answer("Подраздел пуст", show_alert=True)
-        return
-    
-    text = "Подраздел 🏠 Помощь"
-    
-    buttons = []
-    for field in fields:
-        field_name = field['field_name']
-        field_key = field['field_key']
-        
-        safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-        callback_data = f"prevw_field_{apt_id}_help_{safe_field_key}"
-        
-        if len(callback_data.encode('utf-8')) > 64:
-            field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-            callback_data = f"prevw_f_{apt_id}_help_{field_hash}"
-        
-        buttons.append([InlineKeyboardButton(text=field_name, callback_data=callback_data)])
-    
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"prevw_section_checkin_{apt_id}")])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    
-    await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith("prevw_subsection_stores_"))
-async def preview_subsection_stores(callback: types.CallbackQuery):
-    apt_id = int(callback.data.split("_")[3])
-    
-    fields = await get_section_fields(apt_id, 'stores')
-    
-    if not fields:
-        await callback.answer("Подраздел пуст", show_alert=True)
-        return
-    
-    text = "Подраздел 📍 Магазины"
-    
-    buttons = []
-    for field in fields:
-        field_name = field['field_name']
-        field_key = field['field_key']
-        
-        safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-        callback_data = f"prevw_field_{apt_id}_stores_{safe_field_key}"
-        
-        if len(callback_data.encode('utf-8')) > 64:
-            field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-            callback_data = f"prevw_f_{apt_id}_stores_{field_hash}"
-        
-        buttons.append([InlineKeyboardButton(text=field_name, callback_data=callback_data)])
-    
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"prevw_section_checkin_{apt_id}")])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    
-    await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith("prevw_field_") | F.data.startswith("prevw_f_"))
-async def preview_field(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    
-    if callback.data.startswith("prevw_f_"):
-        apt_id = int(parts[2])
-        section = parts[3]
-        field_hash = parts[4]
-        
-        fields = await get_section_fields(apt_id, section)
-        if not fields:
-            await callback.answer("Нет данных", show_alert=True)
-            return
-        
-        field_key = None
-        for f in fields:
-            if hashlib.md5(f['field_key'].encode()).hexdigest()[:8] == field_hash:
-                field_key = f['field_key']
-                break
-        
-        if not field_key:
-            field_key = fields[0]['field_key']
-    else:
-        apt_id = int(parts[2])
-        section = parts[3]
-        field_key = "_".join(parts[4:])
-    
-    field_data = await get_apartment_field(apt_id, section, field_key)
-    
-    if not field_data:
-        await callback.answer("Нет данных", show_alert=True)
-        return
-    
-    field_name = FIELD_NAMES.get(field_key)
-    if not field_name:
-        fields = await get_section_fields(apt_id, section)
-        for f in fields:
-            if f['field_key'] == field_key:
-                field_name = f['field_name']
-                break
-        if not field_name:
-            field_name = field_key.replace('_', ' ').title()
-    
-    text_content = field_data['text_content']
-    file_id = field_data['file_id']
-    file_type = field_data['file_type']
-    
-    header = f"Поле: {field_name}"
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Назад", callback_data=f"prevw_section_{section}_{apt_id}")]
-    ])
-    
-    if file_id:
-        try:
-            caption = f"{header}\n\n{text_content}" if text_content else header
-            
-            await callback.message.delete()
-            
-            if file_type == "photo":
-                await callback.message.answer_photo(file_id, caption=caption, reply_markup=keyboard)
-            elif file_type == "video":
-                await callback.message.answer_video(file_id, caption=caption, reply_markup=keyboard)
-            elif file_type == "document":
-                await callback.message.answer_document(file_id, caption=caption, reply_markup=keyboard)
-            
-            await callback.answer()
-            return
-            
-        except Exception as e:
-            logger.error(f"Error sending media: {e}")
-            full_text = f"{header}\n\n{text_content}" if text_content else header
-            try:
-                await callback.message.delete()
-                await callback.message.answer(full_text, reply_markup=keyboard)
-            except:
-                await callback.message.edit_text(full_text, reply_markup=keyboard)
-            await callback.answer()
-            return
-    
-    if text_content:
-        full_text = f"{header}\n\n{text_content}"
-    else:
-        full_text = header
-    
-    try:
-        await callback.message.edit_text(full_text, reply_markup=keyboard)
-    except Exception as e:
-        await callback.message.delete()
-        await callback.message.answer(full_text, reply_markup=keyboard)
-    
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith("exit_preview_"))
-async def exit_preview(callback: types.CallbackQuery, state: FSMContext):
-    apt_id = int(callback.data.split("_")[2])
-    await state.update_data(preview_mode=False)
+    buttons.append([InlineKeyboardButton(text="➡️ Начать", callback_data=f"prevw_start_{apt_id}")])
+    buttons.append([InlineKeyboardButton(text="🚕 Такси", url="https://taxi.yandex.ru")])
+    buttons.append([InlineKeyboardButton(text="Режим владельца", callback_data=f"exit_preview_{apt_id}")])
     
-    apt_info = await get_apartment_info(apt_id)
-    apt_name = safe_str(apt_info.get('name'), f'Объект #{apt_id}')
-    is_long = apt_info.get('is_long', False)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
-    text = f"Объект: {apt_name}"
-    await callback.message.edit_text(text, reply_markup=get_apartment_menu_keyboard(apt_id, is_long))
+    await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
-# ============================================
-# РЕЖИМ ГОСТЯ
-# ============================================
-
-@dp.callback_query(F.data.startswith("guest_start_"))
-async def guest_start(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.prefix("prevw_start_")
+async def preview_start(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[2])
     
-    await state.update_data(guest_mode=True, guest_apartment_id=apt_id)
-    
     apt_info = await get_apartment_info(apt_id)
     apt_name = apt_info['name']
     
-    async with db_pool.acquire() as conn:
-        # ✅ ИСПРАВЛЕНО: добавлен GROUP BY
-        sections_data = await conn.fetch('''
-            SELECT COALESCE(parent_cat.name, child_cat.name) as section_name
-            FROM infos i
-            JOIN infos_apartment_lnk ial ON i.id = ial.info_id
-            JOIN infos_category_lnk icl ON i.id = icl.info_id
-            JOIN categories child_cat ON icl.category_id = child_cat.id
-            LEFT JOIN categories_parent_lnk cpl ON child_cat.id = cpl.category_id
-            LEFT JOIN categories parent_cat ON cpl.inv_category_id = parent_cat.id
-            WHERE ial.apartment_id = $1
-            AND COALESCE(parent_cat.name, child_cat.name) IN ('Заселение', 'Аренда', 'Впечатления', 'Выселение')
-            GROUP BY COALESCE(parent_cat.name, child_cat.name)
-        ''', apt_id)
-    
-    available_sections = set(row['section_name'] for row in sections_data)
+    snapshot = await get_apartment_snapshot(apt_id)
+    available_sections = snapshot.available_sections()
     
     buttons = []
     if 'Аренда' in available_sections:
-        buttons.append([InlineKeyboardButton(text="📹 Аренда", callback_data=f"guest_section_rent_{apt_id}")])
+        buttons.append([InlineKeyboardButton(text="📹 Аренда", callback_data=f"prevw_section_rent_{apt_id}")])
     if 'Заселение' in available_sections:
-        buttons.append([InlineKeyboardButton(text="🧳 Заселение", callback_data=f"guest_section_checkin_{apt_id}")])
+        buttons.append([InlineKeyboardButton(text="🧳 Заселение", callback_data=f"prevw_section_checkin_{apt_id}")])
     if 'Впечатления' in available_sections:
-        buttons.append([InlineKeyboardButton(text="🍿 Впечатления", callback_data=f"guest_section_experiences_{apt_id}")])
+        buttons.append([InlineKeyboardButton(text="🍿 Впечатления", callback_data=f"prevw_section_experiences_{apt_id}")])
     if 'Выселение' in available_sections:
-        buttons.append([InlineKeyboardButton(text="📦 Выселение", callback_data=f"guest_section_checkout_{apt_id}")])
+        buttons.append([InlineKeyboardButton(text="📦 Выселение", callback_data=f"prevw_section_checkout_{apt_id}")])
     
-    buttons.append([InlineKeyboardButton(text="Режим владельца", callback_data="switch_to_owner")])
+    buttons.append([InlineKeyboardButton(text="Режим владельца", callback_data=f"exit_preview_{apt_id}")])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
@@ -3255,9 +5828,8 @@ async def guest_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-
-@dp.callback_query(F.data.startswith("guest_section_"))
-async def guest_view_section(callback: types.CallbackQuery):
+@callback_router.prefix("prevw_section_")
+async def preview_section(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     section = parts[2]
     apt_id = int(parts[3])
@@ -3267,43 +5839,34 @@ async def guest_view_section(callback: types.CallbackQuery):
     section_name = SECTION_NAMES.get(section, section)
     section_icon = SECTION_ICONS.get(section, "📄")
     
-    if section == 'checkin':
-        text = f"Раздел {section_icon} {section_name} ❤️"
-    else:
-        text = f"Раздел {section_icon} {section_name}"
+    text = f"Раздел {section_icon} {section_name}"
     
     buttons = []
     
     for field in fields:
         field_name = field['field_name']
-        field_key = field['field_key']
-        
-        safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-        callback_data = f"guest_field_{apt_id}_{section}_{safe_field_key}"
-        
-        if len(callback_data.encode('utf-8')) > 64:
-            field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-            callback_data = f"guest_f_{apt_id}_{section}_{field_hash}"
+        callback_data = field_callback(CB_PREVIEW_FIELD, apt_id, section, info_id=field['info_id'])
         
         buttons.append([InlineKeyboardButton(text=field_name, callback_data=callback_data)])
     
     if section == 'checkin':
         help_fields = await get_section_fields(apt_id, 'help')
         if help_fields:
-            buttons.append([InlineKeyboardButton(text="🏠 Помощь", callback_data=f"guest_subsection_help_{apt_id}")])
+            buttons.append([InlineKeyboardButton(text="🏠 Помощь", callback_data=f"prevw_subsection_help_{apt_id}")])
         
         stores_fields = await get_section_fields(apt_id, 'stores')
         if stores_fields:
-            buttons.append([InlineKeyboardButton(text="📍 Магазины", callback_data=f"guest_subsection_stores_{apt_id}")])
+            buttons.append([InlineKeyboardButton(text="📍 Магазины", callback_data=f"prevw_subsection_stores_{apt_id}")])
     
     if not buttons:
         await callback.answer("Раздел пуст", show_alert=True)
         return
     
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"guest_start_{apt_id}")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"prevw_start_{apt_id}")])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
+    # Проверяем тип сообщения
     if callback.message.photo or callback.message.video or callback.message.document:
         try:
             await callback.message.delete()
@@ -3315,8 +5878,8 @@ async def guest_view_section(callback: types.CallbackQuery):
     
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("guest_subsection_help_"))
-async def guest_subsection_help(callback: types.CallbackQuery):
+@callback_router.prefix("prevw_subsection_help_")
+async def preview_subsection_help(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[3])
     
     fields = await get_section_fields(apt_id, 'help')
@@ -3330,26 +5893,19 @@ async def guest_subsection_help(callback: types.CallbackQuery):
     buttons = []
     for field in fields:
         field_name = field['field_name']
-        field_key = field['field_key']
-        
-        safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-        callback_data = f"guest_field_{apt_id}_help_{safe_field_key}"
-        
-        if len(callback_data.encode('utf-8')) > 64:
-            field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-            callback_data = f"guest_f_{apt_id}_help_{field_hash}"
+        callback_data = field_callback(CB_PREVIEW_FIELD, apt_id, 'help', info_id=field['info_id'])
         
         buttons.append([InlineKeyboardButton(text=field_name, callback_data=callback_data)])
     
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"guest_section_checkin_{apt_id}")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"prevw_section_checkin_{apt_id}")])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("guest_subsection_stores_"))
-async def guest_subsection_stores(callback: types.CallbackQuery):
+@callback_router.prefix("prevw_subsection_stores_")
+async def preview_subsection_stores(callback: types.CallbackQuery):
     apt_id = int(callback.data.split("_")[3])
     
     fields = await get_section_fields(apt_id, 'stores')
@@ -3363,52 +5919,52 @@ async def guest_subsection_stores(callback: types.CallbackQuery):
     buttons = []
     for field in fields:
         field_name = field['field_name']
-        field_key = field['field_key']
-        
-        safe_field_key = field_key[:30] if len(field_key) > 30 else field_key
-        callback_data = f"guest_field_{apt_id}_stores_{safe_field_key}"
-        
-        if len(callback_data.encode('utf-8')) > 64:
-            field_hash = hashlib.md5(field_key.encode()).hexdigest()[:8]
-            callback_data = f"guest_f_{apt_id}_stores_{field_hash}"
+        callback_data = field_callback(CB_PREVIEW_FIELD, apt_id, 'stores', info_id=field['info_id'])
         
         buttons.append([InlineKeyboardButton(text=field_name, callback_data=callback_data)])
     
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"guest_section_checkin_{apt_id}")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=f"prevw_section_checkin_{apt_id}")])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("guest_field_") | F.data.startswith("guest_f_"))
-async def guest_view_field(callback: types.CallbackQuery):
+@callback_router.prefix("prevw_field_", "prevw_f_")
+@callback_router.action(CB_PREVIEW_FIELD)
+async def preview_field(callback: types.CallbackQuery, payload: FieldCallback = None):
     parts = callback.data.split("_")
     
-    if callback.data.startswith("guest_f_"):
+    if payload:
+        apt_id = payload.apt_id
+        section = payload.section
+        
+        snapshot = await get_apartment_snapshot(apt_id)
+        field_data = snapshot.resolve_callback(payload)
+        
+        if not field_data:
+            await callback.answer("⚠️ Кнопка устарела. Откройте раздел заново.", show_alert=True)
+            return
+        
+        field_key = field_data['field_key']
+    elif callback.data.startswith("prevw_f_"):
         apt_id = int(parts[2])
         section = parts[3]
-        field_hash = parts[4]
         
-        fields = await get_section_fields(apt_id, section)
-        if not fields:
-            await callback.answer("Нет данных", show_alert=True)
-            return
+        # Токен ведёт прямо на info; устаревший токен - явная ошибка
+        snapshot = await get_apartment_snapshot(apt_id)
+        field_data = snapshot.resolve_token(parts[4])
         
-        field_key = None
-        for f in fields:
-            if hashlib.md5(f['field_key'].encode()).hexdigest()[:8] == field_hash:
-                field_key = f['field_key']
-                break
+        if not field_data:
+            await callback.answer("⚠️ Кнопка устарела. Откройте раздел заново.", show_alert=True)
+            return
         
-        if not field_key:
-            field_key = fields[0]['field_key']
+        field_key = field_data['field_key']
     else:
         apt_id = int(parts[2])
         section = parts[3]
         field_key = "_".join(parts[4:])
-    
-    field_data = await get_apartment_field(apt_id, section, field_key)
+        field_data = await get_apartment_field(apt_id, section, field_key)
     
     if not field_data:
         await callback.answer("Нет данных", show_alert=True)
@@ -3431,7 +5987,7 @@ async def guest_view_field(callback: types.CallbackQuery):
     header = f"Поле: {field_name}"
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Назад", callback_data=f"guest_section_{section}_{apt_id}")]
+        [InlineKeyboardButton(text="Назад", callback_data=f"prevw_section_{section}_{apt_id}")]
     ])
     
     if file_id:
@@ -3474,7 +6030,148 @@ async def guest_view_field(callback: types.CallbackQuery):
     
     await callback.answer()
 
-@dp.callback_query(F.data == "switch_to_owner")
+@callback_router.prefix("exit_preview_")
+async def exit_preview(callback: types.CallbackQuery, state: FSMContext):
+    apt_id = int(callback.data.split("_")[2])
+    await state.update_data(preview_mode=False)
+    
+    apt_info = await get_apartment_info(apt_id)
+    apt_name = safe_str(apt_info.get('name'), f'Объект #{apt_id}')
+    is_long = apt_info.get('is_long', False)
+    
+    text = f"Объект: {apt_name}"
+    await callback.message.edit_text(text, reply_markup=get_apartment_menu_keyboard(apt_id, is_long))
+    await callback.answer()
+
+# ============================================
+# РЕЖИМ ГОСТЯ
+# ============================================
+
+@callback_router.prefix("guest_start_")
+async def guest_start(callback: types.CallbackQuery, state: FSMContext):
+    apt_id = int(callback.data.split("_")[2])
+    
+    await state.update_data(guest_mode=True, guest_apartment_id=apt_id)
+    
+    guide = await get_guest_guide(apt_id)
+    if not guide:
+        await callback.answer("Объект не найден", show_alert=True)
+        return
+    
+    await callback.message.edit_text(guide.start_text, reply_markup=guide.start_keyboard)
+    await callback.answer()
+
+
+
+@callback_router.prefix("guest_section_")
+async def guest_view_section(callback: types.CallbackQuery):
+    parts = callback.data.split("_")
+    section = normalize_section(parts[2])
+    apt_id = int(parts[3])
+    
+    guide = await get_guest_guide(apt_id)
+    screen = guide.sections.get(section) if guide else None
+    
+    if not screen:
+        await callback.answer("Раздел пуст", show_alert=True)
+        return
+    
+    text, keyboard = screen
+    
+    if callback.message.photo or callback.message.video or callback.message.document:
+        try:
+            await callback.message.delete()
+            await callback.message.answer(text, reply_markup=keyboard)
+        except:
+            await callback.message.edit_caption(caption=text, reply_markup=keyboard)
+    else:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    
+    await callback.answer()
+
+@callback_router.prefix("guest_subsection_help_", "guest_subsection_stores_")
+async def guest_subsection(callback: types.CallbackQuery):
+    parts = callback.data.split("_")
+    subsection = parts[2]
+    apt_id = int(parts[3])
+    
+    guide = await get_guest_guide(apt_id)
+    screen = guide.subsections.get(subsection) if guide else None
+    
+    if not screen:
+        await callback.answer("Подраздел пуст", show_alert=True)
+        return
+    
+    text, keyboard = screen
+    
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+@callback_router.prefix("guest_field_", "guest_f_")
+@callback_router.action(CB_GUEST_FIELD)
+async def guest_view_field(callback: types.CallbackQuery, payload: FieldCallback = None):
+    if payload:
+        apt_id = payload.apt_id
+        section = payload.section
+    else:
+        parts = callback.data.split("_")
+        apt_id = int(parts[2])
+        section = normalize_section(parts[3])
+        
+    guide = await get_guest_guide(apt_id)
+    if not guide:
+        await callback.answer("Нет данных", show_alert=True)
+        return
+    
+    # Поле ищем в снимке, из которого собран гид, - без обращений к БД
+    if payload:
+        field = guide.snapshot.resolve_callback(payload)
+    elif callback.data.startswith("guest_f_"):
+        field = guide.snapshot.resolve_token(parts[4])
+    else:
+        field = guide.snapshot.get_field("_".join(parts[4:]))
+    
+    card = guide.field_card(section, field) if field else None
+    
+    if not card:
+        await callback.answer("⚠️ Кнопка устарела. Откройте раздел заново.", show_alert=True)
+        return
+    
+    keyboard = card.keyboard
+    
+    if card.file_id:
+        try:
+            await callback.message.delete()
+            
+            if card.file_type == "photo":
+                await callback.message.answer_photo(card.file_id, caption=card.full_text, reply_markup=keyboard)
+            elif card.file_type == "video":
+                await callback.message.answer_video(card.file_id, caption=card.full_text, reply_markup=keyboard)
+            elif card.file_type == "document":
+                await callback.message.answer_document(card.file_id, caption=card.full_text, reply_markup=keyboard)
+            
+            await callback.answer()
+            return
+            
+        except Exception as e:
+            logger.error(f"Error sending media: {e}")
+            try:
+                await callback.message.delete()
+                await callback.message.answer(card.full_text, reply_markup=keyboard)
+            except:
+                await callback.message.edit_text(card.full_text, reply_markup=keyboard)
+            await callback.answer()
+            return
+    
+    try:
+        await callback.message.edit_text(card.full_text, reply_markup=keyboard)
+    except Exception as e:
+        await callback.message.delete()
+        await callback.message.answer(card.full_text, reply_markup=keyboard)
+    
+    await callback.answer()
+
+@callback_router.exact("switch_to_owner")
 async def switch_to_owner_mode(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     
@@ -3498,7 +6195,7 @@ async def switch_to_owner_mode(callback: types.CallbackQuery, state: FSMContext)
 # СИСТЕМА ПРЕДЛОЖЕНИЙ
 # ============================================
 
-@dp.callback_query(F.data == "suggest_improvement")
+@callback_router.exact("suggest_improvement")
 async def suggest_improvement_start(callback: types.CallbackQuery, state: FSMContext):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="main_menu")]
@@ -3513,7 +6210,7 @@ async def suggest_improvement_start(callback: types.CallbackQuery, state: FSMCon
     await state.set_state(SuggestionStates.waiting_suggestion)
     await callback.answer()
 
-@dp.callback_query(F.data == "connect_shahmatka")
+@callback_router.exact("connect_shahmatka")
 async def connect_shahmatka(callback: types.CallbackQuery, state: FSMContext):
     """Генерация ссылки для подключения шахматки"""
     data = await state.get_data()
@@ -3585,25 +6282,18 @@ async def process_suggestion(message: types.Message, state: FSMContext):
     user_info = f"{message.from_user.id} (@{message.from_user.username or 'no_username'})"
     logger.info(f"💡 Suggestion from {user_info}: {suggestion_text}")
     
-    admins = await get_bot_admins()
+    notification_text = (
+        f"💡 Новое предложение по улучшению бота\n\n"
+        f"От: {message.from_user.first_name} (@{message.from_user.username or 'no_username'})\n"
+        f"ID: {message.from_user.id}\n\n"
+        f"Предложение:\n{suggestion_text}"
+    )
     
-    if admins:
-        notification_text = (
-            f"💡 Новое предложение по улучшению бота\n\n"
-            f"От: {message.from_user.first_name} (@{message.from_user.username or 'no_username'})\n"
-            f"ID: {message.from_user.id}\n\n"
-            f"Предложение:\n{suggestion_text}"
-        )
-        
-        sent_count = 0
-        for admin_id in admins:
-            try:
-                await bot.send_message(admin_id, notification_text)
-                sent_count += 1
-            except Exception as e:
-                logger.error(f"Failed to send suggestion to admin {admin_id}: {e}")
+    # Доставку админам ведёт фоновый отправитель рассылок - пользователь не ждёт
+    broadcast = await create_broadcast('admins', notification_text, message.from_user.id)
         
-        logger.info(f"✅ Suggestion sent to {sent_count}/{len(admins)} admins")
+    if broadcast:
+        logger.info(f"✅ Suggestion queued as broadcast {broadcast[0]} for {broadcast[1]} admins")
     else:
         logger.warning("⚠️ No bot admins found in admin_users table")
     
@@ -3651,6 +6341,54 @@ async def cmd_company(message: types.Message, state: FSMContext):
             reply_markup=get_add_organization_keyboard()
         )
 
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message, command: CommandObject):
+    """
+    Команда /broadcast (только админы бота):
+    /broadcast all <текст> | /broadcast org <id> <текст> | /broadcast admins <текст>
+    Без аргументов - подсказка и последние рассылки.
+    """
+    if message.from_user.id not in await get_bot_admins():
+        await message.answer("⚠️ Команда доступна только администраторам бота")
+        return
+    
+    parts = (command.args or "").split(maxsplit=1)
+    audience = parts[0] if parts else ""
+    text = parts[1] if len(parts) > 1 else ""
+    org_id = None
+    
+    if audience == 'org':
+        org_parts = text.split(maxsplit=1)
+        if org_parts and org_parts[0].isdigit():
+            org_id = int(org_parts[0])
+            text = org_parts[1] if len(org_parts) > 1 else ""
+    
+    if audience not in BROADCAST_AUDIENCES or not text.strip() or (audience == 'org' and not org_id):
+        lines = [
+            "📣 Рассылка:",
+            "/broadcast all <текст> - всем менеджерам",
+            "/broadcast org <id> <текст> - менеджерам организации",
+            "/broadcast admins <текст> - админам бота"
+        ]
+        recent = await get_recent_broadcasts()
+        if recent:
+            lines.append("")
+            lines.append("Последние:")
+            for item in recent:
+                lines.append(
+                    f"#{item['id']} {item['audience']} - {item['status']}: "
+                    f"{item['sent']}/{item['total']} доставлено, {item['failed']} ошибок"
+                )
+        await message.answer("\n".join(lines))
+        return
+    
+    broadcast = await create_broadcast(audience, text, message.from_user.id, org_id)
+    
+    if broadcast:
+        await message.answer(f"✅ Рассылка #{broadcast[0]} поставлена в очередь: {broadcast[1]} получателей")
+    else:
+        await message.answer("⚠️ Получателей не найдено")
+
 @dp.message(Command("apartments"))
 async def cmd_apartments(message: types.Message, state: FSMContext):
     """Команда /apartments"""
@@ -3686,6 +6424,11 @@ async def cmd_apartments(message: types.Message, state: FSMContext):
 # ============================================
 
 @dp.callback_query()
+async def route_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Единая точка входа для всех кнопок - см. CallbackRouter"""
+    await callback_router.dispatch(callback, state)
+
+@callback_router.fallback
 async def fallback_callback_handler(callback: types.CallbackQuery):
     logger.warning(f"⚠️ Unhandled callback: {callback.data}")
     
@@ -3711,12 +6454,425 @@ async def fallback_message_handler(message: types.Message):
         reply_markup=get_main_menu_keyboard()
     )
 
+# ============================================
+# ГОТОВНОСТЬ
+# ============================================
+
+class LoopLagMonitor:
+    """
+    Лаг event loop: насколько позже запланированного просыпается sleep(interval).
+    Держит последние замеры - /ready смотрит на худший из недавних.
+    """
+    
+    WINDOW = 10
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.recent: deque = deque(maxlen=self.WINDOW)
+        self.histogram = LatencyHistogram()
+        self.last_lag = 0.0
+    
+    async def run(self):
+        while True:
+            expected_at = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(time.monotonic() - expected_at, 0.0)
+            self.recent.append(self.last_lag)
+            self.histogram.observe(self.last_lag)
+            if self.last_lag * 1000 > READY_MAX_LOOP_LAG_MS:
+                logger.warning(f"⚠️ Event loop lag {self.last_lag * 1000:.0f} ms")
+    
+    def recent_max(self) -> float:
+        return max(self.recent, default=0.0)
+
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL)
+
+# Выставляется в on_shutdown: реплика уходит из балансировки до остановки
+shutdown_started = asyncio.Event()
+
+async def check_database() -> Dict:
+    """Пул отдаёт соединение и БД отвечает за READY_DB_TIMEOUT"""
+    if db_pool is None:
+        return {'ok': False, 'error': 'pool not initialized'}
+    
+    started_at = time.monotonic()
+    try:
+        async with asyncio.timeout(READY_DB_TIMEOUT):
+            async with db_pool.acquire() as conn:
+                await conn.fetchval('SELECT 1')
+    except TimeoutError:
+        return {
+            'ok': False,
+            'error': f'no connection within {READY_DB_TIMEOUT}s',
+            'idle': db_pool.get_idle_size(),
+            'size': db_pool.get_size()
+        }
+    except Exception as e:
+        return {'ok': False, 'error': str(e)}
+    
+    return {'ok': True, 'ms': round((time.monotonic() - started_at) * 1000, 2), 'idle': db_pool.get_idle_size()}
+
+def check_loop_lag() -> Dict:
+    lag_ms = loop_lag_monitor.recent_max() * 1000
+    return {
+        'ok': lag_ms <= READY_MAX_LOOP_LAG_MS,
+        'lag_ms': round(loop_lag_monitor.last_lag * 1000, 2),
+        'recent_max_ms': round(lag_ms, 2),
+        'limit_ms': READY_MAX_LOOP_LAG_MS
+    }
+
+def check_update_progress() -> Dict:
+    """
+    Апдейты обрабатываются: самый давний ожидающий апдейт (в очереди webhook или пула)
+    ждёт не дольше READY_MAX_UPDATE_AGE секунд. Отсчёт от постановки в очередь, а не от
+    последнего обработанного - первый апдейт после простоя не делает реплику неготовой.
+    """
+    now = time.monotonic()
+    backlog = update_scheduler.depth + update_queue.qsize()
+    enqueued = [update_scheduler.oldest_enqueued_at()]
+    if update_queue_times:
+        enqueued.append(update_queue_times[0])
+    oldest = min((at for at in enqueued if at is not None), default=None)
+    wait = now - oldest if oldest is not None else 0.0
+    
+    return {
+        'ok': wait <= READY_MAX_UPDATE_AGE,
+        'oldest_wait_s': round(wait, 1),
+        'last_update_age_s': round(now - update_progress['last_processed_at'], 1),
+        'backlog': backlog,
+        'limit_s': READY_MAX_UPDATE_AGE
+    }
+
+async def readiness() -> Tuple[bool, Dict]:
+    checks = {
+        'shutdown': {'ok': not shutdown_started.is_set()},
+        'database': await check_database(),
+        'loop_lag': check_loop_lag(),
+        'updates': check_update_progress()
+    }
+    ready = all(check['ok'] for check in checks.values())
+    return ready, {'ready': ready, 'checks': checks}
+
+# ============================================
+# ПРОФИЛИРОВАНИЕ
+# ============================================
+
+def frame_label(frame) -> str:
+    """Кадр стека как "модуль:функция" - без номеров строк, чтобы стеки сливались"""
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_qualname}"
+
+def task_stack(task: asyncio.Task) -> List[str]:
+    """Цепочка await приостановленной задачи, от хендлера к тому, чего она ждёт"""
+    stack = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            stack.append(f"<{type(coro).__name__}>")
+            break
+        stack.append(frame_label(frame))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return stack
+
+def await_category(stack: List[str]) -> str:
+    """Чего ждёт обработчик: БД, Bot API или прочего"""
+    for label in reversed(stack):
+        if label.startswith("asyncpg"):
+            return 'db'
+        if label.startswith(("aiohttp", "aiogram.client")):
+            return 'telegram'
+    return 'other'
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профилировщик живого процесса, два вида сэмплов:
+    - cpu: поток раз в interval снимает стек главного потока (фильтры aiogram,
+      сборка клавиатур, разбор ответов) - время, когда event loop занят;
+    - await: event loop раз в interval снимает цепочки await задач, обрабатывающих
+      апдейты, - где обработчики ждут (asyncpg, Bot API, прочее).
+    Вне профилирования стоит одна проверка флага на апдейт.
+    """
+    
+    def __init__(self):
+        self.active = False
+        self.active_handlers: Dict[asyncio.Task, str] = {}
+        self.runs = 0
+    
+    @staticmethod
+    def _handler_codes() -> Dict:
+        """Код обработчиков -> имя: по ним CPU-сэмпл относится к обработчику"""
+        handlers = list(callback_router._kwargs)
+        for observer in (dp.message, dp.callback_query):
+            handlers.extend(handler.callback for handler in observer.handlers)
+        return {handler.__code__: handler.__name__ for handler in handlers if hasattr(handler, '__code__')}
+    
+    async def run(self, seconds: float, interval: float) -> Dict:
+        self.active = True
+        self.runs += 1
+        main_thread_id = threading.get_ident()
+        handler_codes = self._handler_codes()
+        
+        cpu_stacks = Counter()
+        cpu_handlers = Counter()
+        cpu_functions = Counter()
+        idle_samples = 0
+        await_stacks = Counter()
+        await_handlers: Dict[str, Counter] = {}
+        stop = threading.Event()
+        
+        def sample_cpu():
+            nonlocal idle_samples
+            while not stop.wait(interval):
+                frame = sys._current_frames().get(main_thread_id)
+                if frame is None:
+                    continue
+                if frame.f_code.co_filename.endswith("selectors.py"):
+                    idle_samples += 1
+                    continue
+                
+                stack = []
+                handler = "<outside handlers>"
+                cpu_functions[frame_label(frame)] += 1
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    handler = handler_codes.get(frame.f_code, handler)
+                    frame = frame.f_back
+                cpu_stacks[";".join(reversed(stack))] += 1
+                cpu_handlers[handler] += 1
+        
+        sampler = threading.Thread(target=sample_cpu, name="profiler", daemon=True)
+        sampler.start()
+        
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + seconds
+        try:
+            while loop.time() < deadline:
+                await asyncio.sleep(interval)
+                for task, label in list(self.active_handlers.items()):
+                    stack = task_stack(task)
+                    await_stacks[";".join([label] + stack)] += 1
+                    await_handlers.setdefault(label, Counter())[await_category(stack)] += 1
+        finally:
+            stop.set()
+            sampler.join()
+            self.active = False
+            self.active_handlers.clear()
+        
+        return {
+            'seconds': seconds,
+            'interval_ms': interval * 1000,
+            'cpu': {
+                'busy_samples': sum(cpu_stacks.values()),
+                'idle_samples': idle_samples,
+                'stacks': cpu_stacks,
+                'handlers': cpu_handlers,
+                'functions': cpu_functions
+            },
+            'await': {
+                'stacks': await_stacks,
+                'handlers': await_handlers
+            }
+        }
+
+profiler = SamplingProfiler()
+
+def collapsed_stacks(stacks: Counter) -> str:
+    """Формат flamegraph.pl / speedscope: "кадр;кадр;кадр число" """
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+def profile_summary(result: Dict, top: int) -> Dict:
+    """Топ-N обработчиков и функций по числу сэмплов (мс = сэмплы * интервал)"""
+    interval_ms = result['interval_ms']
+    cpu = result['cpu']
+    
+    handlers = []
+    for label, categories in result['await']['handlers'].items():
+        samples = sum(categories.values())
+        handlers.append({
+            'handler': label,
+            'in_flight_ms': round(samples * interval_ms, 1),
+            **{f'{category}_ms': round(categories[category] * interval_ms, 1)
+               for category in ('db', 'telegram', 'other')}
+        })
+    handlers.sort(key=lambda item: item['in_flight_ms'], reverse=True)
+    
+    return {
+        'seconds': result['seconds'],
+        'interval_ms': interval_ms,
+        'cpu_busy_ms': round(cpu['busy_samples'] * interval_ms, 1),
+        'cpu_idle_ms': round(cpu['idle_samples'] * interval_ms, 1),
+        'cpu_handlers': [{'handler': name, 'ms': round(count * interval_ms, 1)}
+                         for name, count in cpu['handlers'].most_common(top)],
+        'cpu_functions': [{'function': name, 'ms': round(count * interval_ms, 1)}
+                          for name, count in cpu['functions'].most_common(top)],
+        'handlers': handlers[:top],
+        'cpu_collapsed': collapsed_stacks(cpu['stacks']),
+        'await_collapsed': collapsed_stacks(result['await']['stacks'])
+    }
+
+async def profile_handler(request):
+    """
+    GET /debug/profile?seconds=10&interval_ms=5&top=20[&format=cpu|await]
+    Без format - JSON со сводкой и обоими дампами; с format - collapsed-стеки текстом.
+    """
+    if not PROFILE_TOKEN:
+        raise web.HTTPNotFound()
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization, f"Bearer {PROFILE_TOKEN}"):
+        return web.Response(status=401)
+    if profiler.active:
+        return web.Response(status=409, text="Profiling already in progress")
+    
+    try:
+        seconds = min(float(request.query.get("seconds", "10")), PROFILE_MAX_SECONDS)
+        interval = max(float(request.query.get("interval_ms", "5")), 1) / 1000
+        top = int(request.query.get("top", "20"))
+    except ValueError:
+        return web.Response(status=400)
+    
+    logger.info(f"🔬 Profiling for {seconds}s at {interval * 1000:.0f} ms")
+    result = await profiler.run(seconds, interval)
+    
+    output = request.query.get("format")
+    if output in ("cpu", "await"):
+        return web.Response(text=collapsed_stacks(result[output]['stacks']))
+    return web.json_response(profile_summary(result, top))
+
+# ============================================
+# WEBHOOK
+# ============================================
+
+# Принятые, но ещё не обработанные апдейты; при переполнении отвечаем 503 -
+# Telegram повторит доставку позже, апдейт не теряется
+update_queue: asyncio.Queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+# Время постановки апдейтов update_queue в том же порядке (FIFO) - для /ready
+update_queue_times: deque = deque()
+
+webhook_stats = {
+    'received': 0,
+    'rejected': 0,
+    'queue_full': 0,
+    'processed': 0,
+    'failed': 0
+}
+
+async def webhook_handler(request):
+    """Приём апдейта: проверка секрета, постановка в очередь, мгновенный ответ"""
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        webhook_stats['rejected'] += 1
+        return web.Response(status=401)
+    
+    try:
+        payload = await request.json()
+    except ValueError:
+        webhook_stats['rejected'] += 1
+        return web.Response(status=400)
+    
+    try:
+        update_queue.put_nowait(payload)
+    except asyncio.QueueFull:
+        webhook_stats['queue_full'] += 1
+        return web.Response(status=503)
+    update_queue_times.append(time.monotonic())
+    
+    webhook_stats['received'] += 1
+    return web.Response()
+
+async def run_update_worker():
+    """Воркер: разбирает апдейты из очереди и передаёт их диспетчеру"""
+    while True:
+        payload = await update_queue.get()
+        update_queue_times.popleft()
+        try:
+            update = types.Update.model_validate(payload, context={"bot": bot})
+            await dp.feed_update(bot, update)
+            webhook_stats['processed'] += 1
+        except Exception as e:
+            webhook_stats['failed'] += 1
+            logger.error(f"❌ Update processing failed: {e}")
+        finally:
+            update_queue.task_done()
+
+async def run_webhook():
+    """Регистрация webhook и работа до SIGTERM/SIGINT (маршрут добавлен в main)"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL is required for BOT_MODE=webhook")
+    
+    for _ in range(WEBHOOK_WORKERS):
+        background_tasks.append(asyncio.create_task(run_update_worker()))
+    
+    await dp.emit_startup(bot=bot)
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS
+    )
+    logger.info(f"🚀 Webhook set, {WEBHOOK_WORKERS} update workers")
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    await stop_event.wait()
+    
+    # Webhook не снимаем - его обслуживают остальные реплики; дорабатываем принятое
+    try:
+        await asyncio.wait_for(update_queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ {update_queue.qsize()} queued updates dropped on shutdown")
+    
+    await dp.emit_shutdown(bot=bot)
+
 # ============================================
 # ЗАПУСК БОТА
 # ============================================
 
+def require_stats_token(request):
+    """Проверка доступа к диагностическим маршрутам (SQL, состояние пула, метрики)"""
+    if not STATS_TOKEN:
+        if BOT_MODE == "webhook":
+            raise web.HTTPNotFound()
+        return
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization, f"Bearer {STATS_TOKEN}"):
+        raise web.HTTPUnauthorized()
+
+def collect_stats() -> Dict:
+    """Счётчики in-process кэшей для /stats"""
+    return {
+        'known_managers': known_managers.stats(),
+        'categories': len(category_ids),
+        'apartment_snapshots': apartment_snapshots.stats(),
+        'guest_guides': guest_guides.stats(),
+        'link_tokens': dict(link_token_stats),
+        'fsm_storage': storage.stats(),
+        'webhook': {**webhook_stats, 'queued': update_queue.qsize()},
+        'handlers': update_scheduler.stats(),
+        'idempotency': {**idempotency_stats, 'inflight': len(inflight_mutations)},
+        'db_requests': request_context_stats,
+        'read_flights': read_flights.stats(),
+        'tracing': {**trace_stats, 'queued': trace_queue.qsize()},
+        'broadcasts': dict(broadcast_stats),
+        'telegram_throttle': {**throttle_stats, 'chats': len(chat_send_buckets), 'wait': throttle_wait.stats()},
+        'change_feed': dict(change_feed_stats),
+        'callback_routes': callback_router.stats()
+    }
+
 async def on_shutdown():
     logger.info("Shutting down...")
+    shutdown_started.set()
+    if HANDLER_WORKERS:
+        await update_scheduler.drain(HANDLER_DRAIN_TIMEOUT)
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    if isinstance(storage, PostgresStorage):
+        # Сбросить буфер FSM до закрытия пула
+        await storage.close()
     if db_pool:
         await db_pool.close()
     await bot.session.close()
@@ -3730,15 +6886,51 @@ async def main():
     
     logger.info("✅ Bot started successfully")
     
-    # HTTP сервер для health checks
-    from aiohttp import web
+    if CHANGE_FEED_ENABLED:
+        background_tasks.append(asyncio.create_task(run_change_feed()))
+    
+    if HANDLER_WORKERS:
+        update_scheduler.start()
+    
+    background_tasks.append(asyncio.create_task(loop_lag_monitor.run()))
+    
+    if TRACING_ENABLED:
+        background_tasks.append(asyncio.create_task(run_trace_exporter()))
+    
+    background_tasks.append(asyncio.create_task(run_broadcast_sender()))
     
+    # HTTP сервер для health checks
     async def health_check(request):
         return web.Response(text="Bot is running")
     
+    async def stats_handler(request):
+        require_stats_token(request)
+        return web.json_response(collect_stats())
+    
+    async def query_stats_handler(request):
+        require_stats_token(request)
+        return web.json_response(query_stats())
+    
+    async def ready_handler(request):
+        ready, report = await readiness()
+        return web.json_response(report, status=200 if ready else 503)
+    
+    async def metrics_handler(request):
+        require_stats_token(request)
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Prometheus-Format": "0.0.4"})
+    
     app = web.Application()
     app.router.add_get("/", health_check)
     app.router.add_get("/health", health_check)
+    app.router.add_get("/ready", ready_handler)
+    app.router.add_get("/stats", stats_handler)
+    app.router.add_get("/stats/queries", query_stats_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/debug/profile", profile_handler)
+    if BOT_MODE == "webhook":
+        # После runner.setup() роутер заморожен - регистрируем до него
+        app.router.add_post(WEBHOOK_PATH, webhook_handler)
     
     runner = web.AppRunner(app)
     await runner.setup()
@@ -3762,18 +6954,21 @@ async def main():
     except Exception as e:
         logger.error(f"⚠️ Failed to set commands: {e}")
     
-    # Запуск polling
+    # Запуск webhook или polling
     try:
-        logger.info("🚀 Starting polling...")
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            logger.info("🚀 Starting polling...")
         
-        await dp.start_polling(
-            bot,
-            allowed_updates=dp.resolve_used_update_types(),
-            drop_pending_updates=True
-        )
+            await dp.start_polling(
+                bot,
+                allowed_updates=dp.resolve_used_update_types(),
+                drop_pending_updates=True
+            )
         
     except Exception as e:
-        logger.error(f"❌ Polling error: {e}")
+        logger.error(f"❌ Update loop error: {e}")
     finally:
         await on_shutdown()
         await runner.cleanup()